@@ -0,0 +1,416 @@
+import base64
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import tracemalloc
+import warnings
+import zlib
+from datetime import datetime, timedelta
+from sys import argv
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Tuple
+import fastf1 as ff1
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+import numpy as np
+import pandas as pd
+import gen_data
+from data import CORNER_LABELS, CORNER_TYPES
+from gen_data import CORNER_CHANNELS, SPEED_BANDS, corner_type_performance, corner_type_performance_batch, get_driver_fastest_laps, get_team_fastest_laps, label_lap, label_lap_by_speed
+from corner_segmentation import find_corners
+from lap_grid import resample_laps
+from lap_trace import LapTrace
+from live_replay import replay
+from trackviz import plot_speedtrace, plot_time_per_type, plot_track_map
+from track_clustering import cluster_sweep, kmeans_clustering, normalize
+
+# Offline benchmark of the analysis pipeline on synthetic telemetry: no network access or fastf1 cache needed.
+# Every stage is timed at up to three scales (one lap, one session, several seasons), then run once more under
+# tracemalloc to record its peak memory. Results are written as JSON, one file per run, so that runs of
+# different versions can be compared with `benchmark.py compare`.
+
+RESULTS_DIR = "benchmark_results"
+SAMPLE_RATE = 10      # Hz, ~750 samples per lap like the merged car and position data of fastf1
+TEAMS = 10
+DRIVERS_PER_TEAM = 2
+LAPS_PER_DRIVER = 12
+ROUNDS_PER_SEASON = 22
+TRACKS = 24
+MAX_SPEED = 90        # m/s
+BRAKING = 40          # m/s²
+ACCELERATION = 12     # m/s²
+
+class SyntheticLap:
+    "Minimal stand-in for fastf1's Lap: metadata by key and a telemetry DataFrame"
+    def __init__(self, metadata : Dict, telemetry : pd.DataFrame):
+        self.metadata = metadata
+        self.telemetry = telemetry
+
+    def __getitem__(self, key):
+        return self.metadata[key]
+
+class SyntheticSession:
+    "Minimal stand-in for fastf1's Session: a name with synthetic CORNER_LABELS and a fastf1 Laps table"
+    def __init__(self, name : str, laps : ff1.core.Laps):
+        self.name = name
+        self.laps = laps
+
+    def __str__(self) -> str:
+        return self.name
+
+def synthetic_track(rng : np.random.Generator, length : float = 5000) -> Tuple[np.ndarray, np.ndarray]:
+    "Random corner positions and apex speeds (m/s) of a track, at least 350 m apart"
+    n_corners = rng.integers(6, 12)
+    positions = np.sort(rng.choice(np.arange(300, length - 300, 350), n_corners, replace=False)).astype(float)
+    apex_speeds = rng.uniform(60, 260, n_corners) / 3.6
+    return positions, apex_speeds
+
+def synthetic_labels(positions : np.ndarray, apex_speeds : np.ndarray) -> List[Tuple[str, int, int]]:
+    "Hand-label-like corner windows around every corner, classified by apex speed"
+    types = np.digitize(apex_speeds * 3.6, SPEED_BANDS)
+    return [(CORNER_TYPES[t], int(p - 150), int(p + 150)) for t, p in zip(types, positions)]
+
+def synthetic_telemetry(positions : np.ndarray, apex_speeds : np.ndarray, pace : float = 1.0, length : float = 5000) -> pd.DataFrame:
+    "Telemetry of a lap sampled at SAMPLE_RATE: braking/acceleration limited speed profile, throttle, and a closed track map"
+    d = np.arange(0, length, 1.0)
+    gaps = d[:, np.newaxis] - positions[np.newaxis, :]
+    limits = np.sqrt(apex_speeds ** 2 + 2 * np.where(gaps < 0, BRAKING, ACCELERATION) * np.abs(gaps))
+    speed = np.minimum(limits.min(axis=1), MAX_SPEED) * pace
+    time = np.concatenate([[0], np.cumsum(np.diff(d) / speed[1:])])
+
+    samples = np.arange(0, time[-1], 1 / SAMPLE_RATE)
+    distance = np.interp(samples, time, d)
+    accelerating = np.diff(speed, append=speed[-1]) >= 0
+    throttle = np.where(accelerating, 100.0, 0.0)
+    angle = 2 * np.pi * distance / length
+
+    return pd.DataFrame({
+        "Distance" : distance,
+        "Time" : pd.to_timedelta(samples, unit='s'),
+        "Speed" : np.interp(distance, d, speed) * 3.6,
+        "Throttle" : np.interp(distance, d, throttle).round(),
+        "X" : 1500 * np.cos(angle) + 200 * np.cos(3 * angle),
+        "Y" : 900 * np.sin(angle),
+    })
+
+def synthetic_season_data(n_sessions : int, seed : int = 0) -> Tuple[List[SyntheticSession], List[SyntheticLap], Dict[str, List[Tuple[str, int, int]]]]:
+    "Synthetic sessions (lap tables), one labelled-ready team lap per team and session, and the corner labels of the sessions (see registered_labels)"
+    rng = np.random.default_rng(seed)
+    tracks = [synthetic_track(rng) for _ in range(TRACKS)]
+    sessions, laps, labels = [], [], {}
+    for i in range(n_sessions):
+        positions, apex_speeds = tracks[i % TRACKS]
+        name = f"Synthetic Season {i // ROUNDS_PER_SEASON + 1} Round {i % ROUNDS_PER_SEASON + 1} - Qualifying"
+        labels[name] = synthetic_labels(positions, apex_speeds)
+
+        rows = []
+        for team in range(TEAMS):
+            for driver in range(DRIVERS_PER_TEAM):
+                lap_times = 88 + team * 0.1 + rng.uniform(0, 3, LAPS_PER_DRIVER)
+                for lap_number, lap_time in enumerate(lap_times):
+                    rows.append({
+                        "Driver" : f"D{team}{driver}", "Team" : f"Team {team}", "LapNumber" : float(lap_number + 1),
+                        "LapTime" : pd.Timedelta(seconds=lap_time), "IsPersonalBest" : lap_time == lap_times[:lap_number + 1].min(),
+                        "Compound" : "SOFT", "Deleted" : False, "IsAccurate" : True,
+                    })
+        sessions.append(SyntheticSession(name, ff1.core.Laps(pd.DataFrame(rows))))
+
+        for team in range(TEAMS):
+            telemetry = synthetic_telemetry(positions, apex_speeds, pace = 1 - team * 0.002)
+            laps.append(SyntheticLap({"Driver" : f"D{team}0", "Team" : f"Team {team}", "Session" : sessions[-1]}, telemetry))
+
+    return sessions, laps, labels
+
+@contextlib.contextmanager
+def registered_labels(labels : Dict[str, List[Tuple[str, int, int]]]) -> Iterator[None]:
+    "Adds corner labels to CORNER_LABELS for the duration of a with block, then restores it (and drops their compiled indexes)"
+    previous = {name : CORNER_LABELS[name] for name in labels if name in CORNER_LABELS}
+    CORNER_LABELS.update(labels)
+    try:
+        yield
+    finally:
+        for name in labels:
+            del CORNER_LABELS[name]
+            gen_data._LABEL_INDEXES.pop(name, None)
+            gen_data._LABEL_CODES.pop(name, None)
+        CORNER_LABELS.update(previous)
+
+def synthetic_tracks_table(n_tracks : int, seed : int = 0) -> pd.DataFrame:
+    "Synthetic track_corners_db.json-like table"
+    rng = np.random.default_rng(seed)
+    times = rng.uniform(5, 40, (n_tracks, len(CORNER_TYPES)))
+    return pd.DataFrame(times, columns=CORNER_TYPES, index=[f"Track {i}" for i in range(n_tracks)])
+
+def measure(f : Callable[[], None], repeats : int) -> Dict[str, float]:
+    "Best and mean wall time over several runs, then the peak traced memory of one more run"
+    timings = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeats):
+            start = perf_counter()
+            f()
+            timings.append(perf_counter() - start)
+
+        tracemalloc.start()
+        f()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    plt.close("all")
+
+    return {"BestSeconds" : min(timings), "MeanSeconds" : float(np.mean(timings)), "PeakMemoryKB" : peak / 1024}
+
+def label_all(laps : List[SyntheticLap], labeller : Callable):
+    for lap in laps:
+        labeller(lap["Session"], lap)
+
+def ctp_all(laps : List[SyntheticLap]):
+    for lap in laps:
+        corner_type_performance(lap)
+
+def plot_all(laps : List[SyntheticLap], plot : Callable):
+    fig, ax = plt.subplots()
+    for lap in laps:
+        plot(lap, ax)
+
+def run_benchmarks(n_seasons : int = 3, repeats : int = 3) -> Dict:
+    "Times every stage of the pipeline at 1 lap, 1 session and n_seasons scale ('seasons')"
+    n_sessions = n_seasons * ROUNDS_PER_SEASON
+    sessions, laps, labels = synthetic_season_data(n_sessions)
+    with registered_labels(labels):
+        scales = {
+            "lap" : (sessions[:1], laps[:1]),
+            "session" : (sessions[:1], laps[:TEAMS]),
+            "seasons" : (sessions, laps),
+        }
+        label_all(laps, label_lap)
+        # Labelled LapTrace of every lap, to time the struct of arrays path against the telemetry DataFrames
+        lap_traces = {id(lap) : LapTrace.from_lap(lap) for lap in laps}
+        traces = lambda l: [lap_traces[id(lap)] for lap in l]
+
+        stages = {
+            "label_lap" : (lambda s, l: label_all(l, label_lap), None),
+            "label_lap_by_speed" : (lambda s, l: label_all(l, label_lap_by_speed), None),
+            "corner_type_performance" : (lambda s, l: ctp_all(l), None),
+            "corner_type_performance_batch" : (lambda s, l: corner_type_performance_batch(l), None),
+            "get_team_fastest_laps" : (lambda s, l: [get_team_fastest_laps(session) for session in s], ["session", "seasons"]),
+            "get_driver_fastest_laps" : (lambda s, l: [get_driver_fastest_laps(session) for session in s], ["session", "seasons"]),
+            "plot_track_map" : (lambda s, l: plot_all(l, plot_track_map), ["lap", "session"]),
+            "plot_speedtrace" : (lambda s, l: plot_all(l, plot_speedtrace), ["lap", "session"]),
+            "plot_time_per_type" : (lambda s, l: plot_all(l, plot_time_per_type), ["lap", "session"]),
+            "lap_trace" : (lambda s, l: [LapTrace.from_lap(lap) for lap in l], None),
+            "label_lap_trace" : (lambda s, l: label_all(traces(l), label_lap), None),
+            "corner_type_performance_trace" : (lambda s, l: ctp_all(traces(l)), None),
+            "plot_track_map_trace" : (lambda s, l: plot_all(traces(l), plot_track_map), ["lap", "session"]),
+            "plot_speedtrace_trace" : (lambda s, l: plot_all(traces(l), plot_speedtrace), ["lap", "session"]),
+        }
+
+        results = []
+        for stage, (f, stage_scales) in stages.items():
+            for scale, (scale_sessions, scale_laps) in scales.items():
+                if stage_scales is not None and scale not in stage_scales:
+                    continue
+                print(f"{stage} ({scale})...")
+                result = measure(lambda: f(scale_sessions, scale_laps), repeats)
+                results.append({"Stage" : stage, "Scale" : scale, "Laps" : len(scale_laps), "Sessions" : len(scale_sessions), **result})
+
+    for scale, n_tracks in (("season", TRACKS), ("seasons", TRACKS * n_seasons)):
+        tracks = normalize(synthetic_tracks_table(n_tracks))
+        stages = (
+            ("cluster_sweep", lambda: cluster_sweep(tracks, parallel = False, use_cache = False)),
+            ("cluster_sweep_parallel", lambda: cluster_sweep(tracks, use_cache = False)),
+            ("kmeans_clustering", lambda: kmeans_clustering(tracks, 4, cluster_sweep(tracks, [4], parallel = False, use_cache = False))),
+        )
+        for stage, f in stages:
+            print(f"{stage} ({scale})...")
+            results.append({"Stage" : stage, "Scale" : scale, "Tracks" : n_tracks, **measure(f, repeats)})
+
+    return {
+        "Version" : git_version(),
+        "Seasons" : n_seasons,
+        "Timestamp" : datetime.now().isoformat(timespec="seconds"),
+        "Python" : platform.python_version(),
+        "NumPy" : np.__version__,
+        "pandas" : pd.__version__,
+        "Results" : results,
+    }
+
+def check_resample_laps(seed : int = 0) -> bool:
+    "resample_laps of laps starting past 0 m (or before it) must match a separate np.interp of every lap"
+    rng = np.random.default_rng(seed)
+    positions, apex_speeds = synthetic_track(rng)
+    laps = []
+    for offset in (0.0, 3.0, -2.0, 12.0):
+        telemetry = synthetic_telemetry(positions, apex_speeds)
+        telemetry["Distance"] += offset
+        laps.append(SyntheticLap({"Driver" : "D00", "Team" : "Team 0"}, telemetry))
+
+    grid, values = resample_laps(laps, ["Time", "Speed"])
+    for lap, lap_values in zip(laps, values):
+        trace = LapTrace.from_lap(lap)
+        expected = np.column_stack([np.interp(grid, trace.distance, trace.time), np.interp(grid, trace.distance, trace.speed)])
+        if not np.allclose(lap_values, expected):
+            return False
+    return True
+
+def check_find_corners(seed : int = 0, min_accuracy : float = 0.9) -> bool:
+    "find_corners must find every corner of the synthetic tracks, and classify most of them like synthetic_labels"
+    rng = np.random.default_rng(seed)
+    found, classified, total = 0, 0, 0
+    for _ in range(TRACKS):
+        positions, apex_speeds = synthetic_track(rng)
+        telemetry = synthetic_telemetry(positions, apex_speeds)
+        corners = find_corners(telemetry["Distance"].to_numpy(), telemetry["Speed"].to_numpy(), telemetry["Throttle"].to_numpy())
+        for corner_type, position in zip(np.array(CORNER_TYPES)[np.digitize(apex_speeds * 3.6, SPEED_BANDS)], positions):
+            matches = [t for t, start, finish in corners if start <= position <= finish]
+            found += len(matches) > 0
+            classified += len(matches) > 0 and matches[0] == corner_type
+            total += 1
+    return found == total and classified >= min_accuracy * total
+
+def check_corner_totals(seed : int = 0) -> bool:
+    "The corners of every type must add up to the corner type totals, including on laps that start inside a corner"
+    rng = np.random.default_rng(seed)
+    positions, apex_speeds = synthetic_track(rng)
+    name = "Synthetic Corner Totals - Qualifying"
+    # Two adjacent windows of the same type around the start line: the lap starts inside a corner
+    labels = {name : [("LOW", -100, 100), ("LOW", 100, 140)] + synthetic_labels(positions, apex_speeds)}
+    session = SyntheticSession(name, ff1.core.Laps())
+    laps = [SyntheticLap({"Driver" : f"D{team}0", "Team" : f"Team {team}"}, synthetic_telemetry(positions, apex_speeds, pace = 1 - team * 0.002)) for team in range(3)]
+
+    with registered_labels(labels):
+        for lap in laps:
+            label_lap(session, lap)
+        types = corner_type_performance_batch(laps)
+        corners = gen_data.corner_performance_batch(session, laps)
+        corner_codes = gen_data.get_label_codes(name)[:-1]
+
+    distance_time = [CORNER_CHANNELS.index("Distance"), CORNER_CHANNELS.index("Time")]
+    for code in set(corner_codes) - {CORNER_TYPES.index("STRAIGHT")}:
+        totals = np.nansum(corners[:, corner_codes == code][:, :, distance_time], axis=1)
+        if not np.allclose(totals, types[:, code, :2]):
+            return False
+    return True
+
+def synthetic_recording(path : str, delay : float, seed : int = 0, drivers : int = 4, laps_per_driver : int = 2) -> Dict[Tuple[str, int], Tuple[np.ndarray, np.ndarray]]:
+    """Writes a live timing recording of synthetic laps, every message being published delay seconds after its data
+
+    Car and position samples (4 Hz) are published every second, the samples of the last second in one batch, and a
+    lap time when the lap ends. Returns the (time from the start of the lap in s, speed) of every (driver, lap)
+    """
+    rng = np.random.default_rng(seed)
+    positions, apex_speeds = synthetic_track(rng)
+    start = datetime(2023, 7, 8, 14, 0, 0)
+    utc = lambda t: (start + timedelta(seconds=float(t))).strftime("%Y-%m-%dT%H:%M:%S.%f") + "Z"
+    compress = lambda message: (lambda c: base64.b64encode(c.compress(json.dumps(message).encode()) + c.flush()).decode())(zlib.compressobj(wbits=-zlib.MAX_WBITS))
+
+    messages = [(0.0, "DriverList", {str(n) : {"Tla" : f"D{n:02d}", "TeamName" : f"Team {n // 2}"} for n in range(drivers)})]
+    samples, truth = [], {}
+    for n in range(drivers):
+        t = 5.0 + 3 * n
+        for k in range(laps_per_driver):
+            telemetry = synthetic_telemetry(positions, apex_speeds, pace = 1 - rng.uniform(0, 0.01))
+            time = (telemetry["Time"] / np.timedelta64(1, 's')).to_numpy()
+            truth[(f"D{n:02d}", k)] = (time, telemetry["Speed"].to_numpy())
+            sample_times = np.arange(np.ceil(t * 4) / 4, t + time[-1], 0.25)
+            channels = [np.interp(sample_times - t, time, telemetry[c]) for c in ("Speed", "Throttle", "X", "Y")]
+            samples.extend((st, str(n), *values) for st, *values in zip(sample_times, *channels))
+            lap_time = time[-1]
+            messages.append((t + lap_time + delay, "TimingData", {"Lines" : {str(n) : {"LastLapTime" : {"Value" : f"{int(lap_time // 60)}:{lap_time % 60:06.3f}"}}}}))
+            t += lap_time + 30 * (k % 2 == 0)
+
+    samples = pd.DataFrame(samples, columns=["Time", "Driver", "Speed", "Throttle", "X", "Y"])
+    for second, batch in samples.groupby(np.ceil(samples["Time"])):
+        entries = [(time, group) for time, group in batch.groupby("Time")]
+        messages.append((second + delay, "CarData.z", compress({"Entries" : [
+            {"Utc" : utc(time), "Cars" : {row.Driver : {"Channels" : {"2" : round(row.Speed), "4" : row.Throttle}} for row in group.itertuples()}}
+            for time, group in entries
+        ]})))
+        messages.append((second + delay, "Position.z", compress({"Position" : [
+            {"Timestamp" : utc(time), "Entries" : {row.Driver : {"X" : round(row.X), "Y" : round(row.Y)} for row in group.itertuples()}}
+            for time, group in entries
+        ]})))
+
+    with open(path, "w") as f:
+        for published, category, message in sorted(messages, key=lambda m: m[0]):
+            f.write(str([category, message, utc(published)]) + "\n")
+    return truth
+
+def check_live_replay(delay : float = 3.0, max_error : float = 2.0) -> bool:
+    "The best laps cut out of a recording whose messages are published with a delay must match the synthetic laps (mean speed error in km/h)"
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "recording.txt")
+        truth = synthetic_recording(path, delay)
+        with contextlib.redirect_stdout(io.StringIO()):
+            state = replay(path, pace = 0, plot = False)
+
+    errors = []
+    for trace in state.best_laps.values():
+        # The best lap of a driver is the one whose lap time matches (to the published millisecond)
+        time, speed = min((truth[key] for key in truth if key[0] == trace["Driver"]), key=lambda lap: abs(lap[0][-1] - trace["LapTime"].total_seconds()))
+        errors.append(np.mean(np.abs(trace.speed - np.interp(trace.time, time, speed))))
+    return len(errors) > 0 and max(errors) < max_error
+
+CHECKS = {
+    "resample_laps" : check_resample_laps,
+    "find_corners" : check_find_corners,
+    "corner_totals" : check_corner_totals,
+    "live_replay" : check_live_replay,
+}
+
+def run_checks() -> bool:
+    "Runs the offline consistency checks on synthetic telemetry, printing their outcome"
+    passed = True
+    for name, check in CHECKS.items():
+        ok = check()
+        print(f"{name}: {'ok' if ok else 'FAILED'}")
+        passed &= ok
+    return passed
+
+def git_version() -> str:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def print_results(run : Dict):
+    table = pd.DataFrame(run["Results"]).set_index(["Stage", "Scale"])
+    print(f"Version {run['Version']} ({run['Timestamp']}, {run['Seasons']} seasons)")
+    print(table[["BestSeconds", "MeanSeconds", "PeakMemoryKB"]].round(4).to_string())
+
+def compare_runs(old_path : str, new_path : str) -> pd.DataFrame:
+    "Ratio of the best times and peak memory of two benchmark runs (new / old), stage by stage"
+    runs = []
+    for path in (old_path, new_path):
+        with open(path) as f:
+            runs.append(pd.DataFrame(json.load(f)["Results"]).set_index(["Stage", "Scale"]))
+    old, new = runs
+    return pd.DataFrame({
+        "OldSeconds" : old["BestSeconds"],
+        "NewSeconds" : new["BestSeconds"],
+        "TimeRatio" : new["BestSeconds"] / old["BestSeconds"],
+        "MemoryRatio" : new["PeakMemoryKB"] / old["PeakMemoryKB"],
+    }).dropna()
+
+if __name__ == "__main__":
+    warnings.filterwarnings("ignore")
+    if len(argv) in (1, 2, 3) and (len(argv) == 1 or argv[1] == "run"):
+        run = run_benchmarks(int(argv[2]) if len(argv) == 3 else 3)
+        print_results(run)
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{run['Timestamp'].replace(':', '-')}_{run['Version']}.json")
+        with open(path, "w") as f:
+            json.dump(run, f, indent=4)
+        print(f"Results written to {path}")
+    elif len(argv) == 2 and argv[1] == "check":
+        exit(0 if run_checks() else 1)
+    elif len(argv) == 4 and argv[1] == "compare":
+        print(compare_runs(argv[2], argv[3]).round(3).to_string())
+    else:
+        print("Usage:")
+        print(f"  {argv[0]} run [seasons]     | benchmarks every stage on synthetic data and writes the results to '{RESULTS_DIR}'")
+        print(f"  {argv[0]} compare old new   | compares two result files")
+        print(f"  {argv[0]} check             | runs the consistency checks on synthetic data")
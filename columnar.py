@@ -0,0 +1,200 @@
+import os
+import struct
+import tempfile
+import zipfile
+from sys import argv
+from time import perf_counter
+from typing import Dict, List, Optional
+import numpy as np
+import pandas as pd
+from data import CORNER_TYPES
+
+# Table files are read and written according to their extension:
+#   .json            pandas JSON, the original format (text, dtypes inferred on read)
+#   .npz             uncompressed numpy archive, one array per column. Text columns (Team, GPName, CornerType...)
+#                    are stored as categorical codes + categories, numeric columns are memory-mapped on read
+#   .parquet/.feather  pandas columnar formats (require pyarrow)
+
+COLUMNS_KEY    = "__columns__"
+INDEX_KEY      = "__index__"
+CODES_PREFIX      = "codes:"
+CATEGORIES_PREFIX = "categories:"
+VALUES_PREFIX     = "values:"
+
+def _extension(path : str) -> str:
+    return os.path.splitext(path)[1].lower()
+
+def write_table(data : pd.DataFrame, path : str):
+    "Writes a table in the format given by the extension of the path"
+    extension = _extension(path)
+    if extension == ".json":
+        data.to_json(path)
+    elif extension == ".npz":
+        write_npz(data, path)
+    elif extension == ".parquet":
+        data.to_parquet(path)
+    elif extension == ".feather":
+        data.reset_index().to_feather(path)
+    else:
+        raise ValueError(f"Unsupported table format '{extension}'")
+
+def read_table(path : str, columns : Optional[List[str]] = None) -> pd.DataFrame:
+    "Reads a table in the format given by the extension of the path, optionally loading only some of its columns"
+    extension = _extension(path)
+    if extension == ".json":
+        data = pd.read_json(path)
+        return data if columns is None else data[columns]
+    elif extension == ".npz":
+        return read_npz(path, columns)
+    elif extension == ".parquet":
+        return pd.read_parquet(path, columns=columns)
+    elif extension == ".feather":
+        data = pd.read_feather(path, columns=None if columns is None else ["index"] + columns)
+        return data.set_index("index").rename_axis(None)
+    else:
+        raise ValueError(f"Unsupported table format '{extension}'")
+
+def _to_text(values) -> np.ndarray:
+    return np.array([str(v) for v in values], dtype=str)
+
+def write_npz(data : pd.DataFrame, path : str):
+    "Writes a table as an uncompressed numpy archive, with text columns stored as categorical codes"
+    arrays = {
+        COLUMNS_KEY : _to_text(data.columns),
+        INDEX_KEY   : _to_text(data.index) if data.index.dtype == object else data.index.to_numpy(),
+    }
+    for column in data.columns:
+        values = data[column]
+        if values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype):
+            categorical = pd.Categorical(values)
+            arrays[CODES_PREFIX + column]      = categorical.codes
+            arrays[CATEGORIES_PREFIX + column] = _to_text(categorical.categories)
+        else:
+            arrays[VALUES_PREFIX + column] = values.to_numpy()
+
+    np.savez(path, **arrays)
+
+def load_npz_member(path : str, archive : zipfile.ZipFile, name : str, mmap : bool) -> np.ndarray:
+    "Loads an array of a numpy archive, memory-mapping it straight from the archive file if it is stored uncompressed"
+    info = archive.getinfo(name + ".npy")
+    if not mmap or info.compress_type != zipfile.ZIP_STORED:
+        with archive.open(info) as f:
+            return np.lib.format.read_array(f)
+
+    with open(path, "rb") as f:
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+        name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    if dtype.hasobject or int(np.prod(shape)) == 0:
+        with archive.open(info) as f:
+            return np.lib.format.read_array(f)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape, order="F" if fortran_order else "C")
+
+def read_npz_columns(path : str, columns : Optional[List[str]] = None, mmap : bool = True) -> Dict[str, np.ndarray]:
+    """Reads columns of a numpy archive table as raw arrays, without going through pandas
+
+    Args:
+        path (str): Path of the .npz file
+        columns (Optional[List[str]], optional): Columns to load. Defaults to every column.
+        mmap (bool, optional): Memory-map the numeric columns instead of reading them. Defaults to True.
+
+    Returns:
+        Dict[str, np.ndarray]: Numeric columns as (memory-mapped) arrays, text columns as pandas Categoricals
+    """
+    res = {}
+    with zipfile.ZipFile(path) as archive:
+        members = {name[:-len(".npy")] for name in archive.namelist()}
+        all_columns = [str(column) for column in load_npz_member(path, archive, COLUMNS_KEY, False)]
+        for column in all_columns if columns is None else columns:
+            if column not in all_columns:
+                raise KeyError(f"Column '{column}' not in {path}")
+            if VALUES_PREFIX + column in members:
+                res[column] = load_npz_member(path, archive, VALUES_PREFIX + column, mmap)
+            else:
+                codes      = load_npz_member(path, archive, CODES_PREFIX + column, mmap)
+                categories = load_npz_member(path, archive, CATEGORIES_PREFIX + column, False)
+                res[column] = pd.Categorical.from_codes(codes, categories=categories.astype(object))
+    return res
+
+def read_npz(path : str, columns : Optional[List[str]] = None, mmap : bool = True) -> pd.DataFrame:
+    "Reads a numpy archive table as a DataFrame, text columns being categoricals"
+    arrays = read_npz_columns(path, columns, mmap)
+    with zipfile.ZipFile(path) as archive:
+        index = load_npz_member(path, archive, INDEX_KEY, False)
+    index = index.astype(object) if index.dtype.kind == "U" else index
+
+    return pd.DataFrame(arrays, index=index, copy=False)
+
+def convert_table(source : str, destination : str):
+    "Converts a table between two formats (e.g. to export a .npz file as JSON)"
+    data = read_table(source)
+    for column in data.columns:
+        if isinstance(data[column].dtype, pd.CategoricalDtype):
+            data[column] = data[column].astype(object)
+    write_table(data, destination)
+
+def synthetic_cornering_data(n_seasons : int, n_rounds : int = 22, n_teams : int = 10, seed : int = 0) -> pd.DataFrame:
+    "Generates a table shaped like cornering_data.json, spanning several seasons"
+    rng = np.random.default_rng(seed)
+    n = n_seasons * n_rounds * n_teams * len(CORNER_TYPES)
+    session = np.repeat(np.arange(n_seasons * n_rounds), n_teams * len(CORNER_TYPES))
+    distance = rng.uniform(200, 3000, n)
+    time = distance / rng.uniform(20, 90, n)
+    return pd.DataFrame({
+        "Distance" : distance,
+        "Time" : time,
+        "Speed" : distance / time,
+        "CornerType" : np.tile(CORNER_TYPES, n // len(CORNER_TYPES)).astype(object),
+        "Team" : np.tile(np.repeat([f"Team {i}" for i in range(n_teams)], len(CORNER_TYPES)), n_seasons * n_rounds).astype(object),
+        "GPName" : np.array([f" Grand Prix {s % n_rounds + 1}" for s in session], dtype=object),
+        "SessionNumber" : session % n_rounds + 1,
+    })
+
+def benchmark(n_seasons : int = 20, repeats : int = 3):
+    "Times writing and reading a synthetic multi-season cornering dataset in every available format"
+    data = synthetic_cornering_data(n_seasons)
+    print(f"{len(data)} rows ({n_seasons} seasons)")
+
+    formats = [".json", ".npz"]
+    for extension, module in ((".parquet", "pyarrow"), (".feather", "pyarrow")):
+        try:
+            __import__(module)
+            formats.append(extension)
+        except ImportError:
+            print(f"Skipping {extension} ({module} is not installed)")
+
+    def best_of(f) -> float:
+        timings = []
+        for _ in range(repeats):
+            start = perf_counter()
+            f()
+            timings.append(perf_counter() - start)
+        return min(timings)
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'Format':<10}{'Size (KB)':>12}{'Write (ms)':>12}{'Read (ms)':>12}{'Read 2 cols (ms)':>18}")
+        for extension in formats:
+            path = os.path.join(directory, "cornering_data" + extension)
+            write = best_of(lambda: write_table(data, path))
+            read = best_of(lambda: read_table(path))
+            read_columns = best_of(lambda: read_table(path, ["Time", "Team"]))
+            size = os.path.getsize(path) / 1024
+            print(f"{extension:<10}{size:>12.0f}{write * 1000:>12.1f}{read * 1000:>12.1f}{read_columns * 1000:>18.1f}")
+
+if __name__ == "__main__":
+    if len(argv) == 4 and argv[1] == "convert":
+        convert_table(argv[2], argv[3])
+    elif len(argv) in (2, 3) and argv[1] == "bench":
+        benchmark(int(argv[2]) if len(argv) == 3 else 20)
+    else:
+        print("Usage:")
+        print(f"  {argv[0]} convert source destination | converts a table between formats (.json, .npz, .parquet, .feather)")
+        print(f"  {argv[0]} bench [seasons]            | read/write benchmark on a synthetic multi-season dataset")
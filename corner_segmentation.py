@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+from sys import argv
+from time import perf_counter
+from typing import Dict, List, Optional, Tuple
+from data import CORNER_LABELS, CORNER_TYPES
+from gen_data import FULL_THROTTLE, SPEED_BANDS, compile_corner_labels, label_distances
+from lap_trace import lap_trace
+from season_index import iter_quali_sessions
+from telemetry_archive import ARCHIVE_DIR
+
+# Corners are found on the speed trace of a reference lap (usually the fastest lap of the session):
+#   - apexes are the local minima of the (smoothed) speed trace, at least MIN_SPEED_DROP below the peaks around them
+#   - the peak speed between two apexes splits their corners, so windows never overlap
+#   - if the driver lifted anywhere between these peaks, the corner goes from the braking point (last full throttle
+#     sample before the lift) to the throttle application point (first full throttle sample after it)
+#   - if the corner is taken flat out, it spans the speed dip around the apex (ENTRY_MARGIN above the apex speed)
+#   - the corner class is given by the minimum raw (unsmoothed) speed of its window: Low <100, Medium-Low 100-150,
+#     Medium-High 150-200, High >200 km/h. Smoothing only serves to find the apexes, it lifts the minimum of
+#     V-shaped slow corners by 20 km/h or more
+
+GRID_STEP = 5              # m
+SMOOTHING = 25             # m
+APEX_WINDOW = 150          # m, an apex is the slowest point within this distance on both sides
+MIN_SPEED_DROP = 8         # km/h
+ENTRY_MARGIN = 8           # km/h
+MIN_CORNER_LENGTH = 40     # m
+
+def _segment_argmax(values : np.ndarray, starts : np.ndarray, ends : np.ndarray) -> np.ndarray:
+    "Index of the maximum of values[starts[k]:ends[k]] for every k (segments must be non-empty and sorted)"
+    lengths = ends - starts
+    segment = np.repeat(np.arange(len(starts)), lengths)
+    indexes = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)]) if len(starts) > 0 else np.empty(0, dtype=int)
+    order = np.lexsort((-values[indexes], segment))
+    first = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    return indexes[order[first]]
+
+def find_corners(distance : np.ndarray, speed : np.ndarray, throttle : np.ndarray) -> List[Tuple[str, int, int]]:
+    """Derives corner windows and their class from the speed and throttle traces of a lap
+
+    Args:
+        distance (np.ndarray): Distance of every sample, in meters
+        speed (np.ndarray): Speed of every sample, in km/h
+        throttle (np.ndarray): Throttle of every sample, in %
+
+    Returns:
+        List[Tuple[str, int, int]]: (type, start, finish) corner windows, in the same format as data.CORNER_LABELS
+    """
+    distance = np.asarray(distance, dtype=float)
+    order = np.argsort(distance, kind="stable")
+    grid = np.arange(distance[order][0], distance[order][-1], GRID_STEP)
+    if len(grid) < 3:
+        return []
+    raw_speed = np.interp(grid, distance[order], np.asarray(speed, dtype=float)[order])
+    throttle = np.interp(grid, distance[order], np.asarray(throttle, dtype=float)[order])
+
+    width = max(1, SMOOTHING // GRID_STEP)
+    speed = np.convolve(np.pad(raw_speed, width, mode="edge"), np.ones(2 * width + 1) / (2 * width + 1), mode="valid")
+
+    # Apexes: slowest sample of their neighbourhood, clearly below the fastest samples around them
+    half = max(1, APEX_WINDOW // GRID_STEP)
+    windows = np.lib.stride_tricks.sliding_window_view(np.pad(speed, half, mode="edge"), 2 * half + 1)
+    before_peak = windows[:, :half + 1].max(axis=1)
+    after_peak  = windows[:, half:].max(axis=1)
+    is_apex = (speed == windows.min(axis=1)) & (before_peak - speed >= MIN_SPEED_DROP) & (after_peak - speed >= MIN_SPEED_DROP)
+    is_apex[1:] &= speed[1:] < speed[:-1]  # only the first sample of a flat minimum
+    is_apex[[0, -1]] = False
+    apexes = np.flatnonzero(is_apex)
+    if len(apexes) == 0:
+        return []
+
+    # Peaks: fastest sample between two consecutive apexes (or between an apex and the start/end of the lap)
+    edges = np.concatenate([[0], apexes + 1])
+    peaks = _segment_argmax(speed, edges, np.concatenate([apexes, [len(grid)]]))
+
+    # Lift of every corner: first and last sample below full throttle between its peaks (the throttle can be back
+    # to full at the apex already, so a single sample there doesn't tell whether the driver lifted)
+    index = np.arange(len(grid))
+    lift = throttle < FULL_THROTTLE
+    next_lift = np.minimum.accumulate(np.where(lift, index, len(grid))[::-1])[::-1]
+    last_lift = np.maximum.accumulate(np.where(lift, index, -1))
+    first_lifted, last_lifted = next_lift[peaks[:-1]], last_lift[peaks[1:]]
+    lifted = first_lifted <= peaks[1:]
+
+    apex_speed = speed[apexes]
+    # Last sample before each apex (and first one after it) where the car is ENTRY_MARGIN faster than at the apex
+    entry_segments = np.searchsorted(apexes, index, side="left").clip(max=len(apexes) - 1)
+    exit_segments  = (np.searchsorted(apexes, index, side="right") - 1).clip(min=0)
+    entry_fast = speed >= apex_speed[entry_segments] + ENTRY_MARGIN
+    exit_fast  = speed >= apex_speed[exit_segments]  + ENTRY_MARGIN
+    entry = np.maximum.accumulate(np.where(entry_fast, index, 0))[apexes]
+    exit  = np.minimum.accumulate(np.where(exit_fast, index, len(grid) - 1)[::-1])[::-1][apexes]
+
+    starts   = np.where(lifted, first_lifted - 1, entry)
+    finishes = np.where(lifted, last_lifted + 1, exit)
+    starts   = np.maximum(starts, peaks[:-1])
+    finishes = np.minimum(finishes, peaks[1:])
+
+    types = np.digitize(raw_speed[_segment_argmax(-raw_speed, starts, finishes + 1)], SPEED_BANDS)
+    keep = grid[finishes] - grid[starts] >= MIN_CORNER_LENGTH
+
+    return [
+        (CORNER_TYPES[t], int(round(grid[start])), int(round(grid[finish])))
+        for t, start, finish in zip(types[keep], starts[keep], finishes[keep])
+    ]
+
+def find_lap_corners(lap) -> List[Tuple[str, int, int]]:
+    "Derives the corner windows of a lap (fastf1, archived or LapTrace) from its telemetry"
+    trace = lap_trace(lap)
+    return find_corners(trace.distance, trace.speed, trace.throttle)
+
+def compare_labels(auto_labels : List[Tuple[str, float, float]], hand_labels : List[Tuple[str, float, float]], lap_length : Optional[float] = None) -> Dict[str, float]:
+    """Compares automatic corner labels with hand-made ones
+
+    Args:
+        auto_labels (List[Tuple[str, float, float]]): Automatic (type, start, finish) corner windows
+        hand_labels (List[Tuple[str, float, float]]): Hand-made (type, start, finish) corner windows
+        lap_length (Optional[float], optional): Length of the lap. Defaults to the end of the last window.
+
+    Returns:
+        Dict[str, float]: Share of the lap distance labelled with the same corner type ("Agreement"), share of
+            the hand-labelled corner distance covered by automatic corners of the same type ("CornerRecall"), and
+            the number of corners of each set
+    """
+    if lap_length is None:
+        lap_length = max([finish for _, _, finish in auto_labels + hand_labels], default=0) + GRID_STEP
+    grid = np.arange(GRID_STEP / 2, lap_length, GRID_STEP)
+    auto = label_distances(compile_corner_labels(auto_labels), grid)
+    hand = label_distances(compile_corner_labels(hand_labels), grid)
+    in_corner = hand != "STRAIGHT"
+
+    return {
+        "Agreement" : float(np.mean(auto == hand)),
+        "CornerRecall" : float(np.mean(auto[in_corner] == hand[in_corner])) if in_corner.any() else 1.0,
+        "AutoCorners" : len(auto_labels),
+        "HandCorners" : len(hand_labels),
+    }
+
+def segment_season(year : int, archive_dir : Optional[str] = None) -> Dict[str, List[Tuple[str, int, int]]]:
+    "Derives the corner labels of every dry qualifying session of a season from its fastest lap"
+    res = {}
+    for session in iter_quali_sessions(year, archive_dir = archive_dir):
+        res[str(session)] = find_lap_corners(session.laps.pick_fastest())
+    return res
+
+if __name__ == "__main__":
+    if len(argv) in (2, 3):
+        start = perf_counter()
+        labels = segment_season(int(argv[1]), ARCHIVE_DIR if len(argv) == 3 and argv[2] == "archive" else None)
+        print(f"Segmented {len(labels)} sessions in {perf_counter() - start:.2f}s\n")
+
+        comparison = {
+            session : compare_labels(session_labels, CORNER_LABELS[session])
+            for session, session_labels in labels.items() if session in CORNER_LABELS
+        }
+        print(pd.DataFrame(comparison).T)
+        print()
+        for session, session_labels in labels.items():
+            print(f"    '{session}' : [")
+            for label in session_labels:
+                print(f"        {label},")
+            print("    ],")
+    else:
+        print("Usage:")
+        print(f"  {argv[0]} year ['archive'] | labels the corners of every dry qualifying session of a season and compares them with CORNER_LABELS")
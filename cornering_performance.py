@@ -1,16 +1,39 @@
 import pandas as pd
+import numpy as np
 import fastf1 as ff1
-from typing import List
+from typing import List, Optional, Tuple
 from matplotlib import pyplot as plt
+from matplotlib.animation import FuncAnimation
 import matplotlib
 from fastf1 import plotting
 from data import CORNER_TYPES
+from columnar import read_table, write_table
+from season_cube import SeasonCube, build_season_cube, relative_speeds, rolling_speed_deltas, window_speed_matrix, window_title
+from sys import argv
 
 BAD_DATA = [
    (' United States Grand Prix', "Aston Martin", "MEDIUM-HIGH"),
    (' Las Vegas Grand Prix', "McLaren")
 ]
 
+def speed_matrix(data : pd.DataFrame) -> pd.DataFrame:
+    """Computes the average speed of every team on every corner type
+
+    Args:
+        data (pd.DataFrame): Cornering performance data (Distance, Time, Team and CornerType columns)
+
+    Returns:
+        pd.DataFrame: (team x corner type) speed matrix, with the corner types ordered as in CORNER_TYPES
+    """
+    totals = data.groupby(["Team", "CornerType"], observed = True)[["Distance", "Time"]].sum()
+    speeds = (totals["Distance"] / totals["Time"]).unstack("CornerType")
+    return speeds.reindex(columns = CORNER_TYPES)
+
+def relative_speed_matrix(data : pd.DataFrame) -> pd.DataFrame:
+    "Speed of every team on every corner type, as a ratio of the average speed of the teams on that corner type"
+    speeds = speed_matrix(data)
+    return speeds / speeds.mean()
+
 def plot_performance(data : pd.DataFrame, ax : matplotlib.axis.Axis, title : str, ylabel : bool = False):
     """Plots a breakdown of the performance of the car by corner types, as a parallel coordinates plot
 
@@ -20,34 +43,51 @@ def plot_performance(data : pd.DataFrame, ax : matplotlib.axis.Axis, title : str
         title (str): Title of the plot
         ylabel (bool, optional): Decide whether to show the y label. Defaults to False.
     """
+    plot_speed_deltas((relative_speed_matrix(data) - 1) * 100, ax, title, ylabel)
+
+def plot_speed_deltas(deltas : pd.DataFrame, ax : matplotlib.axis.Axis, title : str, ylabel : bool = False):
+    "Draws the plot_performance view of a (team x corner type) matrix of speed deltas to the average, in %"
     for i in range(5):
         ax.axvline(x = i, color = 'grey', linestyle = '-')
 
-    df = data.groupby(["Team", "CornerType"]).sum(numeric_only = True)
-    df = df.drop(columns=["SessionNumber"])
-    df["Speed"] = df["Distance"] / df["Time"]
-    df = df.reset_index()
-    teams = set(df["Team"])
-
-    for team in teams:
+    for team, speeds in deltas.iterrows():
         if team == 'Haas F1 Team':
             team_color = "black"
         else:
             team_color = ff1.plotting.team_color(team)
-        speeds = []
-
-        for ct in CORNER_TYPES:
-            speed = float(df[df["Team"] == team][df["CornerType"] == ct]["Speed"])
-            average = df[df["CornerType"] == ct]["Speed"].mean()
-            speeds.append((speed - average) * 100 / average)
 
-        ax.plot([0, 1, 2, 3, 4], speeds, color = team_color, linewidth = 3)
+        ax.plot([0, 1, 2, 3, 4], speeds.to_numpy(), color = team_color, linewidth = 3)
     ax.set_title(title)
     ax.set_xticks([0, 1, 2, 3, 4])
     ax.set_xticklabels(CORNER_TYPES,rotation = 25, ha='right')
     if ylabel:
         ax.set(ylabel = "Car speed as a percentage delta from the average")
 
+def plot_window(cube : SeasonCube, ax : matplotlib.axis.Axis, first : Optional[int] = None, last : Optional[int] = None, ylabel : bool = False, title : Optional[str] = None):
+    "Plots the performance breakdown of the sessions numbered first to last (inclusive, open-ended if None), from the season cube. The title defaults to the GP range of the window"
+    speeds = window_speed_matrix(cube, first, last)
+    deltas = pd.DataFrame((relative_speeds(speeds.to_numpy()) - 1) * 100, index = speeds.index, columns = speeds.columns)
+    plot_speed_deltas(deltas, ax, window_title(cube, first, last) if title is None else title, ylabel)
+
+def animate_rolling_windows(cube : SeasonCube, n : int, interval : int = 800) -> Tuple[plt.Figure, FuncAnimation]:
+    "Animates the performance breakdown over every window of n consecutive sessions of the season"
+    titles, deltas = rolling_speed_deltas(cube, n)
+    fig, ax = plt.subplots(figsize=(8, 8))
+    limit = np.nanmax(np.abs(deltas)) if np.isfinite(deltas).any() else 1
+
+    def draw(i : int):
+        ax.clear()
+        present = ~np.isnan(deltas[i]).all(axis=1)
+        plot_speed_deltas(pd.DataFrame(deltas[i][present], index = cube.teams[present], columns = CORNER_TYPES), ax, f"{titles[i]} ({n} rounds)", ylabel = True)
+        ax.set_ylim(-limit * 1.05, limit * 1.05)
+
+    return fig, FuncAnimation(fig, draw, frames = len(titles), interval = interval)
+
+def parse_window(text : str) -> Tuple[Optional[int], Optional[int]]:
+    "Parses a first-last window of session numbers ('9-14', '15-' or '-8')"
+    first, _, last = text.partition("-")
+    return (int(first) if first else None, int(last) if last else None)
+
 def project_pecking_order(data : pd.DataFrame, track_corners : List[float]):
     """Prints a projected pecking order based on past cornering performance data and a set of track characteristics
 
@@ -60,84 +100,140 @@ def project_pecking_order(data : pd.DataFrame, track_corners : List[float]):
             - time spent on high-speed corners
             - time spent on straights
     """
-    df = data.groupby(["Team", "CornerType"]).sum(numeric_only = True)
-    df = df.drop(columns=["SessionNumber"])
-    df["Speed"] = df["Distance"] / df["Time"]
-    df = df.reset_index()
-    teams = set(df["Team"])
-    speeds = {}
-    for team in teams:
-        speeds[team] = {}
-        for ct in CORNER_TYPES:
-            speed = float(df[df["Team"] == team][df["CornerType"] == ct]["Speed"])
-            average = df[df["CornerType"] == ct]["Speed"].mean()
-            speeds[team][ct] = speed/average
-    
-    speeds = pd.DataFrame(speeds).T
+    speeds = relative_speed_matrix(data)
     
     # Change the list values in the line below
-    low, medium_low, medium_high, high, straight = track_corners
-
-    speeds["LapTime"] = low  / speeds["LOW"]         +\
-                 medium_low  / speeds["MEDIUM-LOW"]  +\
-                 medium_high / speeds["MEDIUM-HIGH"] +\
-                 high        / speeds["HIGH"]        +\
-                 straight    / speeds["STRAIGHT"]
+    tracks = pd.DataFrame([track_corners], columns=CORNER_TYPES, index=["LapTime"])
+    speeds["LapTime"] = project_lap_times(data, tracks)["LapTime"]
     
     print(speeds.sort_values(by=["LapTime"]))
 
-if __name__ == "__main__":
-    data = pd.read_json("cornering_data.json")
+def project_lap_times(data : pd.DataFrame, tracks : pd.DataFrame) -> pd.DataFrame:
+    """Projects the lap time of every team on every track in a single matrix product
+
+    Args:
+        data (pd.DataFrame): Past cornering performance data
+        tracks (pd.DataFrame): (track x corner type) matrix of the time spent on each corner type, e.g. track_corners_db.json
+
+    Returns:
+        pd.DataFrame: (team x track) matrix of projected lap times
+    """
+    slowness = 1 / relative_speed_matrix(data)
+    times = tracks.reindex(columns = CORNER_TYPES)
+    return pd.DataFrame(slowness.to_numpy() @ times.to_numpy().T, index = slowness.index, columns = times.index)
+
+def project_pecking_orders(data : pd.DataFrame, tracks : pd.DataFrame) -> pd.DataFrame:
+    """Projects the pecking order of the teams on every track
+
+    Args:
+        data (pd.DataFrame): Past cornering performance data
+        tracks (pd.DataFrame): (track x corner type) matrix of the time spent on each corner type
+
+    Returns:
+        pd.DataFrame: Team-indexed frame with a (LapTime | Rank | Gap, track) column index, e.g. res["Rank"] is the
+            (team x track) matrix of ranks and res["Gap"] the gaps to the fastest team of each track. A team without a
+            lap time on a track (e.g. no data on one of its corner types) has no rank there (<NA>)
+    """
+    lap_times = project_lap_times(data, tracks)
+    return pd.concat({
+        "LapTime" : lap_times,
+        "Rank" : lap_times.rank(method = "min").astype("Int64"),
+        "Gap" : lap_times - lap_times.min(),
+    }, axis = 1)
+
+def pecking_order_table(projection : pd.DataFrame) -> pd.DataFrame:
+    """Flattens the output of project_pecking_orders into one (Track, Team, LapTime, Rank, Gap) row per team and track, sorted by track
+    and rank. Teams without a lap time on a track are left out of it"""
+    lap_times = projection["LapTime"]
+    table = pd.DataFrame({
+        "Track" : np.tile(lap_times.columns.to_numpy(), len(lap_times.index)),
+        "Team" : np.repeat(lap_times.index.to_numpy(), len(lap_times.columns)),
+        "LapTime" : lap_times.to_numpy().ravel(),
+        "Rank" : projection["Rank"].to_numpy(dtype = float, na_value = np.nan).ravel(),
+        "Gap" : projection["Gap"].to_numpy().ravel(),
+    }).dropna(subset = ["LapTime"]).astype({"Rank" : int})
+    return table.sort_values(by=["Track", "Rank"], kind = "stable").reset_index(drop = True)
+
+def replace_bad_data(data : pd.DataFrame, bad_data : List[tuple] = BAD_DATA) -> pd.DataFrame:
+    """Replaces bad cornering data with the average of the other teams in the same session
+
+    Args:
+        data (pd.DataFrame): Cornering performance data
+        bad_data (List[tuple], optional): Bad entries, either (GP name, team) for a whole session or
+            (GP name, team, corner type) for a single corner type. Defaults to BAD_DATA.
+
+    Returns:
+        pd.DataFrame: The data without the Speed column, the bad rows being replaced by averaged rows appended at the end
+            (bad entries of sessions that aren't in the data are ignored)
+    """
+    keys = []
+    for row in bad_data:
+        gp, team = row[:2]
+        for corner_type in (row[2:] if len(row) == 3 else CORNER_TYPES):
+            keys.append((gp, team, corner_type))
+    keys = pd.DataFrame(keys, columns=["GPName", "Team", "CornerType"])
 
     # First: delete the bad rows
-    for row in BAD_DATA:
-        if len(row) == 2:
-            gp, team = row
-            bad_data = data[data["GPName"] == gp][data["Team"] == team]
-        elif len(row) == 3:
-            gp, team, corner_type = row
-            bad_data = data[data["GPName"] == gp][data["Team"] == team][data["CornerType"] == corner_type]
-        data = data.drop(bad_data.index)
+    row_keys = pd.MultiIndex.from_frame(data[["GPName", "Team", "CornerType"]].astype(object))
+    data = data[~row_keys.isin(pd.MultiIndex.from_frame(keys))]
     data = data.drop(columns=['Speed'])
 
     # Second: replace the deleted rows with averaged values
-    for row in BAD_DATA:
-        if len(row) == 2:
-            gp, team = row
-            for corner_type in CORNER_TYPES:
-                cornering_data = data[data["GPName"] == gp][data["CornerType"] == corner_type]
-                mean_distance = cornering_data["Distance"].mean()
-                mean_time = cornering_data["Time"].mean()
-                session_number = int(cornering_data["SessionNumber"].median())
-                averaged_entry = {
-                    "Distance" : mean_distance,
-                    "Time" : mean_time,
-                    "CornerType" : corner_type,
-                    "Team" : team,
-                    "GPName" : gp,
-                    "SessionNumber" : session_number,
-                }
-                data = pd.concat([data, pd.DataFrame([averaged_entry])], ignore_index=True)
-        elif len(row) == 3:
-            gp, team, corner_type = row
-            cornering_data = data[data["GPName"] == gp][data["CornerType"] == corner_type]
-            mean_distance = cornering_data["Distance"].mean()
-            mean_time = cornering_data["Time"].mean()
-            session_number = int(cornering_data["SessionNumber"].median())
-            averaged_entry = {
-                "Distance" : mean_distance,
-                "Time" : mean_time,
-                "CornerType" : corner_type,
-                "Team" : team,
-                "GPName" : gp,
-                "SessionNumber" : session_number,
-            }
-            data = pd.concat([data, pd.DataFrame([averaged_entry])], ignore_index=True)
-
-    fig, axes = plt.subplots(1, 3, figsize=(12, 12))
-    plot_performance(data[data["SessionNumber"] <  9],                             axes[0], "Bahrain-Canada", ylabel=True)
-    plot_performance(data[data["SessionNumber"] >= 9][data["SessionNumber"] < 15], axes[1], "Austria-Italy")
-    plot_performance(data[data["SessionNumber"] >=15],                             axes[2], "Singapore onwards")
+    averages = data.groupby(["GPName", "CornerType"], observed = True).agg(
+        Distance = ("Distance", "mean"),
+        Time = ("Time", "mean"),
+        SessionNumber = ("SessionNumber", "median"),
+    ).reset_index()
+    averaged_entries = keys.merge(averages.astype({"GPName" : object, "CornerType" : object}), on=["GPName", "CornerType"], how="inner")
+    averaged_entries["SessionNumber"] = averaged_entries["SessionNumber"].astype(int)
+    averaged_entries = averaged_entries[["Distance", "Time", "CornerType", "Team", "GPName", "SessionNumber"]]
+
+    return pd.concat([data, averaged_entries], ignore_index=True)
+
+if __name__ == "__main__":
+    if len(argv) >= 2 and argv[1] == "project":
+        if len(argv) > 5:
+            print("Usage:")
+            print(f"  {argv[0]} project [cornering data] [track corners db] [output]")
+            exit()
+        paths = argv[2:] + ["cornering_data.json", "track_corners_db.json"][len(argv) - 2:]
+        data = replace_bad_data(read_table(paths[0]))
+        projection = project_pecking_orders(data, read_table(paths[1]))
+
+        pecking_orders = pecking_order_table(projection)
+        if len(paths) == 3:
+            write_table(pecking_orders, paths[2])
+        else:
+            pd.set_option("display.max_rows", None)
+            print(pecking_orders)
+        exit()
+
+    if len(argv) >= 3 and argv[1] == "rolling" and argv[2].isdigit():
+        if len(argv) > 5:
+            print("Usage:")
+            print(f"  {argv[0]} rolling n [cornering data] [output.gif]")
+            exit()
+        cube = build_season_cube(replace_bad_data(read_table(argv[3] if len(argv) >= 4 else "cornering_data.json")))
+        fig, animation = animate_rolling_windows(cube, int(argv[2]))
+        if len(argv) == 5:
+            animation.save(argv[4])
+        else:
+            plt.show()
+        exit()
+
+    if len(argv) >= 2 and argv[1] == "windows":
+        windows = [arg for arg in argv[2:] if "-" in arg and arg.replace("-", "").isdigit()]
+        paths = [arg for arg in argv[2:] if arg not in windows]
+        titles = [None] * len(windows)
+    else:
+        windows = ["-8", "9-14", "15-"]
+        titles = ["Bahrain-Canada", "Austria-Italy", "Singapore onwards"]
+        paths = argv[1:2]
+    cube = build_season_cube(replace_bad_data(read_table(paths[0] if paths else "cornering_data.json")))
+
+    fig, axes = plt.subplots(1, len(windows), figsize=(4 * len(windows), 12), squeeze=False)
+    for i, (window, title) in enumerate(zip(windows, titles)):
+        plot_window(cube, axes[0][i], *parse_window(window), ylabel = i == 0, title = title)
 
     fig.suptitle('F1 CAR PERFORMANCE BREAKDOWN\nLow: <100km/h | Medium-low: 100-150km/h\nMedium-high: 150-200km/h | High: >200km/h', fontsize=16)
-    plt.show()
\ No newline at end of file
+    plt.show()
@@ -1,8 +1,17 @@
 import fastf1 as ff1
 import pandas as pd
 import numpy as np
-from data import CORNER_LABELS
-from typing import Set, Dict
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sys import argv
+from data import CORNER_LABELS, CORNER_TYPES
+from columnar import write_table
+from lap_trace import LapTrace, lap_trace
+from instrumentation import collect_stages, merge_stages, report, stage
+from result_cache import ResultCache, corner_labels_hash
+from telemetry_archive import ARCHIVE_DIR, ArchivedSession
+from season_index import WET_COMPOUNDS, iter_quali_rounds, load_quali_session
+from typing import Callable, Set, Dict, List, NamedTuple, Optional, Tuple
 
 # Straight-line: Full throttle
 # High:       >200kph
@@ -12,121 +21,499 @@ from typing import Set, Dict
 
 ff1.Cache.enable_cache('cache')
 
+PERFORMANCE_CHANNELS = ["Distance", "Time", "Speed"]
+STRAIGHT_CODE = CORNER_TYPES.index("STRAIGHT")
+
+def corner_type_codes(corner_types) -> np.ndarray:
+    "Converts an array of corner type names into their index in CORNER_TYPES."
+    codes = pd.Categorical(corner_types, categories=CORNER_TYPES).codes
+    if (codes < 0).any():
+        unknown = set(np.asarray(corner_types, dtype=object)[codes < 0])
+        raise KeyError(f"Unknown corner types: {unknown}")
+    return codes.astype(np.int64)
+
+def _lap_arrays(lap : ff1.core.Lap) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    "Corner type codes, distance and time (in seconds) of a labelled lap (or LapTrace), as numpy arrays."
+    if isinstance(lap, LapTrace):
+        return lap.corner_codes().astype(np.int64), lap.distance, lap.time
+    telemetry = lap.telemetry
+    return (
+        corner_type_codes(telemetry["CornerType"]),
+        telemetry["Distance"].to_numpy(dtype=float),
+        (telemetry["Time"] / np.timedelta64(1, 's')).to_numpy(dtype=float),
+    )
+
+def segment_totals(lap_ids : np.ndarray, codes : np.ndarray, distance : np.ndarray, time : np.ndarray, n_laps : int) -> np.ndarray:
+    """Reduces concatenated lap samples into the distance and time spent on each corner type.
+
+    Every lap starts with an implicit straight segment at (0m, 0s). A new segment begins on the last sample
+    before each corner type change and the lap is closed by its final sample, so the distance and time
+    between two consecutive segment boundaries are credited to the corner type of the first boundary.
+
+    Args:
+        lap_ids (np.ndarray): Lap index of every sample, grouped by lap (non-decreasing)
+        codes (np.ndarray): Corner type code (index in CORNER_TYPES) of every sample
+        distance (np.ndarray): Distance of every sample, in meters
+        time (np.ndarray): Time of every sample, in seconds
+        n_laps (int): Number of laps
+
+    Returns:
+        np.ndarray: (n_laps, len(CORNER_TYPES), 2) array with the distance and time spent on each corner type
+    """
+    res = np.zeros((n_laps, len(CORNER_TYPES), 2))
+    if len(codes) == 0:
+        return res
+
+    same_lap = lap_ids[1:] == lap_ids[:-1]
+    is_change = np.append((codes[1:] != codes[:-1]) & same_lap, False)
+    is_last   = np.append(~same_lap, True)
+
+    boundaries = np.flatnonzero(is_change | is_last)
+    boundary_laps = lap_ids[boundaries]
+    # Transitions take the type of the upcoming sample, lap ends keep their own
+    boundary_codes = np.where(is_change[boundaries], codes[np.minimum(boundaries + 1, len(codes) - 1)], codes[boundaries])
+
+    first_of_lap = np.ones(len(boundaries), dtype=bool)
+    first_of_lap[1:] = boundary_laps[1:] != boundary_laps[:-1]
+
+    segment_codes = np.empty_like(boundary_codes)
+    segment_codes[1:] = boundary_codes[:-1]
+    segment_codes[first_of_lap] = STRAIGHT_CODE
+    bins = boundary_laps * len(CORNER_TYPES) + segment_codes
+
+    for channel, values in enumerate((distance, time)):
+        points = values[boundaries]
+        previous = np.empty_like(points)
+        previous[1:] = points[:-1]
+        previous[first_of_lap] = 0
+        res[:, :, channel] = np.bincount(bins, weights=points - previous, minlength=n_laps * len(CORNER_TYPES)).reshape(n_laps, -1)
+
+    return res
+
+def _with_speed(totals : np.ndarray) -> np.ndarray:
+    "Appends the average speed to an array of distance/time totals."
+    distance, time = totals[..., 0], totals[..., 1]
+    speed = np.divide(distance, time, out=np.zeros_like(distance), where=time > 0)
+    return np.concatenate([totals, speed[..., np.newaxis]], axis=-1)
+
 def corner_type_performance(lap : ff1.core.Lap) -> Dict[str, Dict[str, float]]:
     "Outputs the time, distance and speed spent on each type of corner for any given labelled lap."
-    segments = [
-        ("STRAIGHT", 0, 0)
-    ]
-
-    for i0 in range(len(lap.telemetry) - 1):
-        i1 = i0 + 1
-
-        row0 = lap.telemetry.iloc[i0]
-        row1 = lap.telemetry.iloc[i1]
-
-        if row0["CornerType"] != row1["CornerType"]:
-            segments.append(
-                (row1["CornerType"], row0["Distance"], row0["Time"] / np.timedelta64(1, 's'))
-            )
-    
-    last_row = lap.telemetry.iloc[-1]
-    segments.append(
-        (last_row["CornerType"], last_row["Distance"], last_row["Time"] / np.timedelta64(1, 's'))
-    )
+    codes, distance, time = _lap_arrays(lap)
+    totals = _with_speed(segment_totals(np.zeros(len(codes), dtype=np.int64), codes, distance, time, 1))[0]
 
-    res = {
-        'STRAIGHT'    : {"Distance" : 0, "Time" : 0},
-        'LOW'         : {"Distance" : 0, "Time" : 0},
-        'MEDIUM-LOW'  : {"Distance" : 0, "Time" : 0},
-        'MEDIUM-HIGH' : {"Distance" : 0, "Time" : 0},
-        'HIGH'        : {"Distance" : 0, "Time" : 0},
-    }
-
-    for i in range(len(segments) - 1):
-        d = segments[i + 1][1] - segments[i][1]
-        t = segments[i + 1][2] - segments[i][2]
-        corner_type = segments[i][0]
-        
-        cd, ct = res[corner_type]["Distance"], res[corner_type]["Time"]
-        cd += d
-        ct += t
-
-        res[corner_type] = {"Distance" : cd, "Time" : ct}
-    
-    for key in res:
-        res[key]["Speed"] = res[key]["Distance"] / res[key]["Time"] if (res[key]["Time"] > 0) else 0
+    res = {}
+    for key in ('STRAIGHT', 'LOW', 'MEDIUM-LOW', 'MEDIUM-HIGH', 'HIGH'):
+        res[key] = dict(zip(PERFORMANCE_CHANNELS, totals[CORNER_TYPES.index(key)].tolist()))
 
     return res
 
-def get_team_fastest_laps(session : ff1.core.Session) -> ff1.core.Laps:
-    "Get the fastest lap (illegal or not) of every team in the session."
-    teams = pd.unique(session.laps['Team'])
-    list_fastest_laps = list()
-    for team in teams:
-        fastest_team_lap       = session.laps.pick_team(team).pick_fastest(only_by_time=True)
-        fastest_legal_team_lap = session.laps.pick_team(team).pick_fastest()
-        fastest_team_lap["LegalLapTime"] = fastest_legal_team_lap
-        list_fastest_laps.append(fastest_team_lap)
-
-    fastest_laps = ff1.core.Laps(list_fastest_laps, session = session).sort_values(by='LapTime').reset_index(drop=True)
+def corner_type_performance_batch(laps : List[ff1.core.Lap]) -> np.ndarray:
+    """Outputs the distance, time and speed spent on each type of corner for many labelled laps at once.
+
+    Args:
+        laps (List[ff1.core.Lap]): Labelled laps
+
+    Returns:
+        np.ndarray: (lap, corner type, channel) array, with corner types ordered as in CORNER_TYPES
+            and channels ordered as in PERFORMANCE_CHANNELS
+    """
+    arrays = [_lap_arrays(lap) for lap in laps]
+    lap_ids = np.repeat(np.arange(len(arrays)), [len(codes) for codes, _, _ in arrays])
+    codes, distance, time = (np.concatenate([a[i] for a in arrays]) if arrays else np.empty(0) for i in range(3))
+
+    return _with_speed(segment_totals(lap_ids, codes.astype(np.int64), distance, time, len(arrays)))
+
+def get_fastest_laps_by(session : ff1.core.Session, column : str) -> ff1.core.Laps:
+    """Get the fastest lap (illegal or not) of every group of laps (e.g. every team) in the session, in a single grouped pass.
+
+    The fastest lap and the fastest legal lap (personal best, like Laps.pick_fastest) of every group are found
+    with one groupby over the lap times, ties going to the first lap of the table like Laps.pick_fastest.
+
+    Args:
+        session (ff1.core.Session): Loaded qualifying session
+        column (str): Column of the laps table to group by ("Team", "Driver"...)
+
+    Returns:
+        ff1.core.Laps: Fastest lap of every group, sorted by lap time. "LegalLapTime" holds the fastest legal lap
+            of the group (None if it has none) and "LapTimeDelta" the gap to the fastest lap
+    """
+    laps = session.laps
+    lap_time = (laps['LapTime'] / np.timedelta64(1, 's')).to_numpy(dtype=float)
+    timed = ~np.isnan(lap_time)
+    legal = timed & (laps['IsPersonalBest'] == True).to_numpy()
+    times = pd.DataFrame({
+        "Time" : np.where(timed, lap_time, np.inf),
+        "Legal" : np.where(legal, lap_time, np.inf),
+    })
+    # Groups in order of first appearance, like pd.unique
+    groups = times.groupby(laps[column].to_numpy(), sort=False)
+    fastest, best = groups.idxmin(), groups.min()
+    # Groups without any timed lap have no fastest lap
+    fastest, best = fastest[np.isfinite(best["Time"])], best[np.isfinite(best["Time"])]
+
+    fastest_laps = laps.iloc[fastest["Time"].to_numpy()]
+    legal_laps = np.empty(len(fastest), dtype=object)
+    legal_laps[:] = [laps.iloc[i] if np.isfinite(t) else None for i, t in zip(fastest["Legal"], best["Legal"])]
+    fastest_laps = fastest_laps.assign(LegalLapTime = legal_laps).sort_values(by='LapTime').reset_index(drop=True)
     pole_lap = fastest_laps.pick_fastest(only_by_time=True)
     fastest_laps['LapTimeDelta'] = fastest_laps['LapTime'] - pole_lap['LapTime']
 
     return fastest_laps
 
+def get_team_fastest_laps(session : ff1.core.Session) -> ff1.core.Laps:
+    "Get the fastest lap (illegal or not) of every team in the session."
+    if isinstance(session, ArchivedSession):
+        return session.team_fastest_laps()
+    return get_fastest_laps_by(session, "Team")
+
+def get_driver_fastest_laps(session : ff1.core.Session) -> ff1.core.Laps:
+    "Get the fastest lap (illegal or not) of every driver in the session, like get_team_fastest_laps."
+    if isinstance(session, ArchivedSession):
+        raise ValueError("Telemetry archives only hold the fastest lap of every team")
+    return get_fastest_laps_by(session, "Driver")
+
+class CornerLabelIndex(NamedTuple):
+    "Sorted, non-overlapping corner windows of a session, ready for vectorized lookups."
+    types    : np.ndarray # Corner type of each window, with a trailing "STRAIGHT" sentinel
+    starts   : np.ndarray
+    finishes : np.ndarray
+
+_LABEL_INDEXES : Dict[str, CornerLabelIndex] = {}
+_LABEL_CODES : Dict[str, np.ndarray] = {}
+
+def compile_corner_labels(labels : List[Tuple[str, float, float]]) -> CornerLabelIndex:
+    "Builds the lookup arrays for a list of (type, start, finish) corner windows, rejecting inconsistent labels."
+    labels = sorted(labels, key = lambda label: label[1])
+
+    for t, start, finish in labels:
+        if t not in CORNER_TYPES:
+            raise ValueError(f"Unknown corner type '{t}'")
+        if not start < finish:
+            raise ValueError(f"Empty corner window ({t}, {start}, {finish})")
+    for (t0, start0, finish0), (t1, start1, finish1) in zip(labels, labels[1:]):
+        if start1 < finish0:
+            raise ValueError(f"Overlapping corner windows ({t0}, {start0}, {finish0}) and ({t1}, {start1}, {finish1})")
+
+    return CornerLabelIndex(
+        np.array([t for t, _, _ in labels] + ["STRAIGHT"], dtype=object),
+        np.array([start  for _, start, _  in labels], dtype=float),
+        np.array([finish for _, _, finish in labels], dtype=float),
+    )
+
+def get_label_index(session_name : str) -> CornerLabelIndex:
+    "Gets the compiled corner label index of a session, building it on first use."
+    if session_name not in _LABEL_INDEXES:
+        _LABEL_INDEXES[session_name] = compile_corner_labels(CORNER_LABELS[session_name])
+    return _LABEL_INDEXES[session_name]
+
+def get_label_codes(session_name : str) -> np.ndarray:
+    "Gets the corner type codes (int8 index in CORNER_TYPES) of the windows of a session's label index, sentinel included."
+    if session_name not in _LABEL_CODES:
+        _LABEL_CODES[session_name] = corner_type_codes(get_label_index(session_name).types).astype(np.int8)
+    return _LABEL_CODES[session_name]
+
+def window_indexes(index : CornerLabelIndex, distance : np.ndarray) -> np.ndarray:
+    "Index of the corner window of every distance (start < d <= finish), len(index.starts) if it isn't in any window."
+    # Windows don't overlap, so the first window finishing at or after d is the only candidate
+    candidates = np.searchsorted(index.finishes, distance, side='left')
+    inside = candidates < len(index.starts)
+    inside[inside] = index.starts[candidates[inside]] < distance[inside]
+    candidates[~inside] = len(index.starts)
+
+    return candidates
+
+def label_distances(index : CornerLabelIndex, distance : np.ndarray) -> np.ndarray:
+    "Assigns a corner type to every distance: the window where start < d <= finish, STRAIGHT otherwise."
+    return index.types[window_indexes(index, distance)]
+
 def label_lap(session : ff1.core.Session, lap : ff1.core.Lap):
-    "Assign a corner type for every datapoint in the lap."
-    corner_type = []
-    for index, row in lap.telemetry.iterrows():
-        for t, start, finish in CORNER_LABELS[str(session)]:
-            if start < row["Distance"] <= finish:
-                corner_type.append(t)
-                break
+    "Assign a corner type for every datapoint in the lap (for a LapTrace, its corner type codes)."
+    index = get_label_index(str(session))
+    if isinstance(lap, LapTrace):
+        lap.codes = get_label_codes(str(session))[window_indexes(index, lap.distance)]
+        return
+    lap.telemetry["CornerType"] = label_distances(index, lap.telemetry["Distance"].to_numpy(dtype=float))
+
+# Per-corner breakdown: every window of CORNER_LABELS is a corner, numbered from 1 in order of distance
+CORNER_CHANNELS = ["EntrySpeed", "ApexSpeed", "ExitSpeed", "Distance", "Time"]
+
+def corner_totals(lap_ids : np.ndarray, windows : np.ndarray, codes : np.ndarray, distance : np.ndarray, time : np.ndarray, speed : np.ndarray, n_laps : int, n_corners : int) -> np.ndarray:
+    """Reduces concatenated lap samples into the entry, apex and exit speed, distance and time of every corner.
+
+    Entry and exit speeds are the speeds of the first and last samples inside the corner window, the apex speed
+    is the lowest one. Like in segment_totals, a corner goes from the last sample before its window to the last
+    sample inside it, and the first segment of a lap (from 0m, 0s to the first corner type change) is credited to
+    STRAIGHT: a corner the lap starts in gets no distance and time. The corners of a type therefore add up to the
+    segment_totals total of that type.
+
+    Args:
+        lap_ids (np.ndarray): Lap index of every sample, grouped by lap (non-decreasing)
+        windows (np.ndarray): Corner window of every sample (see window_indexes), n_corners outside of every corner
+        codes (np.ndarray): Corner type code (index in CORNER_TYPES) of every sample, as given to segment_totals
+        distance (np.ndarray): Distance of every sample, in meters
+        time (np.ndarray): Time of every sample, in seconds
+        speed (np.ndarray): Speed of every sample, in km/h
+        n_laps (int): Number of laps
+        n_corners (int): Number of corners
+
+    Returns:
+        np.ndarray: (n_laps, n_corners, len(CORNER_CHANNELS)) array, NaN for the corners a lap has no sample in
+    """
+    res = np.full((n_laps, n_corners, len(CORNER_CHANNELS)), np.nan)
+    samples = np.flatnonzero(windows < n_corners)
+    if len(samples) == 0:
+        return res
+
+    # Last sample of the first run of corner types of every lap, i.e. the end of its first segment in segment_totals
+    same_lap = lap_ids[1:] == lap_ids[:-1]
+    lap_ends = np.flatnonzero(np.append(~same_lap, True))
+    changes = np.flatnonzero((codes[1:] != codes[:-1]) & same_lap)
+    first_segment_end = np.full(n_laps, -1)
+    first_segment_end[lap_ids[lap_ends]] = lap_ends
+    changed_laps, first_changes = np.unique(lap_ids[changes], return_index=True)
+    first_segment_end[changed_laps] = changes[first_changes]
+
+    keys = lap_ids[samples] * n_corners + windows[samples]
+    order = np.argsort(keys, kind="stable")
+    samples, keys = samples[order], keys[order]
+    run_starts = np.flatnonzero(np.append(True, keys[1:] != keys[:-1]))
+    first = samples[run_starts]
+    last  = samples[np.append(run_starts[1:], len(keys)) - 1]
+    previous = np.maximum(first - 1, 0)
+    in_first_segment = first <= first_segment_end[lap_ids[first]]
+
+    flat = res.reshape(-1, len(CORNER_CHANNELS))
+    run_keys = keys[run_starts]
+    flat[run_keys, 0] = speed[first]
+    flat[run_keys, 1] = np.minimum.reduceat(speed[samples], run_starts)
+    flat[run_keys, 2] = speed[last]
+    flat[run_keys, 3] = np.where(in_first_segment, 0, distance[last] - distance[previous])
+    flat[run_keys, 4] = np.where(in_first_segment, 0, time[last]     - time[previous])
+
+    return res
+
+def corner_performance_batch(session : ff1.core.Session, laps : List[ff1.core.Lap]) -> np.ndarray:
+    "(lap, corner, channel) breakdown of laps of a session by corner of CORNER_LABELS, channels ordered as in CORNER_CHANNELS"
+    index = get_label_index(str(session))
+    traces = [lap_trace(lap) for lap in laps]
+    arrays = [(trace.distance, trace.time, trace.speed) for trace in traces]
+    lap_ids = np.repeat(np.arange(len(arrays)), [len(distance) for distance, _, _ in arrays])
+    distance, time, speed = (np.concatenate([a[i] for a in arrays]) if arrays else np.empty(0) for i in range(3))
+
+    windows = window_indexes(index, distance)
+    codes = get_label_codes(str(session))[windows].astype(np.int64)
+    return corner_totals(lap_ids, windows, codes, distance, time, speed, len(arrays), len(index.starts))
+
+def corner_rows(session : ff1.core.Session, performance : np.ndarray, teams : List[str], round_number : int) -> List[Dict]:
+    "Rows of the per-corner table of a session (Corner, CornerType, CORNER_CHANNELS, Team, GPName, SessionNumber), one per team and corner"
+    index = get_label_index(str(session))
+    n_laps, n_corners = performance.shape[:2]
+    table = pd.DataFrame(performance.reshape(-1, len(CORNER_CHANNELS)), columns=CORNER_CHANNELS)
+    table.insert(0, "Corner", np.tile(np.arange(1, n_corners + 1), n_laps))
+    table.insert(1, "CornerType", np.tile(index.types[:-1], n_laps))
+    table["Team"] = np.repeat(np.asarray(teams, dtype=object), n_corners)
+    table["GPName"] = str(session)[21:-13]
+    table["SessionNumber"] = round_number
+    return table.to_dict("records")
+
+def corners_path(path : str) -> str:
+    "Path of the per-corner table stored alongside a per-corner-type table (cornering_data.json -> cornering_data_corners.json)"
+    root, extension = os.path.splitext(path)
+    return f"{root}_corners{extension}"
+
+# Bump whenever a change to the code alters the generated rows, to invalidate the result cache
+RESULTS_VERSION = 3
+
+# Speed band mode: the corner type of every sample comes from its own speed and throttle, no labels needed
+SPEED_BANDS = [100, 150, 200] # km/h, boundaries between LOW | MEDIUM-LOW | MEDIUM-HIGH | HIGH
+FULL_THROTTLE = 98            # %, at or above this the sample is on a straight
+
+def speed_band_codes(speed : np.ndarray, throttle : np.ndarray, speed_bands : List[float] = SPEED_BANDS, full_throttle : float = FULL_THROTTLE) -> np.ndarray:
+    "Corner type code (index in CORNER_TYPES) of every sample: STRAIGHT at full throttle, otherwise the speed band of the sample."
+    codes = np.digitize(speed, speed_bands)
+    codes[throttle >= full_throttle] = STRAIGHT_CODE
+    return codes
+
+def classify_samples(speed : np.ndarray, throttle : np.ndarray, speed_bands : List[float] = SPEED_BANDS, full_throttle : float = FULL_THROTTLE) -> np.ndarray:
+    "Assigns a corner type to every sample: STRAIGHT at full throttle, otherwise the speed band of the sample."
+    types = np.array(CORNER_TYPES, dtype=object)
+    return types[speed_band_codes(speed, throttle, speed_bands, full_throttle)]
+
+def label_lap_by_speed(session : ff1.core.Session, lap : ff1.core.Lap, speed_bands : List[float] = SPEED_BANDS, full_throttle : float = FULL_THROTTLE):
+    "Assign a corner type for every datapoint in the lap from its speed and throttle (drop-in replacement for label_lap)."
+    if isinstance(lap, LapTrace):
+        lap.codes = speed_band_codes(lap.speed, lap.throttle, speed_bands, full_throttle).astype(np.int8)
+        return
+    lap.telemetry["CornerType"] = classify_samples(
+        lap.telemetry["Speed"].to_numpy(dtype=float),
+        lap.telemetry["Throttle"].to_numpy(dtype=float),
+        speed_bands,
+        full_throttle,
+    )
+
+LABELLERS : Dict[str, Callable[[ff1.core.Session, ff1.core.Lap], None]] = {
+    "distance" : label_lap,
+    "speed" : label_lap_by_speed,
+}
+
+def session_compounds(session : ff1.core.Session) -> Set[str]:
+    "Tyre compounds used in a session"
+    if isinstance(session, ArchivedSession):
+        return session.compounds
+    return set(session.laps["Compound"])
+
+def process_round(year : int, round_number : int, force_include : Set[str] = {}, archive_dir : Optional[str] = None, labelling : str = "distance") -> Optional[Dict[str, List[Dict]]]:
+    """Generates the cornering performance rows of every team in a qualifying session.
+
+    Args:
+        year (int): Season of the session
+        round_number (int): Round of the session
+        force_include (Set[str], optional): Sessions to process even if wet weather tyres were used
+        archive_dir (Optional[str], optional): Read the session from its telemetry archive in this directory instead of loading it with fastf1
+        labelling (str, optional): Corner labelling mode, a key of LABELLERS. Defaults to "distance" (CORNER_LABELS windows).
+
+    Returns:
+        Optional[Dict[str, List[Dict]]]: The per-corner-type ("Types") and per-corner ("Corners", distance labelling only)
+            rows of the session (empty if the session was skipped), or None if the round doesn't exist
+    """
+    quali_session = load_quali_session(year, round_number, archive_dir)
+    if quali_session is None:
+        return None
+
+    tyres_used = session_compounds(quali_session)
+
+    if len(WET_COMPOUNDS.intersection(tyres_used)) > 0 and str(quali_session) not in force_include:
+        print("Wet weather tyres were used. Skipping this event")
+        return {"Types" : [], "Corners" : []}
+
+    ##########################################################################
+    data = []
+    with stage("team_fastest_laps", Year=year, Round=round_number):
+        fastest_laps = get_team_fastest_laps(quali_session)
+    laps = []
+
+    for _, lap in fastest_laps.iterlaps():
+        # Only the trace of the lap is kept, so its telemetry DataFrame is freed with the Lap
+        lap = LapTrace.from_lap(lap)
+        laps.append(lap)
+        driver = lap["Driver"]
+        print(f"Processing {driver}...")
+        team = lap["Team"]
+        with stage("label_lap", Year=year, Round=round_number, Driver=driver):
+            LABELLERS[labelling](quali_session, lap)
+        with stage("corner_type_performance", Year=year, Round=round_number, Driver=driver):
+            corner_performance = corner_type_performance(lap)
+
+        for key in corner_performance:
+            entry = corner_performance[key]
+            entry["CornerType"] = key
+            entry["Team"] = team
+            entry["GPName"] = str(quali_session)[21:-13]
+            entry["SessionNumber"] = round_number
+
+            data.append(entry)
+
+    corners = []
+    if labelling == "distance":
+        with stage("corner_performance", Year=year, Round=round_number):
+            performance = corner_performance_batch(quali_session, laps)
+            corners = corner_rows(quali_session, performance, [lap["Team"] for lap in laps], round_number)
+
+    return {"Types" : data, "Corners" : corners}
+
+def session_cache_key(cache : ResultCache, entry : Dict, force_include : Set[str] = {}, archived : bool = False, labelling : str = "distance") -> str:
+    "Cache key of a session's results (from its season index entry): session identity, labelling (hash of its corner labels or speed bands) and code version"
+    return cache.key(
+        entry["Year"],
+        entry["RoundNumber"],
+        entry["Session"],
+        corner_labels_hash(entry["Session"]) if labelling == "distance" else [labelling, SPEED_BANDS, FULL_THROTTLE],
+        entry["Session"] in force_include,
+        archived,
+        RESULTS_VERSION,
+    )
+
+def gen_cornering_performance_data(year : int, path : str, force_include : Set[str] = {}, parallel : bool = False, workers : Optional[int] = None, use_cache : bool = True, archive_dir : Optional[str] = None, labelling : str = "distance"):
+    """Generates cornering performance data for car and track in the season.
+
+    Args:
+        year (int): Season to process
+        path (str): Output file (.json, .npz, .parquet or .feather). The per-corner rows go to corners_path(path)
+        force_include (Set[str], optional): Sessions to process even if wet weather tyres were used
+        parallel (bool, optional): Process the rounds in a pool of worker processes. Defaults to False.
+        workers (Optional[int], optional): Number of worker processes. Defaults to the number of cores.
+        use_cache (bool, optional): Reuse the results of sessions whose inputs didn't change. Defaults to True.
+        archive_dir (Optional[str], optional): Read the sessions from the telemetry archives in this directory instead of loading them with fastf1
+        labelling (str, optional): Corner labelling mode, a key of LABELLERS. Defaults to "distance" (CORNER_LABELS windows).
+    """
+    cache = ResultCache("cornering_performance") if use_cache else None
+
+    results = {}
+    keys = {}
+    # Wet sessions are skipped by the season index, without loading them
+    for entry in iter_quali_rounds(year, force_include, archive_dir):
+        i = entry["RoundNumber"]
+        if cache is not None:
+            keys[i] = session_cache_key(cache, entry, force_include, archive_dir is not None, labelling)
+            results[i] = cache.get(keys[i])
         else:
-            corner_type.append("STRAIGHT")
-    
-    lap.telemetry["CornerType"] = corner_type
+            results[i] = None
+    pending = [i for i in results if results[i] is None]
+
+    def store(round_number : int, rows : Optional[Dict[str, List[Dict]]]):
+        results[round_number] = rows
+        if rows is not None and cache is not None:
+            cache.put(keys[round_number], rows)
 
-def gen_cornering_performance_data(year : int, path : str, force_include : Set[str] = {}):
-    "Generates cornering performance data for car and track in the season."
+    if parallel and len(pending) > 0:
+        with ProcessPoolExecutor(max_workers = workers or os.cpu_count()) as executor:
+            futures = {executor.submit(collect_stages, process_round, year, i, force_include, archive_dir, labelling) : i for i in pending}
+            # Store every session as soon as it is done, so that an interrupted run can be resumed
+            for future in as_completed(futures):
+                rows, stages = future.result()
+                merge_stages(stages)
+                store(futures[future], rows)
+    else:
+        for i in pending:
+            rows = process_round(year, i, force_include, archive_dir, labelling)
+            store(i, rows)
+
+    # Same output whatever the processing order: rounds in order, skipping the ones that couldn't be loaded
     data = []
-    for i in range(1, 30):
-        try:
-            quali_session = ff1.get_session(year, i, 'Q')
-            print(f"Loading {quali_session}")
-            quali_session.load()
-        except ValueError:
-            break
-        except ff1.core.DataNotLoadedError:
-            break
-
-        tyres_used = set(quali_session.laps["Compound"])
-
-        if ('INTERMEDIATE' in tyres_used or 'WET' in tyres_used) and str(quali_session) not in force_include:
-            print("Wet weather tyres were used. Skipping this event")
+    corners = []
+    for i in sorted(results):
+        if results[i] is None:
+            print(f"Could not load round {i}. Skipping this event")
             continue
+        data.extend(results[i]["Types"])
+        corners.extend(results[i]["Corners"])
 
-        ##########################################################################
-        fastest_laps = get_team_fastest_laps(quali_session)
-        
-        for _, lap in fastest_laps.iterlaps():
-            driver = lap["Driver"]
-            print(f"Processing {driver}...")
-            team = lap["Team"]
-            label_lap(quali_session, lap)
-            corner_performance = corner_type_performance(lap)
-            
-            for key in corner_performance:
-                entry = corner_performance[key]
-                entry["CornerType"] = key
-                entry["Team"] = team
-                entry["GPName"] = str(quali_session)[21:-13]
-                entry["SessionNumber"] = i
-                
-                data.append(entry)
-        
-    data = pd.DataFrame(data)
-    data.to_json(path)
+    if cache is not None:
+        cache.report()
+
+    with stage("write", Path=path):
+        data = pd.DataFrame(data)
+        write_table(data, path)
+        if len(corners) > 0:
+            write_table(pd.DataFrame(corners), corners_path(path))
 
 if __name__ == "__main__":
-    gen_cornering_performance_data(2023, "cornering_data.json", {'2023 Season Round 10: British Grand Prix - Qualifying',})
+    force_include = {'2023 Season Round 10: British Grand Prix - Qualifying',}
+    options = {"parallel" : False, "workers" : None, "archive_dir" : None, "labelling" : "distance"}
+    args = argv[1:]
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == "parallel":
+            options["parallel"] = True
+            if len(args) > 0 and args[0].isdigit():
+                options["workers"] = int(args.pop(0))
+        elif arg == "speed":
+            options["labelling"] = "speed"
+        elif arg == "archive":
+            options["archive_dir"] = args.pop(0) if len(args) > 0 else ARCHIVE_DIR
+        else:
+            print("Usage:")
+            print(f"  {argv[0]} [parallel [workers]] [archive [directory]] [speed]")
+            exit()
+    gen_cornering_performance_data(2023, "cornering_data.json", force_include, **options)
+    report()
@@ -0,0 +1,134 @@
+import json
+import os
+import sys
+from contextlib import contextmanager
+from time import perf_counter, process_time, time
+from typing import Callable, Dict, Iterator, List, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Stage-level instrumentation of the scripts. A stage is a block of code wrapped in `with stage(name, **context)`,
+# the context telling which session (Year, Round) or lap (Driver) it worked on. For every stage run, the wall
+# time, CPU time, the peak RSS of the process so far and its growth during the stage are recorded in memory, and
+# report() prints a per-stage summary at the end of the run. Stage times are inclusive of the stages nested in
+# them. Two more outputs are enabled by environment variables, so they reach every entry point (and the worker
+# processes of gen_data.py) without new command line options:
+#   STAGE_LOG=stages.jsonl     appends one JSON line per stage run
+#   STAGE_TRACE=trace.json     writes a Chrome trace (chrome://tracing, ui.perfetto.dev) at the end of the run
+
+LOG_VARIABLE   = "STAGE_LOG"
+TRACE_VARIABLE = "STAGE_TRACE"
+
+def peak_rss_mb() -> float:
+    "Peak resident set size of the process so far, in MB (NaN where unavailable)"
+    if resource is None:
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+class StageRecorder:
+    "Records the stages run by a process, writing them as JSON lines if log_path is set"
+    def __init__(self, log_path : str = None, trace_path : str = None):
+        self.log_path = log_path
+        self.trace_path = trace_path
+        self.records : List[Dict] = []
+        self.depth = 0
+
+    @contextmanager
+    def stage(self, name : str, **context) -> Iterator[None]:
+        start, wall, cpu, rss = time(), perf_counter(), process_time(), peak_rss_mb()
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            peak = peak_rss_mb()
+            self.add([{
+                "Stage" : name,
+                **context,
+                "Start" : start,
+                "WallSeconds" : perf_counter() - wall,
+                "CPUSeconds" : process_time() - cpu,
+                "ProcessPeakRSSMB" : peak, # Peak of the process so far, not of the stage
+                "PeakRSSGrowthMB" : peak - rss,
+                "Depth" : self.depth,
+                "Pid" : os.getpid(),
+            }])
+
+    def add(self, records : List[Dict], log : bool = True):
+        "Adds stage records (log = False for records already logged, e.g. by a worker process)"
+        self.records.extend(records)
+        if log and self.log_path is not None:
+            with open(self.log_path, "a") as f:
+                for record in records:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+    def summary(self) -> List[Dict]:
+        "Runs, total/mean/max wall time, total CPU time and largest peak RSS growth of every stage, in order of first run"
+        stages : Dict[str, Dict] = {}
+        for record in self.records:
+            summary = stages.setdefault(record["Stage"], {"Stage" : record["Stage"], "Runs" : 0, "WallSeconds" : 0.0, "MaxWallSeconds" : 0.0, "CPUSeconds" : 0.0, "PeakRSSGrowthMB" : 0.0})
+            summary["Runs"] += 1
+            summary["WallSeconds"] += record["WallSeconds"]
+            summary["MaxWallSeconds"] = max(summary["MaxWallSeconds"], record["WallSeconds"])
+            summary["CPUSeconds"] += record["CPUSeconds"]
+            summary["PeakRSSGrowthMB"] = max(summary["PeakRSSGrowthMB"], record["PeakRSSGrowthMB"])
+        for summary in stages.values():
+            summary["MeanWallSeconds"] = summary["WallSeconds"] / summary["Runs"]
+        return list(stages.values())
+
+    def write_trace(self, path : str):
+        "Writes the recorded stages as a Chrome trace (one complete event per stage run, one track per process)"
+        events = []
+        for record in self.records:
+            args = {key : value for key, value in record.items() if key not in ("Stage", "Start", "WallSeconds", "Pid", "Depth")}
+            events.append({
+                "name" : record["Stage"],
+                "cat" : "stage",
+                "ph" : "X",
+                "ts" : record["Start"] * 1e6,
+                "dur" : record["WallSeconds"] * 1e6,
+                "pid" : record["Pid"],
+                "tid" : record["Pid"],
+                "args" : args,
+            })
+        with open(path, "w") as f:
+            json.dump({"traceEvents" : events, "displayTimeUnit" : "ms"}, f, default=str)
+
+    def report(self):
+        "Prints the per-stage summary, and writes the Chrome trace if STAGE_TRACE is set"
+        if len(self.records) == 0:
+            return
+        print(f"{'Stage':<30}{'Runs':>6}{'Wall (s)':>10}{'Mean (ms)':>11}{'Max (ms)':>10}{'CPU (s)':>9}{'RSS growth (MB)':>17}")
+        for summary in self.summary():
+            print(
+                f"{summary['Stage']:<30}{summary['Runs']:>6}{summary['WallSeconds']:>10.2f}{summary['MeanWallSeconds'] * 1000:>11.1f}"
+                f"{summary['MaxWallSeconds'] * 1000:>10.1f}{summary['CPUSeconds']:>9.2f}{summary['PeakRSSGrowthMB']:>17.0f}"
+            )
+        print(f"Peak RSS of the process: {peak_rss_mb():.0f} MB")
+        if self.trace_path is not None:
+            self.write_trace(self.trace_path)
+            print(f"Chrome trace written to {self.trace_path}")
+
+RECORDER = StageRecorder(os.environ.get(LOG_VARIABLE), os.environ.get(TRACE_VARIABLE))
+
+def stage(name : str, **context):
+    "Context manager recording a stage of the current process"
+    return RECORDER.stage(name, **context)
+
+def report():
+    "Prints the per-stage summary of the current process (and of the worker processes merged into it)"
+    RECORDER.report()
+
+def collect_stages(f : Callable, *args) -> Tuple[object, List[Dict]]:
+    "Runs f(*args) (typically in a worker process), returning its result and the stages recorded meanwhile"
+    mark = len(RECORDER.records)
+    result = f(*args)
+    return result, RECORDER.records[mark:]
+
+def merge_stages(records : List[Dict]):
+    "Adds the stages recorded by a worker process (see collect_stages), which logged them already"
+    RECORDER.add(records, log = False)
@@ -0,0 +1,209 @@
+import fastf1 as ff1
+import numpy as np
+import pandas as pd
+from sys import argv
+from time import perf_counter
+from typing import NamedTuple, Optional, Set, Tuple
+from data import CORNER_TYPES
+from columnar import write_table
+from gen_data import corner_type_codes, get_label_index, label_distances, segment_totals, speed_band_codes
+from instrumentation import report, stage
+from season_index import iter_quali_sessions, load_quali_session
+from telemetry_archive import ARCHIVE_DIR, ArchivedSession
+
+# Batch engine: corner type breakdown of every accurate lap of a session, not only the fastest lap of every team.
+# Instead of labelling and reducing the telemetry of each lap on its own, the samples of all the laps are
+# gathered into flat arrays with a lap id column, labelled in one go and reduced with gen_data.segment_totals.
+#   - fastf1 sessions: the car data of every driver is sliced into laps with their start/end session times, and
+#     distances are integrated from speed within each lap, like fastf1's Telemetry.add_distance. Laps are not
+#     merged with the position data, so the samples are the ~4 Hz car data samples
+#   - telemetry archives: every archived lap (team fastest laps and session fastest lap) is used as is
+
+QUALI_PARTS = ["Q1", "Q2", "Q3"]
+LAP_COLUMNS = ["Driver", "Team", "LapNumber", "Compound", "Part"]
+
+class LapSamples(NamedTuple):
+    "Telemetry samples of many laps concatenated into flat arrays, grouped by lap (lap_ids[i] is the row in laps of sample i)"
+    laps     : pd.DataFrame
+    lap_ids  : np.ndarray
+    distance : np.ndarray # m
+    time     : np.ndarray # s, from the start of the lap
+    speed    : np.ndarray # km/h
+    throttle : np.ndarray # %
+
+def quali_parts(laps : ff1.core.Laps) -> pd.Series:
+    "Qualifying part (Q1, Q2 or Q3) of every lap of a session"
+    parts = pd.Series(None, index=laps.index, dtype=object)
+    for part, part_laps in zip(QUALI_PARTS, laps.split_qualifying_sessions()):
+        if part_laps is not None:
+            parts[part_laps.index] = part
+    return parts
+
+def select_laps(session : ff1.core.Session, compounds : Optional[Set[str]] = None, parts : Optional[Set[str]] = None, drivers : Optional[Set[str]] = None) -> pd.DataFrame:
+    """Every accurate, timed lap of a session (every archived lap for telemetry archives), optionally filtered
+
+    Args:
+        session (ff1.core.Session): Loaded (or archived) qualifying session
+        compounds (Optional[Set[str]], optional): Only keep the laps on these compounds
+        parts (Optional[Set[str]], optional): Only keep the laps of these qualifying parts (Q1, Q2, Q3). Not available for archives.
+        drivers (Optional[Set[str]], optional): Only keep the laps of these drivers (abbreviations, e.g. VER)
+
+    Returns:
+        pd.DataFrame: The selected laps, with their qualifying part in the "Part" column
+    """
+    if isinstance(session, ArchivedSession):
+        if parts is not None:
+            raise ValueError("Telemetry archives don't record the qualifying part of their laps")
+        laps = session.metadata.copy()
+        laps["Part"] = None
+    else:
+        laps = pd.DataFrame(session.laps)
+        laps["Part"] = quali_parts(session.laps)
+        laps = laps[laps["IsAccurate"] == True]
+
+    laps = laps[laps["LapTime"].notna()]
+    if compounds is not None:
+        laps = laps[laps["Compound"].isin(compounds)]
+    if parts is not None:
+        laps = laps[laps["Part"].isin(parts)]
+    if drivers is not None:
+        laps = laps[laps["Driver"].isin(drivers)]
+
+    return laps.reset_index(drop=True)
+
+def _concat_ranges(first : np.ndarray, last : np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    "Indexes first[k]:last[k] for every k, concatenated, and the k of every index"
+    lengths = last - first
+    ids = np.repeat(np.arange(len(first)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum()) - np.repeat(offsets - first, lengths), ids
+
+def lap_distance(lap_ids : np.ndarray, time : np.ndarray, speed : np.ndarray) -> np.ndarray:
+    "Distance of every sample from the start of its lap, integrated from speed like fastf1's Telemetry.add_distance"
+    if len(time) == 0:
+        return np.empty(0)
+    first = np.ones(len(time), dtype=bool)
+    first[1:] = lap_ids[1:] != lap_ids[:-1]
+    dt = np.diff(time, prepend=0.0)
+    dt[first] = time[first]
+    ds = speed / 3.6 * dt
+
+    distance = np.cumsum(ds)
+    lap_start = np.maximum.accumulate(np.where(first, np.arange(len(time)), 0))
+    return distance - (distance - ds)[lap_start]
+
+def car_data_samples(session : ff1.core.Session, laps : pd.DataFrame) -> LapSamples:
+    "Car data samples of the laps of a loaded fastf1 session"
+    chunks = []
+    for driver_number, driver_laps in laps.groupby("DriverNumber", sort=False):
+        car_data = session.car_data[driver_number]
+        session_time = (car_data["SessionTime"] / np.timedelta64(1, 's')).to_numpy(dtype=float)
+        starts = (driver_laps["LapStartTime"] / np.timedelta64(1, 's')).to_numpy(dtype=float)
+        ends   = (driver_laps["Time"]         / np.timedelta64(1, 's')).to_numpy(dtype=float)
+        indexes, ids = _concat_ranges(np.searchsorted(session_time, starts, side='left'), np.searchsorted(session_time, ends, side='right'))
+        chunks.append((
+            driver_laps.index.to_numpy()[ids],
+            session_time[indexes] - starts[ids],
+            car_data["Speed"].to_numpy(dtype=float)[indexes],
+            car_data["Throttle"].to_numpy(dtype=float)[indexes],
+        ))
+
+    lap_ids, time, speed, throttle = (np.concatenate([chunk[i] for chunk in chunks]) if chunks else np.empty(0) for i in range(4))
+    order = np.argsort(lap_ids, kind="stable")
+    lap_ids, time, speed, throttle = lap_ids[order].astype(np.int64), time[order], speed[order], throttle[order]
+
+    return LapSamples(laps, lap_ids, lap_distance(lap_ids, time, speed), time, speed, throttle)
+
+def archive_samples(session : ArchivedSession, laps : pd.DataFrame) -> LapSamples:
+    "Telemetry samples of the laps of a telemetry archive"
+    archive_index = laps["ArchiveIndex"].to_numpy()
+    indexes, lap_ids = _concat_ranges(session.offsets[archive_index], session.offsets[archive_index + 1])
+    distance, time, speed, throttle = (session.channels[channel][indexes].astype(float) for channel in ("Distance", "Time", "Speed", "Throttle"))
+    return LapSamples(laps, lap_ids, distance, time, speed, throttle)
+
+def lap_samples(session : ff1.core.Session, laps : pd.DataFrame) -> LapSamples:
+    "Telemetry samples of laps selected with select_laps"
+    if isinstance(session, ArchivedSession):
+        return archive_samples(session, laps)
+    return car_data_samples(session, laps)
+
+def sample_codes(session : ff1.core.Session, samples : LapSamples, labelling : str = "distance") -> np.ndarray:
+    "Corner type code (index in CORNER_TYPES) of every sample, with the labelling modes of gen_data.LABELLERS"
+    if labelling == "distance":
+        index = get_label_index(str(session))
+        return label_distances(index._replace(types=corner_type_codes(index.types)), samples.distance)
+    elif labelling == "speed":
+        return speed_band_codes(samples.speed, samples.throttle)
+    raise ValueError(f"Unknown labelling mode '{labelling}'")
+
+def all_laps_performance(session : ff1.core.Session, labelling : str = "distance", compounds : Optional[Set[str]] = None, parts : Optional[Set[str]] = None, drivers : Optional[Set[str]] = None) -> pd.DataFrame:
+    """Distance, time and speed spent on each corner type by every selected lap of a session
+
+    Args:
+        session (ff1.core.Session): Loaded (or archived) qualifying session
+        labelling (str, optional): Corner labelling mode, a key of gen_data.LABELLERS. Defaults to "distance".
+        compounds, parts, drivers (Optional[Set[str]], optional): Lap filters, see select_laps
+
+    Returns:
+        pd.DataFrame: One row per lap and corner type (Distance, Time, Speed, CornerType, Driver, Team, LapNumber,
+            Compound, Part, LapTime in seconds, GPName), corner types ordered as in CORNER_TYPES
+    """
+    laps = select_laps(session, compounds, parts, drivers)
+    samples = lap_samples(session, laps)
+    codes = sample_codes(session, samples, labelling)
+    totals = segment_totals(samples.lap_ids, codes.astype(np.int64), samples.distance, samples.time, len(laps))
+
+    distance, time = totals[:, :, 0].ravel(), totals[:, :, 1].ravel()
+    res = pd.DataFrame({
+        "Distance" : distance,
+        "Time" : time,
+        "Speed" : np.divide(distance, time, out=np.zeros_like(distance), where=time > 0),
+        "CornerType" : np.tile(CORNER_TYPES, len(laps)),
+    })
+    for column in LAP_COLUMNS:
+        res[column] = np.repeat(laps[column].to_numpy(), len(CORNER_TYPES))
+    res["LapTime"] = np.repeat((laps["LapTime"] / np.timedelta64(1, 's')).to_numpy(dtype=float), len(CORNER_TYPES))
+    res["GPName"] = str(session)[21:-13]
+
+    return res
+
+def gen_all_laps_data(year : int, path : str, force_include : Set[str] = set(), archive_dir : Optional[str] = None, labelling : str = "distance", compounds : Optional[Set[str]] = None, parts : Optional[Set[str]] = None, drivers : Optional[Set[str]] = None):
+    "Generates the corner type breakdown of every selected lap of every dry qualifying session of a season"
+    tables = []
+    for session in iter_quali_sessions(year, force_include, archive_dir):
+        with stage("all_laps_performance", Session=str(session)):
+            table = all_laps_performance(session, labelling, compounds, parts, drivers)
+        table["SessionNumber"] = session.event["RoundNumber"]
+        tables.append(table)
+
+    with stage("write", Path=path):
+        write_table(pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(), path)
+
+if __name__ == "__main__":
+    options = {"archive_dir" : None, "labelling" : "distance", "compounds" : None, "parts" : None, "drivers" : None}
+    positional = []
+    for arg in argv[1:]:
+        if arg == "archive":
+            options["archive_dir"] = ARCHIVE_DIR
+        elif arg == "speed":
+            options["labelling"] = "speed"
+        elif "=" in arg and arg.split("=")[0] in ("compound", "part", "driver"):
+            name, values = arg.split("=", 1)
+            options[name + "s"] = set(values.upper().split(","))
+        else:
+            positional.append(arg)
+
+    if len(positional) == 1 and positional[0].isdigit():
+        gen_all_laps_data(int(positional[0]), "all_laps_data.json", {'2023 Season Round 10: British Grand Prix - Qualifying',}, **options)
+        report()
+    elif len(positional) == 2 and positional[0].isdigit() and positional[1].isdigit():
+        quali_session = load_quali_session(int(positional[0]), int(positional[1]), options.pop("archive_dir"))
+        start = perf_counter()
+        table = all_laps_performance(quali_session, **options)
+        print(table.to_string())
+        print(f"{len(table) // len(CORNER_TYPES)} laps processed in {perf_counter() - start:.3f}s")
+    else:
+        print("Usage:")
+        print(f"  {argv[0]} year [options]       | writes the corner type breakdown of every lap of a season to 'all_laps_data.json'")
+        print(f"  {argv[0]} year round [options] | prints the corner type breakdown of every lap of a qualifying session")
+        print("Options: compound=SOFT,MEDIUM part=Q1,Q2,Q3 driver=VER,HAM archive speed")
@@ -0,0 +1,138 @@
+import fastf1 as ff1
+import numpy as np
+import pandas as pd
+from sys import argv
+from typing import List, NamedTuple, Tuple
+from data import CORNER_TYPES
+from gen_data import classify_samples, corner_type_codes, get_label_index, get_team_fastest_laps, label_distances
+from lap_trace import lap_trace
+from season_index import load_quali_session
+from telemetry_archive import ARCHIVE_DIR
+
+# Lap tensors: the fastest lap of every team resampled onto a common distance grid of the track, so that laps
+# can be compared point by point with array operations instead of aligning telemetry frames sampled at
+# different positions. The grid goes from 0 to the length of the shortest lap, every GRID_STEP meters.
+
+GRID_STEP = 5          # m
+MINI_SECTORS = 25
+GRID_CHANNELS = ["Time", "Speed", "Throttle"]
+
+class LapTensor(NamedTuple):
+    "Laps resampled on a common distance grid: values[lap, point, channel]"
+    laps         : pd.DataFrame # Driver, Team, LapTime (s) of every lap, fastest first
+    grid         : np.ndarray   # m
+    channels     : List[str]
+    values       : np.ndarray
+    corner_types : np.ndarray   # Corner type code (index in CORNER_TYPES) of every grid point
+
+    def channel(self, name : str) -> np.ndarray:
+        "(lap, point) array of a channel"
+        return self.values[:, :, self.channels.index(name)]
+
+def resample_laps(laps : List[ff1.core.Lap], channels : List[str] = GRID_CHANNELS, step : float = GRID_STEP) -> Tuple[np.ndarray, np.ndarray]:
+    """Resamples laps onto a common distance grid, interpolating all of them in a single call
+
+    Args:
+        laps (List[ff1.core.Lap]): Laps (fastf1, archived or LapTrace) of the same track
+        channels (List[str], optional): Telemetry channels to resample ("Time" is converted to seconds)
+        step (float, optional): Grid step, in meters
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The grid and the (lap, point, channel) tensor
+    """
+    traces = []
+    for lap in laps:
+        trace = lap_trace(lap)
+        traces.append((trace.distance, np.column_stack([trace.channel(c) for c in channels])))
+
+    grid = np.arange(0, min(distance[-1] for distance, _ in traces), step)
+    # Every lap is shifted by a multiple of a span longer than any lap, so the concatenated distances stay sorted.
+    # The grid points are clamped to the distance range of their own lap: past its edges, a lap keeps its first
+    # (or last) sample like a per-lap np.interp, instead of blending with the neighbouring lap
+    first = np.array([distance[0] for distance, _ in traces])
+    last = np.array([distance[-1] for distance, _ in traces])
+    span = last.max() - min(first.min(), 0) + step
+    shifts = np.arange(len(traces)) * span
+    distance = np.concatenate([d + shift for (d, _), shift in zip(traces, shifts)])
+    samples = np.concatenate([v for _, v in traces])
+    points = (np.clip(grid[np.newaxis, :], first[:, np.newaxis], last[:, np.newaxis]) + shifts[:, np.newaxis]).ravel()
+
+    values = np.stack([np.interp(points, distance, samples[:, i]) for i in range(len(channels))], axis=-1)
+    return grid, values.reshape(len(traces), len(grid), len(channels))
+
+def session_lap_tensor(session : ff1.core.Session, step : float = GRID_STEP, labelling : str = "distance") -> LapTensor:
+    """Lap tensor of the fastest lap of every team in a session
+
+    Args:
+        session (ff1.core.Session): Loaded (or archived) qualifying session
+        step (float, optional): Grid step, in meters
+        labelling (str, optional): "distance" labels the grid with CORNER_LABELS, "speed" with the speed bands of the fastest lap
+
+    Returns:
+        LapTensor: Laps sorted by lap time, fastest first
+    """
+    return lap_tensor(session, [lap for _, lap in get_team_fastest_laps(session).iterlaps()], step, labelling)
+
+def lap_tensor(session : ff1.core.Session, fastest_laps : List[ff1.core.Lap], step : float = GRID_STEP, labelling : str = "distance") -> LapTensor:
+    "Lap tensor of laps of a session, sorted by lap time (see session_lap_tensor)"
+    laps = pd.DataFrame({
+        "Driver" : [lap["Driver"] for lap in fastest_laps],
+        "Team" : [lap["Team"] for lap in fastest_laps],
+        "LapTime" : [lap["LapTime"] / np.timedelta64(1, 's') for lap in fastest_laps],
+    })
+    grid, values = resample_laps(fastest_laps, GRID_CHANNELS, step)
+
+    if labelling == "distance":
+        corner_types = label_distances(get_label_index(str(session)), grid)
+    elif labelling == "speed":
+        corner_types = classify_samples(values[0, :, GRID_CHANNELS.index("Speed")], values[0, :, GRID_CHANNELS.index("Throttle")])
+    else:
+        raise ValueError(f"Unknown labelling mode '{labelling}'")
+
+    return LapTensor(laps, grid, list(GRID_CHANNELS), values, corner_type_codes(corner_types))
+
+def time_deltas(tensor : LapTensor, reference : int = 0) -> np.ndarray:
+    "(lap, point) time delta of every lap to the reference lap (by default the fastest one), in seconds"
+    time = tensor.channel("Time")
+    return time - time[reference]
+
+def mini_sector_times(tensor : LapTensor, n_sectors : int = MINI_SECTORS) -> Tuple[np.ndarray, np.ndarray]:
+    "Boundaries (grid indexes) of n_sectors mini-sectors of equal length and the (lap, sector) time spent in each of them"
+    boundaries = np.linspace(0, len(tensor.grid) - 1, n_sectors + 1).round().astype(int)
+    time = tensor.channel("Time")[:, boundaries]
+    return boundaries, np.diff(time, axis=1)
+
+def mini_sector_winners(tensor : LapTensor, n_sectors : int = MINI_SECTORS) -> pd.DataFrame:
+    "Fastest team of every mini-sector, with its time and its margin to the second fastest"
+    boundaries, times = mini_sector_times(tensor, n_sectors)
+    order = np.argsort(times, axis=0)
+    sectors = np.arange(n_sectors)
+    margin = times[order[1], sectors] - times[order[0], sectors] if len(times) > 1 else np.zeros(n_sectors)
+    return pd.DataFrame({
+        "Start" : tensor.grid[boundaries[:-1]],
+        "End" : tensor.grid[boundaries[1:]],
+        "Team" : tensor.laps["Team"].to_numpy()[order[0]],
+        "Driver" : tensor.laps["Driver"].to_numpy()[order[0]],
+        "Time" : times[order[0], sectors],
+        "Margin" : margin,
+    })
+
+def corner_type_deltas(tensor : LapTensor, reference : int = 0) -> pd.DataFrame:
+    "(team, corner type) time lost (positive) or gained on every corner type relative to the reference lap, in seconds"
+    dt = np.diff(tensor.channel("Time"), axis=1)
+    # Every grid interval is credited to the corner type of its first point
+    one_hot = np.eye(len(CORNER_TYPES))[tensor.corner_types[:-1]]
+    per_type = dt @ one_hot
+    return pd.DataFrame(per_type - per_type[reference], index=tensor.laps["Team"], columns=CORNER_TYPES)
+
+if __name__ == "__main__":
+    if len(argv) in (3, 4):
+        quali_session = load_quali_session(int(argv[1]), int(argv[2]), ARCHIVE_DIR if len(argv) == 4 and argv[3] == "archive" else None)
+        tensor = session_lap_tensor(quali_session)
+        print(f"Lap tensor: {tensor.values.shape[0]} laps x {tensor.values.shape[1]} points x {tensor.values.shape[2]} channels\n")
+        print(corner_type_deltas(tensor).round(3))
+        print()
+        print(mini_sector_winners(tensor).round(3).to_string())
+    else:
+        print("Usage:")
+        print(f"  {argv[0]} year round ['archive'] | per-corner-type deltas to pole and mini-sector winners of a qualifying session")
@@ -0,0 +1,94 @@
+from typing import Optional
+import numpy as np
+import pandas as pd
+from data import CORNER_TYPES
+from telemetry_archive import ArchivedLap
+
+# A LapTrace is the telemetry of a lap as a handful of contiguous numpy arrays (struct of arrays) instead of a
+# fastf1 telemetry DataFrame: distance, time in seconds, speed and throttle in float64 (the analysis channels),
+# the X/Y position in float32 (only used to draw track maps) and the corner type codes (index in CORNER_TYPES)
+# in int8. It is materialized once per lap; the Lap it comes from, and its telemetry DataFrame, can then be
+# dropped. Like fastf1's Lap, the lap metadata (Driver, Team, LapTime...) is accessed by key.
+
+# Telemetry channel name -> LapTrace attribute
+TRACE_CHANNELS = {"Distance" : "distance", "Time" : "time", "Speed" : "speed", "Throttle" : "throttle", "X" : "x", "Y" : "y"}
+
+class LapTrace:
+    "Telemetry of a lap as contiguous arrays, with the metadata of the lap by key like fastf1's Lap"
+    __slots__ = ("metadata", "distance", "time", "speed", "throttle", "x", "y", "codes")
+
+    def __init__(self, metadata, distance : np.ndarray, time : np.ndarray, speed : np.ndarray, throttle : np.ndarray, x : np.ndarray, y : np.ndarray, codes : Optional[np.ndarray] = None):
+        self.metadata = metadata
+        self.distance = np.ascontiguousarray(distance, dtype=np.float64)
+        self.time     = np.ascontiguousarray(time,     dtype=np.float64) # s
+        self.speed    = np.ascontiguousarray(speed,    dtype=np.float64) # km/h
+        self.throttle = np.ascontiguousarray(throttle, dtype=np.float64) # %
+        self.x        = np.ascontiguousarray(x,        dtype=np.float32)
+        self.y        = np.ascontiguousarray(y,        dtype=np.float32)
+        self.codes    = None if codes is None else np.ascontiguousarray(codes, dtype=np.int8) # Set by the labellers
+
+    @classmethod
+    def from_lap(cls, lap) -> "LapTrace":
+        "Materializes the trace of a lap (fastf1, archived or anything with a telemetry DataFrame). CornerType labels are kept as codes"
+        metadata = lap.to_dict() if isinstance(lap, pd.Series) else lap.metadata
+        # Archived laps hold their channels as arrays already, unless their telemetry DataFrame was built (and maybe labelled)
+        if isinstance(lap, ArchivedLap) and "telemetry" not in vars(lap):
+            return cls(metadata, *(lap.channels[channel] for channel in TRACE_CHANNELS))
+
+        telemetry = lap.telemetry
+        codes = None
+        if "CornerType" in telemetry:
+            codes = pd.Categorical(telemetry["CornerType"], categories=CORNER_TYPES).codes
+            if (codes < 0).any():
+                raise KeyError(f"Unknown corner types: {set(telemetry['CornerType'][codes < 0])}")
+        return cls(
+            metadata,
+            telemetry["Distance"].to_numpy(dtype=float),
+            (telemetry["Time"] / np.timedelta64(1, 's')).to_numpy(dtype=float),
+            telemetry["Speed"].to_numpy(dtype=float),
+            telemetry["Throttle"].to_numpy(dtype=float),
+            telemetry["X"].to_numpy(dtype=float),
+            telemetry["Y"].to_numpy(dtype=float),
+            codes,
+        )
+
+    def __getitem__(self, key):
+        return self.metadata[key]
+
+    def get(self, key, default = None):
+        return self.metadata.get(key, default)
+
+    def __len__(self) -> int:
+        return len(self.distance)
+
+    def channel(self, name : str) -> np.ndarray:
+        "Array of a telemetry channel, by its fastf1 name (Time in seconds)"
+        return getattr(self, TRACE_CHANNELS[name])
+
+    def corner_codes(self) -> np.ndarray:
+        "Corner type code (index in CORNER_TYPES) of every sample of a labelled trace"
+        if self.codes is None:
+            raise KeyError("CornerType: the trace isn't labelled (see gen_data.LABELLERS)")
+        return self.codes
+
+    @property
+    def corner_types(self) -> np.ndarray:
+        "Corner type of every sample of a labelled trace"
+        return np.array(CORNER_TYPES, dtype=object)[self.corner_codes()]
+
+    def take(self, indexes : np.ndarray) -> "LapTrace":
+        "Trace of a subset of the samples"
+        return LapTrace(
+            self.metadata,
+            *(getattr(self, attribute)[indexes] for attribute in TRACE_CHANNELS.values()),
+            None if self.codes is None else self.codes[indexes],
+        )
+
+    @property
+    def nbytes(self) -> int:
+        "Memory used by the arrays of the trace"
+        return sum(getattr(self, attribute).nbytes for attribute in TRACE_CHANNELS.values()) + (0 if self.codes is None else self.codes.nbytes)
+
+def lap_trace(lap) -> LapTrace:
+    "The trace of a lap, or the given trace itself"
+    return lap if isinstance(lap, LapTrace) else LapTrace.from_lap(lap)
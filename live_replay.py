@@ -0,0 +1,340 @@
+import base64
+import json
+import time as clock
+import zlib
+from collections import deque
+from datetime import datetime
+from sys import argv
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+import numpy as np
+import pandas as pd
+from fastf1.utils import to_datetime, to_timedelta
+from data import CORNER_LABELS
+from gen_data import LABELLERS, corner_type_performance
+from instrumentation import report, stage
+from lap_batch import lap_distance
+from lap_trace import LapTrace
+
+# Live-timing replay: instead of loading a finished session, a live timing recording (written by fastf1's
+# SignalRClient, `python -m fastf1.livetiming save file.txt`) is consumed line by line as a stream, at the pace it
+# was recorded (or faster). The car and position samples of every driver are kept in rolling buffers of the last
+# BUFFER_SECONDS; when the timing data reports a completed lap that beats the best lap of its team, the lap is
+# cut out of the buffers (its end is the time the lap time was published, its start the end minus the lap time),
+# labelled and broken down by corner type, and only this team's corner type performance is replaced (the lines of
+# the plot_performance_per_car view are then moved in place). Only the current best lap of every team is kept, as
+# a LapTrace. Nothing is downloaded: the corner labels of the session are found in CORNER_LABELS, by its name.
+# The samples are stamped with their own Utc time, ahead of the time their (batched) messages are published. So,
+# like fastf1's Session.t0_date, the time a lap was published is moved to the clock of the samples by the offset of
+# the least delayed sample seen so far.
+
+BUFFER_SECONDS = 240    # s of car and position samples kept per driver, longer than any lap
+MAX_WAIT = 10           # s, a completed lap is processed once its car data arrived, or after this delay
+REDRAW_INTERVAL = 1.0   # s (wall time) between two redraws of the view
+CATEGORIES = {"CarData.z", "Position.z", "TimingData", "DriverList"}
+SPEED_CHANNEL, THROTTLE_CHANNEL = "2", "4"
+
+class LapRecord(NamedTuple):
+    "A completed lap, waiting for its telemetry"
+    driver    : str
+    lap_time  : float # s
+    published : float # s, from the start of the recording, on the clock of the messages
+
+def _fix_json(line : str) -> str:
+    # Recordings hold the repr of the messages, not json (like fastf1's LiveTimingData)
+    return line.replace("'", '"').replace('True', 'true').replace('False', 'false')
+
+def _inflate(data : str) -> Dict:
+    "Decodes the payload of a compressed ('.z') category"
+    return json.loads(zlib.decompress(base64.b64decode(data), -zlib.MAX_WBITS).decode('utf-8-sig'))
+
+def read_recording(path : str, categories : Set[str] = CATEGORIES) -> Iterator[Tuple[str, Dict, datetime]]:
+    "Streams the (category, message, timestamp) of the lines of a live timing recording, skipping the other categories without parsing them"
+    with open(path) as f:
+        for line in f:
+            category = line[2:line.find("'", 2)]
+            if category not in categories:
+                continue
+            try:
+                category, message, timestamp = json.loads(_fix_json(line))
+            except ValueError:
+                continue
+            timestamp = to_datetime(timestamp)
+            if timestamp is None:
+                continue
+            if category.endswith(".z"):
+                message = _inflate(message)
+            yield category, message, timestamp
+
+def find_session_name(year : int, round_number : Optional[int] = None, event_name : Optional[str] = None) -> str:
+    "Name of the qualifying session of CORNER_LABELS matching a year and a round number or an event name (e.g. 'Bahrain Grand Prix')"
+    for name in CORNER_LABELS:
+        prefix, _, rest = name.partition(": ")
+        event, _, session = rest.rpartition(" - ")
+        if (prefix.startswith(f"{year} Season Round ") and session == "Qualifying"
+                and (round_number is None or prefix == f"{year} Season Round {round_number}")
+                and (event_name is None or event == event_name)):
+            return name
+    raise KeyError(f"No corner labels for the {year} {event_name or f'round {round_number}'} qualifying session")
+
+def recording_session_name(path : str) -> str:
+    "Name of the session of CORNER_LABELS a recording was made at, from its SessionInfo message"
+    for _, message, _ in read_recording(path, {"SessionInfo"}):
+        if "Meeting" in message and "StartDate" in message:
+            return find_session_name(int(message["StartDate"][:4]), event_name = message["Meeting"]["Name"])
+    raise KeyError(f"{path} has no SessionInfo message")
+
+def _merge(target : Dict, update : Dict):
+    "Applies an incremental update to a stream state (nested dicts)"
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+
+class SampleBuffer:
+    "Rolling buffer of the last BUFFER_SECONDS of (time, values...) samples of a driver"
+    __slots__ = ("samples",)
+
+    def __init__(self):
+        self.samples = deque()
+
+    def append(self, time : float, *values : float):
+        self.samples.append((time, *values))
+        while self.samples[0][0] < time - BUFFER_SECONDS:
+            self.samples.popleft()
+
+    @property
+    def last_time(self) -> float:
+        return self.samples[-1][0] if self.samples else -np.inf
+
+    def window(self, start : float, end : float) -> np.ndarray:
+        "(sample, column) array of the samples between start and end, time first"
+        rows = [sample for sample in self.samples if start <= sample[0] <= end]
+        return np.array(rows, dtype=float).reshape(len(rows), -1)
+
+class LiveTeamBests:
+    """Incrementally maintained best lap of every team, from a stream of live timing messages
+
+    Args:
+        session_name (Optional[str]): Name of the session in CORNER_LABELS, for the "distance" labelling
+        labelling (str, optional): Corner labelling mode, a key of gen_data.LABELLERS. Defaults to "speed"
+            (no corner labels needed).
+    """
+    def __init__(self, session_name : Optional[str] = None, labelling : str = "speed"):
+        if labelling == "distance" and session_name is None:
+            raise ValueError("The distance labelling needs the name of the session")
+        self.session_name = session_name
+        self.labelling = labelling
+        self.start : Optional[datetime] = None
+        self.drivers : Dict[str, Dict] = {}
+        self.car = {}
+        self.position = {}
+        self.pending : List[LapRecord] = []
+        self.clock_offset : Optional[float] = None # s, sample time - message time of the least delayed sample
+        self.best_laps : Dict[str, LapTrace] = {}
+        self.team_performance : Dict[str, Dict[str, Dict[str, float]]] = {}
+        self.completed_laps = 0
+
+    def seconds(self, timestamp : datetime) -> float:
+        "Time from the start of the recording, in seconds"
+        if self.start is None:
+            self.start = timestamp
+        return (timestamp - self.start).total_seconds()
+
+    def team(self, driver : str) -> str:
+        return self.drivers.get(driver, {}).get("TeamName") or f"#{driver}"
+
+    def sample_time(self, published : float) -> float:
+        "Time on the clock of the samples of an event published at a message time"
+        return published + (self.clock_offset or 0.0)
+
+    def observe_delay(self, sample_time : float, now : float):
+        if self.clock_offset is None or sample_time - now > self.clock_offset:
+            self.clock_offset = sample_time - now
+
+    def best_time(self, team : str) -> float:
+        return self.best_laps[team]["LapTime"].total_seconds() if team in self.best_laps else np.inf
+
+    def feed(self, category : str, message : Dict, timestamp : datetime) -> List[str]:
+        "Processes a message. Returns the teams whose best lap improved"
+        now = self.seconds(timestamp)
+        if category == "CarData.z":
+            for entry in message["Entries"]:
+                t = self.seconds(to_datetime(entry["Utc"]))
+                self.observe_delay(t, now)
+                for driver, car in entry["Cars"].items():
+                    channels = car.get("Channels", {})
+                    if SPEED_CHANNEL in channels and THROTTLE_CHANNEL in channels:
+                        self.car.setdefault(driver, SampleBuffer()).append(t, channels[SPEED_CHANNEL], channels[THROTTLE_CHANNEL])
+        elif category == "Position.z":
+            for sample in message["Position"]:
+                t = self.seconds(to_datetime(sample["Timestamp"]))
+                self.observe_delay(t, now)
+                for driver, position in sample["Entries"].items():
+                    self.position.setdefault(driver, SampleBuffer()).append(t, position["X"], position["Y"])
+        elif category == "DriverList":
+            _merge(self.drivers, {driver : info for driver, info in message.items() if isinstance(info, dict)})
+        elif category == "TimingData":
+            self.on_timing(message, now)
+
+        return self.process_pending(now)
+
+    def on_timing(self, message : Dict, now : float):
+        "Records the laps completed in a TimingData update"
+        for driver, line in message.get("Lines", {}).items():
+            if not isinstance(line, dict):
+                continue
+            last_lap = line.get("LastLapTime")
+            value = last_lap.get("Value") if isinstance(last_lap, dict) else None
+            # The stream only sends what changed: a lap time value is a new lap
+            if not value:
+                continue
+            self.completed_laps += 1
+            lap_time = to_timedelta(value).total_seconds()
+            # Laps that can't beat the best lap of their team are never cut out of the buffers
+            if lap_time < self.best_time(self.team(driver)):
+                self.pending.append(LapRecord(driver, lap_time, now))
+
+    def process_pending(self, now : float) -> List[str]:
+        "Processes the pending laps whose car data arrived (or that waited MAX_WAIT). Returns the teams whose best lap improved"
+        improved = []
+        waiting = []
+        for lap in self.pending:
+            buffer = self.car.get(lap.driver)
+            if (buffer is None or buffer.last_time < self.sample_time(lap.published)) and now < lap.published + MAX_WAIT:
+                waiting.append(lap)
+                continue
+            team = self.team(lap.driver)
+            if lap.lap_time >= self.best_time(team):
+                continue
+            trace = self.lap_trace(lap)
+            if trace is None:
+                continue
+            with stage("label_lap", Driver=lap.driver):
+                LABELLERS[self.labelling](self.session_name, trace)
+            with stage("corner_type_performance", Driver=lap.driver):
+                self.team_performance[team] = corner_type_performance(trace)
+            self.best_laps[team] = trace
+            improved.append(team)
+        self.pending = waiting
+        return improved
+
+    def lap_trace(self, lap : LapRecord) -> Optional[LapTrace]:
+        "Cuts a lap out of the sample buffers of its driver, None if they don't cover it"
+        end = self.sample_time(lap.published)
+        start = end - lap.lap_time
+        car = self.car[lap.driver].window(start, end) if lap.driver in self.car else np.empty((0, 3))
+        if len(car) < 2 or car[0, 0] > start + 1 or car[-1, 0] < end - 1:
+            return None
+        position = self.position[lap.driver].window(start - 1, end + 1) if lap.driver in self.position else np.empty((0, 3))
+
+        time = car[:, 0] - start
+        speed, throttle = car[:, 1], car[:, 2]
+        x, y = (np.interp(car[:, 0], position[:, 0], position[:, i]) if len(position) > 0 else np.zeros(len(car)) for i in (1, 2))
+        metadata = {"Driver" : self.drivers.get(lap.driver, {}).get("Tla", lap.driver), "Team" : self.team(lap.driver), "LapTime" : pd.Timedelta(seconds=lap.lap_time)}
+        return LapTrace(metadata, lap_distance(np.zeros(len(time), dtype=np.int64), time, speed), time, speed, throttle, x, y)
+
+    @property
+    def nbytes(self) -> int:
+        "Memory used by the traces of the best laps"
+        return sum(trace.nbytes for trace in self.best_laps.values())
+
+def replay(path : str, session_name : Optional[str] = None, labelling : str = "speed", pace : float = 1.0, plot : bool = True) -> LiveTeamBests:
+    """Replays a live timing recording, updating the best lap of every team and the plot_performance_per_car view as laps complete
+
+    Args:
+        path (str): Live timing recording (fastf1's SignalRClient output)
+        session_name (Optional[str], optional): Name of the session in CORNER_LABELS, for the "distance" labelling
+        labelling (str, optional): Corner labelling mode, a key of gen_data.LABELLERS. Defaults to "speed".
+        pace (float, optional): Replay speed relative to the recording (1: real time, 0: as fast as possible). Defaults to 1.
+        plot (bool, optional): Show the live plot_performance_per_car view. Defaults to True.
+
+    Returns:
+        LiveTeamBests: The final state
+    """
+    state = LiveTeamBests(session_name, labelling)
+    if plot:
+        from matplotlib import pyplot as plt
+        from trackviz import draw_performance_per_car, update_performance_per_car
+        plt.ion()
+        fig, ax = plt.subplots(figsize=(8, 6))
+        lines = None
+
+    wall_start = clock.perf_counter()
+    last_redraw = -np.inf
+    changed = False
+    max_lag = 0.0
+    processing = 0.0
+    for category, message, timestamp in read_recording(path):
+        now = state.seconds(timestamp)
+        if pace > 0:
+            # Wait for the time the message was received at, relative to the start of the replay
+            delay = now / pace - (clock.perf_counter() - wall_start)
+            if delay > 0:
+                clock.sleep(delay)
+            max_lag = max(max_lag, -delay)
+
+        t0 = clock.perf_counter()
+        improved = state.feed(category, message, timestamp)
+        processing += clock.perf_counter() - t0
+        for team in improved:
+            print(f"[{now:8.1f}s] {team}: {state.best_laps[team]['Driver']} {state.best_laps[team]['LapTime'].total_seconds():.3f}s")
+        changed = changed or len(improved) > 0
+
+        if plot and changed and clock.perf_counter() - last_redraw >= REDRAW_INTERVAL:
+            with stage("update_performance_per_car"):
+                if lines is None:
+                    lines = draw_performance_per_car(state.team_performance, ax)
+                else:
+                    update_performance_per_car(state.team_performance, ax, lines)
+                ax.set_title(f"Best laps at {now / 60:.1f} min")
+                plt.pause(0.001)
+            last_redraw = clock.perf_counter()
+            changed = False
+
+    improved = state.process_pending(np.inf)
+    if plot and (changed or improved):
+        if lines is None:
+            draw_performance_per_car(state.team_performance, ax)
+        else:
+            update_performance_per_car(state.team_performance, ax, lines)
+        plt.pause(0.001)
+
+    elapsed = clock.perf_counter() - wall_start
+    print(f"{state.completed_laps} laps completed, {len(state.best_laps)} team best laps ({state.nbytes / 1024:.0f} KB of telemetry kept)")
+    print(f"Replayed in {elapsed:.1f}s, {processing:.2f}s spent processing messages, max lag behind the recording {max_lag:.2f}s")
+    if plot:
+        plt.ioff()
+        plt.show()
+    return state
+
+if __name__ == "__main__":
+    options = {"labelling" : "speed", "pace" : 1.0, "plot" : True}
+    positional = []
+    labels = False
+    for arg in argv[1:]:
+        if arg.startswith("pace="):
+            options["pace"] = float(arg[len("pace="):])
+        elif arg == "noplot":
+            options["plot"] = False
+        elif arg == "labels":
+            labels = True
+        else:
+            positional.append(arg)
+
+    if len(positional) in (1, 3):
+        # The corner labels of a session are looked up by its name (as given by fastf1), without any download
+        if len(positional) == 3:
+            options["session_name"] = find_session_name(int(positional[1]), int(positional[2]))
+        elif labels:
+            options["session_name"] = recording_session_name(positional[0])
+        if "session_name" in options:
+            print(f"Corner labels of '{options['session_name']}'")
+            options["labelling"] = "distance"
+        replay(positional[0], **options)
+        report()
+    else:
+        print("Usage:")
+        print(f"  {argv[0]} recording.txt [year round | labels] [pace=1] [noplot]")
+        print("  Corners are classified with the labels of the session (given by year and round, or found from the SessionInfo")
+        print("  of the recording with 'labels'), otherwise by speed band (no corner labels needed)")
@@ -0,0 +1,52 @@
+import hashlib
+import json
+import os
+from typing import Any, Optional
+from data import CORNER_LABELS
+
+RESULTS_CACHE_DIR = os.path.join('cache', 'results')
+
+def corner_labels_hash(session_name : str) -> str:
+    "Hash of the corner labels of a session, so that editing them invalidates its cached results."
+    labels = CORNER_LABELS.get(session_name)
+    return hashlib.sha256(json.dumps(labels).encode()).hexdigest()
+
+class ResultCache:
+    """Persistent, content-addressed store for the per-session results of the data generation scripts.
+
+    Every entry is a JSON file named after the hash of its key, written as soon as the session is processed,
+    so that a rerun only recomputes the sessions whose inputs changed and an interrupted run can be resumed.
+    """
+    def __init__(self, namespace : str, directory : str = RESULTS_CACHE_DIR):
+        self.directory = os.path.join(directory, namespace)
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, *parts) -> str:
+        "Builds a cache key out of JSON serializable parts (session identity, label hash, code version...)"
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def _path(self, key : str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key : str) -> Optional[Any]:
+        "Returns the cached value of the key, or None if it isn't cached. Counts hits and misses."
+        try:
+            with open(self._path(key)) as f:
+                value = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key : str, value : Any):
+        "Stores a JSON serializable value. The file is written atomically, so an interrupted run can't corrupt it."
+        tmp_path = self._path(key) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, self._path(key))
+
+    def report(self):
+        print(f"Result cache ({self.directory}): {self.hits} hits, {self.misses} misses")
@@ -0,0 +1,92 @@
+from typing import List, NamedTuple, Optional, Tuple
+import numpy as np
+import pandas as pd
+from data import CORNER_TYPES
+
+# Season cube: the cornering performance data of a season as a dense (session x team x corner type x
+# {Distance, Time}) array, with its cumulative sums over the sessions. The totals of any window of consecutive
+# sessions are then the difference of two prefix sums, so speed matrices of arbitrary or rolling windows don't
+# regroup the data table. A team without data in a session contributes zeros to it.
+
+CUBE_CHANNELS = ["Distance", "Time"]
+
+class SeasonCube(NamedTuple):
+    sessions : np.ndarray # SessionNumber of every session, sorted
+    gp_names : np.ndarray # GP name of every session
+    teams    : np.ndarray
+    values   : np.ndarray # (session, team, corner type, channel) totals, channels ordered as in CUBE_CHANNELS
+    prefix   : np.ndarray # (session + 1, team, corner type, channel) cumulative sums of values, prefix[0] = 0
+
+def build_season_cube(data : pd.DataFrame) -> SeasonCube:
+    "Builds the season cube of cornering performance data (Distance, Time, CornerType, Team, GPName and SessionNumber columns)"
+    sessions, session_index = np.unique(data["SessionNumber"].to_numpy(dtype=int), return_inverse=True)
+    teams, team_index = np.unique(data["Team"].to_numpy().astype(str), return_inverse=True)
+    type_index = pd.Categorical(data["CornerType"], categories=CORNER_TYPES).codes
+    if (type_index < 0).any():
+        raise KeyError(f"Unknown corner types: {set(data['CornerType'][type_index < 0])}")
+
+    values = np.zeros((len(sessions), len(teams), len(CORNER_TYPES), len(CUBE_CHANNELS)))
+    np.add.at(values, (session_index, team_index, type_index), data[CUBE_CHANNELS].to_numpy(dtype=float))
+    prefix = np.concatenate([np.zeros((1, *values.shape[1:])), np.cumsum(values, axis=0)])
+
+    gp_names = np.empty(len(sessions), dtype=object)
+    gp_names[session_index] = data["GPName"].to_numpy()
+    return SeasonCube(sessions, gp_names, teams, values, prefix)
+
+def window_bounds(cube : SeasonCube, first : Optional[int] = None, last : Optional[int] = None) -> Tuple[int, int]:
+    "Cube slice [start, stop) of the sessions numbered first to last (inclusive, open-ended if None)"
+    start = 0 if first is None else int(np.searchsorted(cube.sessions, first, side='left'))
+    stop = len(cube.sessions) if last is None else int(np.searchsorted(cube.sessions, last, side='right'))
+    return start, max(start, stop)
+
+def window_totals(cube : SeasonCube, first : Optional[int] = None, last : Optional[int] = None) -> np.ndarray:
+    "(team, corner type, channel) totals of the sessions numbered first to last (inclusive), from the prefix sums"
+    start, stop = window_bounds(cube, first, last)
+    return cube.prefix[stop] - cube.prefix[start]
+
+def rolling_totals(cube : SeasonCube, n : int) -> np.ndarray:
+    "(window, team, corner type, channel) totals of every window of n consecutive sessions of the cube"
+    n = min(n, len(cube.sessions))
+    return cube.prefix[n:] - cube.prefix[:-n] if n > 0 else np.zeros((0, *cube.values.shape[1:]))
+
+def totals_speeds(totals : np.ndarray) -> np.ndarray:
+    "Average speeds of (..., corner type, channel) totals, NaN where no time was recorded"
+    distance, time = totals[..., 0], totals[..., 1]
+    return np.divide(distance, time, out=np.full(distance.shape, np.nan), where=time > 0)
+
+def relative_speeds(speeds : np.ndarray) -> np.ndarray:
+    "(..., team, corner type) speeds as a ratio of the average speed of the teams on each corner type (like cornering_performance.relative_speed_matrix)"
+    present = ~np.isnan(speeds)
+    counts = present.sum(axis=-2, keepdims=True)
+    averages = np.divide(np.where(present, speeds, 0).sum(axis=-2, keepdims=True), counts, out=np.full(counts.shape, np.nan), where=counts > 0)
+    return speeds / averages
+
+def window_speed_matrix(cube : SeasonCube, first : Optional[int] = None, last : Optional[int] = None) -> pd.DataFrame:
+    "(team x corner type) speed matrix of the sessions numbered first to last, like cornering_performance.speed_matrix of these sessions"
+    totals = window_totals(cube, first, last)
+    has_data = totals[:, :, 1].sum(axis=1) > 0
+    return pd.DataFrame(totals_speeds(totals)[has_data], index=pd.Index(cube.teams[has_data], name="Team"), columns=pd.Index(CORNER_TYPES, name="CornerType"))
+
+def window_title(cube : SeasonCube, first : Optional[int] = None, last : Optional[int] = None) -> str:
+    "Title of a window, from the GP names of its first and last sessions (e.g. 'Bahrain-Canada')"
+    start, stop = window_bounds(cube, first, last)
+    if stop == start:
+        return "No session"
+    names = [str(cube.gp_names[i]).strip().replace(" Grand Prix", "") for i in (start, stop - 1)]
+    return names[0] if stop - start == 1 else f"{names[0]}-{names[1]}"
+
+def rolling_speed_deltas(cube : SeasonCube, n : int) -> Tuple[List[str], np.ndarray]:
+    """Speed delta of every team to the average on every corner type, over every window of n consecutive sessions
+
+    Args:
+        cube (SeasonCube): Season cube
+        n (int): Number of sessions of every window
+
+    Returns:
+        Tuple[List[str], np.ndarray]: Title of every window and the (window, team, corner type) deltas, in % of the
+            average speed (NaN for the teams without data in a window), ready to be animated
+    """
+    n = min(n, len(cube.sessions))
+    deltas = (relative_speeds(totals_speeds(rolling_totals(cube, n))) - 1) * 100
+    titles = [window_title(cube, cube.sessions[i], cube.sessions[i + n - 1]) for i in range(len(deltas))]
+    return titles, deltas
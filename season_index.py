@@ -0,0 +1,135 @@
+import json
+import os
+from sys import argv
+from typing import Dict, Iterator, List, Optional, Set
+import fastf1 as ff1
+from instrumentation import stage
+from telemetry_archive import ArchivedSession, load_session_archive
+
+# The season index records, for every qualifying session of a season, what the scripts need to know before
+# loading it: its name, the tyre compounds used (and so whether it was wet) and which data is available.
+# It is built once per season (loading only the laps of each session) and persisted, so that discovering the
+# rounds of a season and skipping the wet ones doesn't require probing or loading any session.
+
+SEASON_INDEX_DIR = os.path.join('cache', 'season_index')
+MAX_ROUNDS = 29
+WET_COMPOUNDS = {'INTERMEDIATE', 'WET'}
+
+ff1.Cache.enable_cache('cache')
+
+def index_path(year : int, archive_dir : Optional[str] = None) -> str:
+    name = f"{year}.json" if archive_dir is None else f"{year}_archive.json"
+    return os.path.join(SEASON_INDEX_DIR, name)
+
+def load_quali_session(year : int, round_number : int, archive_dir : Optional[str] = None, laps_only : bool = False) -> Optional[ff1.core.Session]:
+    "Loads a qualifying session with fastf1, or from its telemetry archive. Returns None if it doesn't exist"
+    if archive_dir is not None:
+        with stage("load_archive", Year=year, Round=round_number):
+            return load_session_archive(archive_dir, year, round_number)
+    with stage("load_laps" if laps_only else "load", Year=year, Round=round_number):
+        try:
+            quali_session = ff1.get_session(year, round_number, 'Q')
+            print(f"Loading {quali_session}")
+            if laps_only:
+                quali_session.load(laps=True, telemetry=False, weather=False, messages=False)
+            else:
+                quali_session.load()
+        except ValueError:
+            return None
+        except ff1.core.DataNotLoadedError:
+            return None
+    return quali_session
+
+def index_entry(year : int, round_number : int, session : ff1.core.Session) -> Dict:
+    "Index entry of a loaded (or archived) qualifying session"
+    if isinstance(session, ArchivedSession):
+        compounds = session.compounds
+        has_laps = has_telemetry = len(session.laps) > 0
+    else:
+        compounds = set(session.laps["Compound"].dropna())
+        has_laps = len(session.laps) > 0
+        has_telemetry = bool(session.f1_api_support)
+
+    return {
+        "Year" : year,
+        "RoundNumber" : round_number,
+        "EventName" : str(session.event["EventName"]),
+        "Session" : str(session),
+        "Compounds" : sorted(str(c) for c in compounds),
+        "Wet" : len(WET_COMPOUNDS.intersection(compounds)) > 0,
+        "HasLaps" : has_laps,
+        "HasTelemetry" : has_telemetry,
+    }
+
+def build_season_index(year : int, archive_dir : Optional[str] = None, index : Optional[Dict] = None) -> Dict:
+    """Builds (or extends) the index of the qualifying sessions of a season
+
+    Args:
+        year (int): Season to index
+        archive_dir (Optional[str], optional): Index the telemetry archives in this directory instead of the fastf1 sessions
+        index (Optional[Dict], optional): Incomplete index to extend, e.g. of a season that is still running
+
+    Returns:
+        Dict: {"Year", "Complete" (False if the last rounds have no data yet), "Rounds" : list of index entries}
+    """
+    rounds : List[Dict] = [] if index is None else index["Rounds"]
+    complete = True
+    for i in range(len(rounds) + 1, MAX_ROUNDS + 1):
+        if archive_dir is None:
+            try:
+                ff1.get_session(year, i, 'Q')
+            except ValueError:
+                break
+        session = load_quali_session(year, i, archive_dir, laps_only = True)
+        if session is None:
+            # The round exists but has no data (yet), so the index must be extended later on
+            complete = archive_dir is not None
+            break
+        rounds.append(index_entry(year, i, session))
+
+    return {"Year" : year, "Complete" : complete, "Rounds" : rounds}
+
+def get_season_index(year : int, archive_dir : Optional[str] = None, rebuild : bool = False) -> Dict:
+    "Gets the persisted index of a season, building it (or extending it, if the season wasn't over) when needed"
+    path = index_path(year, archive_dir)
+    index = None
+    if not rebuild and os.path.exists(path):
+        with open(path) as f:
+            index = json.load(f)
+        if index["Complete"]:
+            return index
+
+    index = build_season_index(year, archive_dir, index)
+    os.makedirs(SEASON_INDEX_DIR, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(index, f, indent=4)
+    return index
+
+def iter_quali_rounds(year : int, force_include : Set[str] = set(), archive_dir : Optional[str] = None) -> Iterator[Dict]:
+    "Iterates over the index entries of the dry qualifying sessions of a season (and of the wet ones in force_include)"
+    for entry in get_season_index(year, archive_dir)["Rounds"]:
+        if entry["Wet"] and entry["Session"] not in force_include:
+            print(f"Wet weather tyres were used in {entry['Session']}. Skipping this event")
+            continue
+        if not entry["HasLaps"] or not entry["HasTelemetry"]:
+            print(f"No {'laps' if not entry['HasLaps'] else 'telemetry'} available for {entry['Session']}. Skipping this event")
+            continue
+        yield entry
+
+def iter_quali_sessions(year : int, force_include : Set[str] = set(), archive_dir : Optional[str] = None) -> Iterator[ff1.core.Session]:
+    "Loads and iterates over the dry qualifying sessions of a season (and the wet ones in force_include)"
+    for entry in iter_quali_rounds(year, force_include, archive_dir):
+        session = load_quali_session(year, entry["RoundNumber"], archive_dir)
+        if session is None:
+            print(f"Could not load {entry['Session']}. Skipping this event")
+            continue
+        yield session
+
+if __name__ == "__main__":
+    if len(argv) == 3 and argv[1] == "build":
+        index = get_season_index(int(argv[2]), rebuild = True)
+        for entry in index["Rounds"]:
+            print(f"{entry['RoundNumber']:>2} {entry['Session']:<70} {'WET' if entry['Wet'] else 'DRY'} {entry['Compounds']}")
+    else:
+        print("Usage:")
+        print(f"  {argv[0]} build year | (re)builds the qualifying session index of a season")
@@ -0,0 +1,159 @@
+import html
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sys import argv
+from typing import Dict, List, Optional, Set
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+from gen_data import RESULTS_VERSION, session_cache_key
+from instrumentation import collect_stages, merge_stages, report, stage
+from result_cache import ResultCache, corner_labels_hash
+from season_index import iter_quali_rounds, load_quali_session
+from telemetry_archive import ARCHIVE_DIR, archive_path
+from trackviz import track_stats_figure
+
+# Headless season reports: the show_track_stats grid of every dry qualifying session of a season is rendered
+# with the Agg backend (no display needed) to image files, one worker process per round, and an index.html page
+# links them all. The inputs of every rendered round (session, corner labels, labelling mode, archive file,
+# output formats...) are recorded in a ResultCache, so rerunning the report only renders the rounds that changed.
+# A round that fails to load or render is listed as such in the index page, without stopping the other rounds.
+
+REPORTS_DIR = "reports"
+FORMATS = ["png"]
+REPORT_VERSION = 1
+
+def round_inputs_key(cache : ResultCache, entry : Dict, directory : str, formats : List[str], force_include : Set[str] = set(), archive_dir : Optional[str] = None, labelling : str = "distance") -> str:
+    "Cache key of the report of a round: its session cache key and index entry, corner labels, results version, archive file state, output directory and formats"
+    archive = None
+    if archive_dir is not None:
+        path = archive_path(archive_dir, entry["Year"], entry["RoundNumber"])
+        archive = [os.path.getmtime(path), os.path.getsize(path)] if os.path.exists(path) else None
+    return cache.key(
+        session_cache_key(cache, entry, force_include, archive_dir is not None, labelling),
+        entry,
+        # The corner panels use the corner labels whatever the labelling mode
+        corner_labels_hash(entry["Session"]),
+        RESULTS_VERSION,
+        archive,
+        os.path.abspath(directory),
+        sorted(formats),
+        REPORT_VERSION,
+    )
+
+def round_files(entry : Dict, formats : List[str]) -> List[str]:
+    return [f"{entry['Year']}_{entry['RoundNumber']:02d}_Q.{extension}" for extension in formats]
+
+def render_round(entry : Dict, directory : str, formats : List[str], archive_dir : Optional[str] = None, labelling : str = "distance") -> Optional[List[str]]:
+    "Renders the track stats grid of a round to one file per format. Returns the file names, or None if the session couldn't be loaded"
+    session = load_quali_session(entry["Year"], entry["RoundNumber"], archive_dir)
+    if session is None:
+        return None
+
+    with stage("render", Year=entry["Year"], Round=entry["RoundNumber"]):
+        fig = track_stats_figure(session, labelling = labelling)
+        fig.suptitle(entry["Session"])
+        files = round_files(entry, formats)
+        for name in files:
+            fig.savefig(os.path.join(directory, name), bbox_inches="tight")
+        plt.close(fig)
+
+    return files
+
+def write_index_page(directory : str, year : int, rounds : List[Dict], failures : List[Dict] = []):
+    "Writes index.html, linking the rendered files of every round (the first format is shown inline) and listing the rounds that failed"
+    sections = []
+    for entry in rounds:
+        files = entry["Files"]
+        links = " | ".join(f'<a href="{html.escape(name)}">{html.escape(name.rsplit(".", 1)[1].upper())}</a>' for name in files)
+        image = f'<a href="{html.escape(files[0])}"><img src="{html.escape(files[0])}" width="800"></a>' if files[0].endswith((".png", ".svg")) else ""
+        sections.append(f"<h2>Round {entry['RoundNumber']}: {html.escape(entry['EventName'])}</h2>\n<p>{links}</p>\n{image}")
+    if len(failures) > 0:
+        items = "\n".join(f"<li>Round {entry['RoundNumber']}: {html.escape(entry['EventName'])} ({html.escape(entry['Error'])})</li>" for entry in failures)
+        sections.append(f"<h2>Failed rounds</h2>\n<ul>\n{items}\n</ul>")
+
+    with open(os.path.join(directory, "index.html"), "w") as f:
+        f.write(f"<!DOCTYPE html>\n<html>\n<head><meta charset=\"utf-8\"><title>{year} qualifying report</title></head>\n<body>\n")
+        f.write(f"<h1>{year} qualifying report</h1>\n")
+        f.write("\n".join(sections))
+        f.write("\n</body>\n</html>\n")
+
+def render_season_report(year : int, directory : str = REPORTS_DIR, formats : List[str] = FORMATS, workers : Optional[int] = None, force_include : Set[str] = {'2023 Season Round 10: British Grand Prix - Qualifying',}, archive_dir : Optional[str] = None, labelling : str = "distance", force : bool = False) -> str:
+    """Renders the track stats of every dry qualifying session of a season to files, with an index page
+
+    Args:
+        year (int): Season to render
+        directory (str, optional): Output directory. Defaults to REPORTS_DIR/year.
+        formats (List[str], optional): File formats (png, svg, pdf). Defaults to png.
+        workers (Optional[int], optional): Number of worker processes. Defaults to the number of cores.
+        force_include (Set[str], optional): Sessions to render even if wet weather tyres were used
+        archive_dir (Optional[str], optional): Read the sessions from the telemetry archives in this directory instead of loading them with fastf1
+        labelling (str, optional): Corner labelling mode, a key of gen_data.LABELLERS. Defaults to "distance".
+        force (bool, optional): Render every round, even the unchanged ones. Defaults to False.
+
+    Returns:
+        str: Path of the index page
+    """
+    directory = os.path.join(directory, str(year))
+    os.makedirs(directory, exist_ok=True)
+    cache = ResultCache("season_reports")
+
+    entries = {entry["RoundNumber"] : entry for entry in iter_quali_rounds(year, force_include, archive_dir)}
+    keys = {i : round_inputs_key(cache, entry, directory, formats, force_include, archive_dir, labelling) for i, entry in entries.items()}
+    files = {}
+    for i, entry in entries.items():
+        cached = None if force else cache.get(keys[i])
+        if cached is not None and all(os.path.exists(os.path.join(directory, name)) for name in cached):
+            files[i] = cached
+    pending = [i for i in entries if i not in files]
+    print(f"Rendering {len(pending)} of {len(entries)} rounds")
+
+    errors = {}
+    if len(pending) > 0:
+        with ProcessPoolExecutor(max_workers = min(len(pending), workers or os.cpu_count())) as executor:
+            futures = {executor.submit(collect_stages, render_round, entries[i], directory, formats, archive_dir, labelling) : i for i in pending}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    rendered, stages = future.result()
+                except Exception as error:
+                    errors[i] = f"{type(error).__name__}: {error}"
+                    print(f"Round {i} failed: {errors[i]}")
+                    continue
+                merge_stages(stages)
+                if rendered is None:
+                    errors[i] = "the session couldn't be loaded"
+                    continue
+                files[i] = rendered
+                cache.put(keys[i], rendered)
+
+    cache.report()
+    rounds = [{**entries[i], "Files" : files[i]} for i in sorted(files)]
+    failures = [{**entries[i], "Error" : errors[i]} for i in sorted(errors)]
+    write_index_page(directory, year, rounds, failures)
+    return os.path.join(directory, "index.html")
+
+if __name__ == "__main__":
+    options = {"archive_dir" : None, "labelling" : "distance", "formats" : FORMATS, "workers" : None, "force" : False}
+    positional = []
+    for arg in argv[1:]:
+        if arg == "archive":
+            options["archive_dir"] = ARCHIVE_DIR
+        elif arg == "speed":
+            options["labelling"] = "speed"
+        elif arg == "force":
+            options["force"] = True
+        elif arg.startswith("formats="):
+            options["formats"] = arg[len("formats="):].lower().split(",")
+        elif arg.startswith("workers="):
+            options["workers"] = int(arg[len("workers="):])
+        else:
+            positional.append(arg)
+
+    if len(positional) in (1, 2) and positional[0].isdigit():
+        index_page = render_season_report(int(positional[0]), *positional[1:], **options)
+        print(f"Report written to {index_page}")
+        report()
+    else:
+        print("Usage:")
+        print(f"  {argv[0]} year [directory] [formats=png,svg,pdf] [workers=N] [archive] [speed] [force]")
@@ -0,0 +1,92 @@
+import warnings
+from functools import cached_property
+from typing import Dict, List, Union
+import fastf1 as ff1
+import numpy as np
+from gen_data import LABELLERS, corner_performance_batch, corner_type_performance, get_team_fastest_laps
+from instrumentation import stage
+from lap_grid import LapTensor, lap_tensor
+from lap_trace import LapTrace
+
+# A SessionAnalysis holds everything the trackviz panels compute from a session: the fastest lap of every team,
+# the labelled traces of these laps (and of the pole lap), their corner breakdowns and lap tensor. Every item
+# is computed on first access and kept, so a grid of panels sharing one analysis runs each heavy step once.
+# Only the LapTrace of every lap is kept, not the Lap itself, so fastf1's telemetry DataFrames are freed.
+
+class NoTelemetryError(ValueError):
+    "fastf1 couldn't build the telemetry of a lap"
+
+class SessionAnalysis:
+    "Lazily computed, memoized analysis of a qualifying session, shared by the trackviz panels"
+    def __init__(self, session : ff1.core.Session, labelling : str = "distance"):
+        self.session = session
+        self.labelling = labelling
+        self.name = str(session)
+        self._traces = {}
+        self._performance = {}
+
+    @cached_property
+    def fastest_laps(self) -> ff1.core.Laps:
+        "Output of gen_data.get_team_fastest_laps"
+        with stage("team_fastest_laps", Session=self.name):
+            return get_team_fastest_laps(self.session)
+
+    def trace(self, lap : ff1.core.Lap) -> LapTrace:
+        "Labelled trace of a lap of the session (materialized and labelled once per lap)"
+        key = (lap["Driver"], lap["LapNumber"])
+        if key not in self._traces:
+            try:
+                trace = LapTrace.from_lap(lap)
+            except (ValueError, ff1.core.DataNotLoadedError) as error:
+                # fastf1 fails to merge the car and position data of some laps (missing or misaligned samples)
+                raise NoTelemetryError(f"No telemetry for lap {lap['LapNumber']:.0f} of {lap['Driver']} in {self.name}: {error}") from error
+            with stage("label_lap", Session=self.name, Driver=lap["Driver"]):
+                LABELLERS[self.labelling](self.session, trace)
+            self._traces[key] = trace
+        return self._traces[key]
+
+    @cached_property
+    def team_traces(self) -> List[LapTrace]:
+        "Labelled traces of the fastest lap of every team, sorted by lap time (laps without telemetry are left out, with a warning)"
+        traces = []
+        for _, lap in self.fastest_laps.iterlaps():
+            try:
+                traces.append(self.trace(lap))
+            except NoTelemetryError as error:
+                warnings.warn(f"{lap['Team']} left out: {error}")
+        if len(traces) == 0:
+            raise NoTelemetryError(f"No team has a lap with telemetry in {self.name}")
+        return traces
+
+    @cached_property
+    def pole_lap(self) -> LapTrace:
+        "Labelled trace of the fastest (legal) lap of the session, shared with team_traces when it is the fastest lap of its team"
+        return self.trace(self.session.laps.pick_fastest())
+
+    def performance(self, trace : LapTrace) -> Dict[str, Dict[str, float]]:
+        "gen_data.corner_type_performance of a trace of the session (computed once)"
+        if id(trace) not in self._performance:
+            with stage("corner_type_performance", Session=self.name, Driver=trace["Driver"]):
+                self._performance[id(trace)] = corner_type_performance(trace)
+        return self._performance[id(trace)]
+
+    @cached_property
+    def team_performance(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        "Corner type performance of the fastest lap of every team, by team"
+        return {trace["Team"] : self.performance(trace) for trace in self.team_traces}
+
+    @cached_property
+    def lap_tensor(self) -> LapTensor:
+        "The team fastest laps resampled on a common distance grid (see lap_grid)"
+        with stage("lap_tensor", Session=self.name):
+            return lap_tensor(self.session, self.team_traces, labelling = self.labelling)
+
+    @cached_property
+    def corner_breakdown(self) -> np.ndarray:
+        "(team lap, corner, channel) per-corner breakdown of the team fastest laps (see gen_data.corner_performance_batch)"
+        with stage("corner_performance", Session=self.name):
+            return corner_performance_batch(self.session, self.team_traces)
+
+def session_analysis(session : Union[ff1.core.Session, SessionAnalysis], labelling : str = "distance") -> SessionAnalysis:
+    "The analysis of a session, or the given analysis itself (keeping its own labelling mode)"
+    return session if isinstance(session, SessionAnalysis) else SessionAnalysis(session, labelling)
@@ -0,0 +1,239 @@
+import os
+import zipfile
+from functools import cached_property
+from sys import argv
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+import numpy as np
+import pandas as pd
+from columnar import load_npz_member
+
+# A telemetry archive holds everything the analysis scripts need from a qualifying session, so that they can run
+# without loading it through fastf1: the fastest lap of every team, the fastest lap of the session, and the
+# compounds used in the session. The traces of all the laps are concatenated into one float32 array per channel
+# (struct of arrays), lap i spanning offsets[i]:offsets[i + 1]. Archives are uncompressed .npz files, so the
+# channels are memory-mapped on load.
+
+ARCHIVE_DIR = os.path.join('cache', 'archive')
+CHANNELS = ["Distance", "Time", "Speed", "Throttle", "X", "Y"]
+TIME_COLUMNS = ["LapTime", "LegalLapTime", "LapTimeDelta"]
+
+SESSION_KEY   = "session"
+COMPOUNDS_KEY = "compounds"
+OFFSETS_KEY   = "offsets"
+LAPS_PREFIX    = "laps:"
+CHANNEL_PREFIX = "channel:"
+
+def archive_path(directory : str, year : int, round_number : int) -> str:
+    return os.path.join(directory, f"{year}_{round_number:02d}_Q.npz")
+
+def _seconds(value) -> float:
+    "Lap time in seconds of a timedelta, a lap or a missing value"
+    if isinstance(value, pd.Series):
+        value = value.get("LapTime")
+    if value is None or pd.isnull(value):
+        return np.nan
+    return value / np.timedelta64(1, 's')
+
+def write_session_archive(session, team_fastest_laps, path : str):
+    """Extracts the team fastest laps and the fastest lap of a loaded session into a telemetry archive
+
+    Args:
+        session (ff1.core.Session): Loaded qualifying session
+        team_fastest_laps (ff1.core.Laps): Output of gen_data.get_team_fastest_laps
+        path (str): Path of the archive
+    """
+    session_fastest = session.laps.pick_fastest()
+    laps = [(lap, True) for _, lap in team_fastest_laps.iterlaps()]
+    is_session_fastest = [lap["Driver"] == session_fastest["Driver"] and lap["LapNumber"] == session_fastest["LapNumber"] for lap, _ in laps]
+    if not any(is_session_fastest):
+        laps.append((session_fastest, False))
+        is_session_fastest.append(True)
+
+    telemetry = []
+    metadata = []
+    for (lap, team_fastest), session_fastest_flag in zip(laps, is_session_fastest):
+        try:
+            trace = lap.telemetry
+        except ValueError:
+            print(f"No telemetry for {lap['Driver']}, skipping this lap")
+            continue
+        telemetry.append(np.column_stack([
+            trace["Distance"].to_numpy(dtype=float),
+            (trace["Time"] / np.timedelta64(1, 's')).to_numpy(dtype=float),
+            trace["Speed"].to_numpy(dtype=float),
+            trace["Throttle"].to_numpy(dtype=float),
+            trace["X"].to_numpy(dtype=float),
+            trace["Y"].to_numpy(dtype=float),
+        ]).astype(np.float32))
+        metadata.append({
+            "Driver" : str(lap["Driver"]),
+            "Team" : str(lap["Team"]),
+            "LapNumber" : float(lap["LapNumber"]),
+            "Compound" : str(lap["Compound"]),
+            "IsPersonalBest" : lap["IsPersonalBest"] == True,
+            "LapTime" : _seconds(lap["LapTime"]),
+            "LegalLapTime" : _seconds(lap.get("LegalLapTime")) if team_fastest else np.nan,
+            "LapTimeDelta" : _seconds(lap.get("LapTimeDelta")) if team_fastest else np.nan,
+            "TeamFastest" : team_fastest,
+            "SessionFastest" : session_fastest_flag,
+        })
+
+    metadata = pd.DataFrame(metadata)
+    channels = np.concatenate(telemetry) if telemetry else np.zeros((0, len(CHANNELS)), dtype=np.float32)
+    arrays = {
+        SESSION_KEY   : np.array([str(session), session.event["EventName"], str(session.event.year), str(session.event["RoundNumber"])]),
+        COMPOUNDS_KEY : np.array(sorted(str(c) for c in set(session.laps["Compound"]))),
+        OFFSETS_KEY   : np.concatenate([[0], np.cumsum([len(t) for t in telemetry])]).astype(np.int64),
+    }
+    for column in metadata.columns:
+        values = metadata[column].to_numpy()
+        arrays[LAPS_PREFIX + column] = values.astype(str) if values.dtype == object else values
+    for i, channel in enumerate(CHANNELS):
+        arrays[CHANNEL_PREFIX + channel] = np.ascontiguousarray(channels[:, i])
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    np.savez(path, **arrays)
+
+class ArchivedEvent(dict):
+    "Event information of an archived session (EventName, RoundNumber and year, like fastf1's Event)"
+    def __init__(self, event_name : str, year : int, round_number : int):
+        super().__init__(EventName=event_name, RoundNumber=round_number)
+        self.year = year
+
+class ArchivedLap:
+    "A lap of a telemetry archive, exposing its metadata by key and its trace as `telemetry`, like fastf1's Lap"
+    def __init__(self, metadata : pd.Series, channels : Dict[str, np.ndarray]):
+        self.metadata = metadata
+        self.channels = channels
+
+    def __getitem__(self, key):
+        return self.metadata[key]
+
+    def get(self, key, default = None):
+        return self.metadata.get(key, default)
+
+    @cached_property
+    def telemetry(self) -> pd.DataFrame:
+        telemetry = pd.DataFrame({channel : self.channels[channel].astype(float) for channel in CHANNELS})
+        telemetry["Time"] = pd.to_timedelta(self.channels["Time"].astype(float), unit='s')
+        return telemetry
+
+class ArchivedLaps:
+    "A set of laps of a telemetry archive, with the subset of fastf1's Laps interface used by the analysis scripts"
+    def __init__(self, metadata : pd.DataFrame, session : "ArchivedSession"):
+        self.metadata = metadata
+        self.session = session
+
+    def __len__(self) -> int:
+        return len(self.metadata)
+
+    def __getitem__(self, column : str) -> pd.Series:
+        return self.metadata[column]
+
+    @property
+    def index(self) -> pd.Index:
+        return self.metadata.index
+
+    def _lap(self, label) -> ArchivedLap:
+        return self.session.get_lap(self.metadata.loc[label, "ArchiveIndex"], self.metadata.loc[label])
+
+    def iterlaps(self) -> Iterator[Tuple[int, ArchivedLap]]:
+        for label in self.metadata.index:
+            yield label, self._lap(label)
+
+    def pick_fastest(self, only_by_time : bool = False) -> Optional[ArchivedLap]:
+        laps = self.metadata if only_by_time else self.metadata[self.metadata["IsPersonalBest"]]
+        laps = laps[laps["LapTime"].notna()]
+        if len(laps) == 0:
+            return None
+        return self._lap(laps["LapTime"].idxmin())
+
+class ArchivedSession:
+    "A qualifying session read back from a telemetry archive"
+    def __init__(self, path : str):
+        self.path = path
+        with zipfile.ZipFile(path) as archive:
+            name, event_name, year, round_number = load_npz_member(path, archive, SESSION_KEY, False)
+            self.name = str(name)
+            self.event = ArchivedEvent(str(event_name), int(year), int(round_number))
+            self.compounds : Set[str] = set(str(c) for c in load_npz_member(path, archive, COMPOUNDS_KEY, False))
+            self.offsets = load_npz_member(path, archive, OFFSETS_KEY, False)
+            members = [name[:-len(".npy")] for name in archive.namelist()]
+            metadata = {
+                member[len(LAPS_PREFIX):] : load_npz_member(path, archive, member, False)
+                for member in members if member.startswith(LAPS_PREFIX)
+            }
+            self.channels = {channel : load_npz_member(path, archive, CHANNEL_PREFIX + channel, True) for channel in CHANNELS}
+
+        metadata = pd.DataFrame(metadata)
+        for column in metadata.columns:
+            if metadata[column].dtype.kind == "U":
+                metadata[column] = metadata[column].astype(object)
+        for column in TIME_COLUMNS:
+            metadata[column] = pd.to_timedelta(metadata[column], unit='s')
+        metadata["ArchiveIndex"] = np.arange(len(metadata))
+        self.metadata = metadata
+
+    def __str__(self) -> str:
+        return self.name
+
+    def get_lap(self, archive_index : int, metadata : pd.Series) -> ArchivedLap:
+        start, end = self.offsets[archive_index], self.offsets[archive_index + 1]
+        return ArchivedLap(metadata, {channel : values[start:end] for channel, values in self.channels.items()})
+
+    @property
+    def laps(self) -> ArchivedLaps:
+        "Every archived lap"
+        return ArchivedLaps(self.metadata, self)
+
+    def team_fastest_laps(self) -> ArchivedLaps:
+        "Fastest lap of every team, sorted by lap time, as returned by gen_data.get_team_fastest_laps"
+        metadata = self.metadata[self.metadata["TeamFastest"]].reset_index(drop=True)
+        return ArchivedLaps(metadata, self)
+
+def load_session_archive(directory : str, year : int, round_number : int) -> Optional[ArchivedSession]:
+    "Opens the archive of a qualifying session, or returns None if it wasn't extracted"
+    path = archive_path(directory, year, round_number)
+    return ArchivedSession(path) if os.path.exists(path) else None
+
+def extract_round(year : int, round_number : int, directory : str = ARCHIVE_DIR) -> Optional[str]:
+    "Loads a qualifying session through fastf1 and writes its telemetry archive. Returns None if the session doesn't exist"
+    import fastf1 as ff1
+    from gen_data import get_team_fastest_laps
+
+    try:
+        quali_session = ff1.get_session(year, round_number, 'Q')
+        print(f"Loading {quali_session}")
+        quali_session.load()
+    except ValueError:
+        return None
+    except ff1.core.DataNotLoadedError:
+        return None
+
+    path = archive_path(directory, year, round_number)
+    write_session_archive(quali_session, get_team_fastest_laps(quali_session), path)
+    print(f"Extracted {path} ({os.path.getsize(path) / 1024:.0f} KB)")
+    return path
+
+def extract_season(year : int, directory : str = ARCHIVE_DIR, max_rounds : int = 29) -> List[str]:
+    "Writes the telemetry archive of every qualifying session of a season"
+    paths = []
+    for i in range(1, max_rounds + 1):
+        path = extract_round(year, i, directory)
+        if path is None:
+            break
+        paths.append(path)
+
+    return paths
+
+if __name__ == "__main__":
+    if len(argv) in (3, 4, 5) and argv[1] == "extract":
+        year = int(argv[2])
+        if len(argv) >= 4 and argv[3].isdigit():
+            extract_round(year, int(argv[3]), argv[4] if len(argv) == 5 else ARCHIVE_DIR)
+        else:
+            extract_season(year, argv[3] if len(argv) == 4 else ARCHIVE_DIR)
+    else:
+        print("Usage:")
+        print(f"  {argv[0]} extract year [directory]       | extracts the telemetry archives of every qualifying session of a season")
+        print(f"  {argv[0]} extract year round [directory] | extracts the telemetry archive of a single qualifying session")
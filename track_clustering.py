@@ -1,34 +1,33 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 from sys import argv
 import fastf1 as ff1
-from typing import Set, List
-from gen_data import label_lap, corner_type_performance
+import numpy as np
+from typing import Dict, Iterable, Optional, Set, List
+from gen_data import LABELLERS, corner_type_performance, session_cache_key
+from telemetry_archive import ARCHIVE_DIR, load_session_archive
+from season_index import iter_quali_rounds, iter_quali_sessions, load_quali_session
+from result_cache import ResultCache
+from instrumentation import collect_stages, merge_stages, report, stage
+from columnar import read_table, write_table
 import pandas as pd
 from sklearn.cluster import KMeans
+from sklearn.metrics import davies_bouldin_score, silhouette_score
 from matplotlib import pyplot as plt
 
 ff1.Cache.enable_cache('cache')
 
-def get_season_quali_sessions(year : int, override : Set[str] = set()) -> List[ff1.core.Session]:
-    "Get the dry qualifying sessions from an F1 season"
-    res = []
-    for i in range(1, 30):
-        try:
-            quali_session = ff1.get_session(year, i, 'Q')
-            print(f"Loading {quali_session}")
-            quali_session.load()
-        except ValueError:
-            break
-        except ff1.core.DataNotLoadedError:
-            break
-
-        tyres_used = set(quali_session.laps["Compound"])
-
-        if ('INTERMEDIATE' in tyres_used or 'WET' in tyres_used) and str(quali_session) not in override:            
-            print("Wet weather tyres were used. Skipping this event")
-            continue
-        res.append(quali_session)
+# K-means sweep: every k of CLUSTER_RANGE is fitted once (in parallel), with a fixed seed so that results are
+# reproducible, and its labels, centers, inertia and silhouette / Davies-Bouldin scores are cached by input data.
+# The elbow plot and the per-k cluster listings are then served from the same sweep.
+CLUSTER_RANGE = range(1, 11)
+SEED = 0
+N_INIT = 10
+SWEEP_VERSION = 1
 
-    return res
+def get_season_quali_sessions(year : int, override : Set[str] = set(), archive_dir : Optional[str] = None) -> List[ff1.core.Session]:
+    "Get the dry qualifying sessions from an F1 season"
+    return list(iter_quali_sessions(year, override, archive_dir))
 
 def get_gp_name(full_name : str) -> str:
     gp_start = full_name.index(":") + 2
@@ -39,6 +38,17 @@ def get_gp_name(full_name : str) -> str:
     return res
 
 
+def get_session_corners_breakdown(session : ff1.core.Session, labelling : str = "distance") -> Dict[str, float]:
+    "Time spent on each corner type by the fastest lap of a loaded session"
+    lap = session.laps.pick_fastest()
+    with stage("label_lap", Session=str(session), Driver=lap["Driver"]):
+        LABELLERS[labelling](session, lap)
+    with stage("corner_type_performance", Session=str(session), Driver=lap["Driver"]):
+        corner_performance = corner_type_performance(lap)
+    for corner_type in corner_performance:
+        corner_performance[corner_type] = round(corner_performance[corner_type]["Time"], 4)
+    return corner_performance
+
 def get_track_corners_breakdown(sessions : List[ff1.core.Session]) -> pd.DataFrame:
     res = {}
 
@@ -46,15 +56,50 @@ def get_track_corners_breakdown(sessions : List[ff1.core.Session]) -> pd.DataFra
         gp_name = get_gp_name(str(session))
 
         print(f"Processing {gp_name}...")
-        lap = session.laps.pick_fastest()
-        label_lap(session, lap)
-        corner_performance = corner_type_performance(lap)
-        for corner_type in corner_performance:
-            corner_performance[corner_type] = round(corner_performance[corner_type]["Time"], 4)
-        res[gp_name] = corner_performance
+        res[gp_name] = get_session_corners_breakdown(session)
     
     return pd.DataFrame(res).T
 
+def session_entry(year : int, race : int, archive_dir : Optional[str] = None) -> Optional[Dict]:
+    "Minimal season index entry (Year, RoundNumber, Session) of a qualifying session, without loading it"
+    session = ff1.get_session(year, race, 'Q') if archive_dir is None else load_session_archive(archive_dir, year, race)
+    if session is None:
+        print(f"No archive for {year} round {race}")
+        return None
+    return {"Year" : year, "RoundNumber" : race, "Session" : str(session)}
+
+def get_cached_track_corners_breakdown(entries : List[Dict], archive_dir : Optional[str] = None, labelling : str = "distance") -> Dict[str, Dict[str, float]]:
+    """Fastest lap corner breakdown of every given qualifying session, only loading the sessions that aren't in the result cache
+
+    Args:
+        entries (List[Dict]): Season index entries (Year, RoundNumber, Session) of the sessions
+        archive_dir (Optional[str], optional): Read the sessions from the telemetry archives in this directory instead of loading them with fastf1
+        labelling (str, optional): Corner labelling mode, a key of gen_data.LABELLERS. Defaults to "distance".
+
+    Returns:
+        Dict[str, Dict[str, float]]: Breakdown of every session, by GP name
+    """
+    cache = ResultCache("track_corners")
+    res = {}
+    for entry in entries:
+        gp_name = get_gp_name(entry["Session"])
+        key = session_cache_key(cache, entry, archived = archive_dir is not None, labelling = labelling)
+        breakdown = cache.get(key)
+
+        if breakdown is None:
+            session = load_quali_session(entry["Year"], entry["RoundNumber"], archive_dir)
+            if session is None:
+                print(f"Could not load {entry['Session']}. Skipping this event")
+                continue
+            print(f"Processing {gp_name}...")
+            breakdown = get_session_corners_breakdown(session, labelling)
+            cache.put(key, breakdown)
+
+        res[gp_name] = breakdown
+
+    cache.report()
+    return res
+
 def check_for_every_race(dt : pd.DataFrame):
     f1_2024 = {"Bahrain", "Saudi Arabian", "Australian", "Japanese", "Chinese", "Miami",
                 "Emilia Romagna", "Monaco", "Canadian", "Spanish", "Austrian", "British",
@@ -68,43 +113,100 @@ def check_for_every_race(dt : pd.DataFrame):
         print(sorted(differences))
         exit()
 
-def gen_data():
-    sessions = get_season_quali_sessions(2023, {'2023 Season Round 10: British Grand Prix - Qualifying',})
+def gen_data(path : str = "track_corners_db.json", archive_dir : Optional[str] = None, labelling : str = "distance"):
+    entries = list(iter_quali_rounds(2023, {'2023 Season Round 10: British Grand Prix - Qualifying',}, archive_dir))
 
     missing_session_keys = ((2019, 3), (2022, 15), (2022, 14), (2019, 7), (2021, 2))
     for year, race in missing_session_keys:
-        session = ff1.get_session(year, race, 'Q')
-        print(f"Loading {get_gp_name(str(session))}")
-        session.load()
-        sessions.append(session)
-        # print(set(session.laps["Compound"]))
+        entry = session_entry(year, race, archive_dir)
+        if entry is not None:
+            entries.append(entry)
 
-    dt = get_track_corners_breakdown(sessions)
+    dt = pd.DataFrame(get_cached_track_corners_breakdown(entries, archive_dir, labelling)).T
     print(dt)
-    dt.to_json("track_corners_db.json")
+    with stage("write", Path=path):
+        write_table(dt, path)
 
-def elbow_method(dt : pd.DataFrame):
-    # https://www.w3schools.com/python/python_ml_k-means.asp
-    inertias = []
+def fit_kmeans(values : np.ndarray, k : int, seed : int = SEED) -> Dict:
+    "Fits K-means with k clusters, returning its labels, centers, inertia and scores (None when undefined, e.g. for k = 1)"
+    with stage("kmeans_fit", Clusters=k):
+        kmeans = KMeans(n_clusters=k, n_init=N_INIT, random_state=seed)
+        kmeans.fit(values)
+
+    scored = 1 < k < len(values)
+    return {
+        "K" : k,
+        "Labels" : kmeans.labels_.tolist(),
+        "Centers" : kmeans.cluster_centers_.tolist(),
+        "Inertia" : float(kmeans.inertia_),
+        "Silhouette" : float(silhouette_score(values, kmeans.labels_)) if scored else None,
+        "DaviesBouldin" : float(davies_bouldin_score(values, kmeans.labels_)) if scored else None,
+    }
+
+def cluster_sweep(dt : pd.DataFrame, ks : Iterable[int] = CLUSTER_RANGE, seed : int = SEED, parallel : bool = True, use_cache : bool = True) -> Dict[int, Dict]:
+    """Fits K-means for every k of a range, only fitting the k that aren't cached for this data and seed
+
+    Args:
+        dt (pd.DataFrame): Data to cluster (e.g. the normalized track corners db)
+        ks (Iterable[int], optional): Numbers of clusters. Defaults to CLUSTER_RANGE.
+        seed (int, optional): Random seed of the fits. Defaults to SEED.
+        parallel (bool, optional): Fit the missing k in a pool of worker processes. Defaults to True.
+        use_cache (bool, optional): Reuse the fits of previous runs. Defaults to True.
+
+    Returns:
+        Dict[int, Dict]: Fit of every k (see fit_kmeans)
+    """
+    ks = [k for k in ks if k <= len(dt)]
+    values = dt.to_numpy(dtype=float)
+    cache = ResultCache("kmeans") if use_cache else None
+    keys = {}
+    res = {}
+    for k in ks:
+        if cache is not None:
+            keys[k] = cache.key([str(c) for c in dt.columns], [str(i) for i in dt.index], values.tolist(), k, seed, N_INIT, SWEEP_VERSION)
+            res[k] = cache.get(keys[k])
+    pending = [k for k in ks if res.get(k) is None]
 
-    for i in range(1,11):
-        kmeans = KMeans(n_clusters=i, n_init=10)
-        kmeans.fit(dt)
-        inertias.append(kmeans.inertia_)
+    if parallel and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers = min(len(pending), os.cpu_count())) as executor:
+            fits = []
+            for fit, stages in executor.map(collect_stages, [fit_kmeans] * len(pending), [values] * len(pending), pending, [seed] * len(pending)):
+                merge_stages(stages)
+                fits.append(fit)
+    else:
+        fits = [fit_kmeans(values, k, seed) for k in pending]
+
+    for k, fit in zip(pending, fits):
+        res[k] = fit
+        if cache is not None:
+            cache.put(keys[k], fit)
+
+    if cache is not None:
+        cache.report()
+    return {k : res[k] for k in ks}
+
+def sweep_scores(sweep : Dict[int, Dict]) -> pd.DataFrame:
+    "Inertia, silhouette and Davies-Bouldin score of every k of a sweep"
+    return pd.DataFrame([{key : fit[key] for key in ("K", "Inertia", "Silhouette", "DaviesBouldin")} for fit in sweep.values()]).set_index("K")
 
-    plt.plot(range(1,11), inertias, marker='o')
+def elbow_method(dt : pd.DataFrame, sweep : Optional[Dict[int, Dict]] = None):
+    # https://www.w3schools.com/python/python_ml_k-means.asp
+    if sweep is None:
+        sweep = cluster_sweep(dt)
+    scores = sweep_scores(sweep)
+
+    plt.plot(scores.index, scores["Inertia"], marker='o')
     plt.title('Elbow method')
     plt.xlabel('Number of clusters')
     plt.ylabel('Inertia')
     plt.show() 
 
-def kmeans_clustering(dt : pd.DataFrame, n : int = 2):
-    kmeans = KMeans(n_clusters=n, n_init='auto')
-    kmeans.fit(dt)
+def kmeans_clustering(dt : pd.DataFrame, n : int = 2, sweep : Optional[Dict[int, Dict]] = None):
+    fit = sweep[n] if sweep is not None and n in sweep else cluster_sweep(dt, [n], parallel = False)[n]
 
     dt1 = dt.copy(True)
 
-    dt1["Cluster"] = kmeans.labels_
+    dt1["Cluster"] = fit["Labels"]
     
     res = {}
     for i in range(n):
@@ -128,17 +230,30 @@ if __name__ == "__main__":
     if len(argv) == 1:
         print("Usage:")
         print(f"  {argv[0]} gen | generate 'track_corners_db.json'")
+        print(f"  {argv[0]} gen archive [directory] | generate 'track_corners_db.json' from the telemetry archives")
+        print(f"  {argv[0]} gen speed | generate 'track_corners_db.json', classifying corners by speed bands instead of CORNER_LABELS")
         print(f"  {argv[0]} run | runs the K-means clustering method on the 'track_corners_db.json' data")
     elif len(argv) == 2 and argv[1] == "gen":
         gen_data()
+        report()
+    elif len(argv) == 3 and argv[1] == "gen" and argv[2] == "speed":
+        gen_data(labelling = "speed")
+        report()
+    elif len(argv) in (3, 4) and argv[1] == "gen" and argv[2] == "archive":
+        gen_data(archive_dir = argv[3] if len(argv) == 4 else ARCHIVE_DIR)
+        report()
     elif len(argv) == 2 and argv[1] == "run":
-        dt = pd.read_json("track_corners_db.json")
+        dt = read_table("track_corners_db.json")
         df = normalize(dt)
 
-        elbow_method(df)
+        sweep = cluster_sweep(df)
+        print(sweep_scores(sweep).round(3))
+        print()
+        elbow_method(df, sweep)
         for i in (2, 3, 4):
-            kmeans_clustering(df, i)
+            kmeans_clustering(df, i, sweep)
             print("="*80)
+        report()
     elif len(argv) == 2:
         print("Invalid argument")
     else:
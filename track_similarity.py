@@ -0,0 +1,141 @@
+import os
+from sys import argv
+from time import perf_counter
+from typing import List, NamedTuple, Optional, Union
+import numpy as np
+import pandas as pd
+from data import CORNER_TYPES
+from columnar import read_table
+
+# Nearest-track index: every track of track_corners_db.json is a point in corner type space (share of the lap
+# time spent on each corner type, as in track_clustering.normalize). The index also holds the gap of every team
+# to the fastest team on each track, from the cornering data, so that the neighbours of a track tell how the
+# teams performed on similar tracks. It is built once and persisted; queries are a brute-force distance
+# computation over a few dozen tracks, which takes well under a millisecond.
+
+INDEX_PATH = os.path.join('cache', 'track_index.npz')
+
+class TrackIndex(NamedTuple):
+    tracks  : np.ndarray # GP names, as in track_corners_db.json
+    vectors : np.ndarray # (track, corner type) share of the lap time spent on each corner type, in %
+    teams   : np.ndarray
+    gaps    : np.ndarray # (track, team) gap to the fastest team, in % of its lap time (NaN if unknown)
+
+def normalize_vectors(times : np.ndarray) -> np.ndarray:
+    "Share of the lap time spent on each corner type, in % (like track_clustering.normalize), of one or many time vectors"
+    times = np.asarray(times, dtype=float)
+    return times * 100 / times.sum(axis=-1, keepdims=True)
+
+def gp_short_name(gp_name : str) -> str:
+    "GP name of the cornering data (e.g. ' British Grand Prix') as in track_corners_db.json ('British GP')"
+    return gp_name.strip().replace("Grand Prix", "GP")
+
+def team_gaps(data : pd.DataFrame) -> pd.DataFrame:
+    "(GP, team) gap of every team to the fastest team of each GP, in % of its lap time, from cornering performance data"
+    lap_times = data.groupby(["GPName", "Team"], observed = True)["Time"].sum().unstack("Team")
+    lap_times.index = [gp_short_name(gp) for gp in lap_times.index]
+    return (lap_times.div(lap_times.min(axis=1), axis=0) - 1) * 100
+
+def build_track_index(tracks : pd.DataFrame, data : Optional[pd.DataFrame] = None) -> TrackIndex:
+    """Builds the nearest-track index
+
+    Args:
+        tracks (pd.DataFrame): (track x corner type) time spent on each corner type, e.g. track_corners_db.json
+        data (Optional[pd.DataFrame], optional): Cornering performance data (cornering_data.json), for the team gaps
+
+    Returns:
+        TrackIndex: The index
+    """
+    gaps = team_gaps(data) if data is not None else pd.DataFrame(index=tracks.index)
+    gaps = gaps.reindex(index=tracks.index)
+    return TrackIndex(
+        tracks.index.to_numpy().astype(str),
+        normalize_vectors(tracks.reindex(columns=CORNER_TYPES).to_numpy(dtype=float)),
+        gaps.columns.to_numpy().astype(str),
+        gaps.to_numpy(dtype=float),
+    )
+
+def save_track_index(index : TrackIndex, path : str = INDEX_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    np.savez(path, **index._asdict())
+
+def load_track_index(path : str = INDEX_PATH) -> TrackIndex:
+    with np.load(path) as archive:
+        return TrackIndex(**{field : archive[field] for field in TrackIndex._fields})
+
+def get_track_index(tracks_path : str = "track_corners_db.json", data_path : str = "cornering_data.json", path : str = INDEX_PATH) -> TrackIndex:
+    "Loads the persisted index, (re)building it if it is missing or older than its source tables"
+    sources = [p for p in (tracks_path, data_path) if os.path.exists(p)]
+    if os.path.exists(path) and all(os.path.getmtime(p) <= os.path.getmtime(path) for p in sources):
+        return load_track_index(path)
+
+    data = read_table(data_path) if os.path.exists(data_path) else None
+    index = build_track_index(read_table(tracks_path), data)
+    save_track_index(index, path)
+    return index
+
+def nearest_tracks(index : TrackIndex, query : Union[str, List[float]], k : int = 3) -> pd.DataFrame:
+    """Finds the tracks closest to a track of the index or to a new one
+
+    Args:
+        index (TrackIndex): Nearest-track index
+        query (Union[str, List[float]]): GP name of a track of the index, or the time spent on each corner type
+            (5 floats, ordered as in CORNER_TYPES) by a new track
+        k (int, optional): Number of neighbours. Defaults to 3.
+
+    Returns:
+        pd.DataFrame: Track and Distance (euclidean, in corner type share %) of the k nearest tracks, nearest first
+    """
+    if isinstance(query, str):
+        matches = np.flatnonzero(index.tracks == query)
+        if len(matches) == 0:
+            raise KeyError(f"Unknown track '{query}'")
+        vector = index.vectors[matches[0]]
+        candidates = np.flatnonzero(index.tracks != query)
+    else:
+        if len(query) != len(CORNER_TYPES):
+            raise ValueError(f"A track vector has {len(CORNER_TYPES)} values ({', '.join(CORNER_TYPES)})")
+        vector = normalize_vectors(query)
+        candidates = np.arange(len(index.tracks))
+
+    distances = np.sqrt(((index.vectors[candidates] - vector) ** 2).sum(axis=1))
+    k = min(k, len(candidates))
+    nearest = np.argpartition(distances, k - 1)[:k] if k > 0 else np.empty(0, dtype=int)
+    nearest = nearest[np.argsort(distances[nearest], kind="stable")]
+    return pd.DataFrame({"Track" : index.tracks[candidates[nearest]], "Distance" : distances[nearest]})
+
+def neighbour_performance(index : TrackIndex, neighbours : pd.DataFrame) -> pd.DataFrame:
+    "(team x neighbour track) gaps to the fastest team of the neighbours of a query, and their inverse distance weighted mean ('Expected')"
+    rows = pd.Index(index.tracks).get_indexer(neighbours["Track"])
+    gaps = pd.DataFrame(index.gaps[rows].T, index=index.teams, columns=neighbours["Track"])
+
+    weights = 1 / np.maximum(neighbours["Distance"].to_numpy(), 1e-9)
+    known = ~np.isnan(gaps.to_numpy())
+    weighted = np.where(known, gaps.to_numpy(), 0) @ weights
+    total = known @ weights
+    gaps["Expected"] = np.divide(weighted, total, out=np.full(len(gaps), np.nan), where=total > 0)
+    return gaps.sort_values(by="Expected")
+
+if __name__ == "__main__":
+    if len(argv) == 2 and argv[1] == "build":
+        index = build_track_index(read_table("track_corners_db.json"), read_table("cornering_data.json") if os.path.exists("cornering_data.json") else None)
+        save_track_index(index)
+        print(f"Indexed {len(index.tracks)} tracks ({len(index.teams)} teams) in {INDEX_PATH}")
+    elif len(argv) in (2, 3) or len(argv) in (6, 7):
+        index = get_track_index()
+        k = int(argv[-1]) if len(argv) in (3, 7) else 3
+        query = argv[1] if len(argv) in (2, 3) else [float(value) for value in argv[1:6]]
+        start = perf_counter()
+        neighbours = nearest_tracks(index, query, k)
+        performance = neighbour_performance(index, neighbours)
+        elapsed = perf_counter() - start
+        print(neighbours.round(2).to_string(index=False))
+        print()
+        print("Gap to the fastest team on the nearest tracks (%):")
+        print(performance.round(2))
+        print(f"\nQuery answered in {elapsed * 1000:.2f}ms")
+    else:
+        print("Usage:")
+        print(f"  {argv[0]} build                                       | (re)builds the nearest-track index of 'track_corners_db.json'")
+        print(f"  {argv[0]} 'GP name' [k]                               | k nearest tracks of a track of the index")
+        print(f"  {argv[0]} low medium_low medium_high high straight [k] | k nearest tracks of a new track (time spent on each corner type)")
@@ -1,11 +1,19 @@
 import fastf1 as ff1
 from matplotlib import pyplot as plt
 import matplotlib as mpl
+from matplotlib.collections import LineCollection
 from timple.timedelta import strftimedelta
 from fastf1 import plotting
 import numpy as np
 from data import CORNER_COLORS, CORNER_TYPES
-from gen_data import get_team_fastest_laps, corner_type_performance, label_lap
+from gen_data import CORNER_CHANNELS, corner_type_performance, get_label_index
+from instrumentation import report, stage
+from lap_grid import LapTensor, time_deltas
+from lap_trace import LapTrace, lap_trace
+from session_analysis import SessionAnalysis, session_analysis
+from telemetry_archive import ARCHIVE_DIR
+from season_index import iter_quali_sessions, load_quali_session
+from typing import Dict, Optional, Union
 from sys import argv
 
 # Straight-line: Full throttle
@@ -17,9 +25,11 @@ from sys import argv
 
 ff1.Cache.enable_cache('cache')
 
-def plot_team_quali_performance(session : ff1.core.Session, ax : mpl.axes.Axes):
+def plot_team_quali_performance(session : Union[ff1.core.Session, SessionAnalysis], ax : mpl.axes.Axes):
     "Plots the best lap of each team as an horizontal bar plot"
-    fastest_laps = get_team_fastest_laps(session)
+    analysis = session_analysis(session)
+    session = analysis.session
+    fastest_laps = analysis.fastest_laps
     pole_lap = fastest_laps.pick_fastest()
 
     team_colors = list()
@@ -46,23 +56,39 @@ def plot_team_quali_performance(session : ff1.core.Session, ax : mpl.axes.Axes):
     ax.set_title(f"{session.event['EventName']} {session.event.year} Qualifying\n"
                  f"Fastest Lap: {lap_time_string} ({pole_lap['Driver']})")
 
-def plot_track_map(lap : ff1.core.Lap, ax : mpl.axes.Axes):
+# Colour of every corner type code (index in CORNER_TYPES)
+CODE_COLORS = np.array([CORNER_COLORS[corner_type] for corner_type in CORNER_TYPES], dtype=object)
+
+def colored_segments(x : np.ndarray, y : np.ndarray, codes : np.ndarray, closed : bool = False, **kwargs) -> LineCollection:
+    "Builds a single collection of line segments between consecutive points, each coloured by the corner type code of its first point"
+    if closed:
+        x, y = np.append(x, x[:1]), np.append(y, y[:1])
+    points = np.column_stack([x, y])
+    segments = np.stack([points[:-1], points[1:]], axis=1)
+    colors = CODE_COLORS[codes[:len(segments)]].tolist()
+
+    return LineCollection(segments, colors=colors, linestyle='-', **kwargs)
+
+def decimated_trace(lap : Union[ff1.core.Lap, LapTrace], decimate : int = 1) -> LapTrace:
+    "Trace of a lap keeping one sample out of every `decimate`, always including the last one"
+    trace = lap_trace(lap)
+    if decimate <= 1 or len(trace) == 0:
+        return trace
+    keep = np.arange(0, len(trace), decimate)
+    if keep[-1] != len(trace) - 1:
+        keep = np.append(keep, len(trace) - 1)
+    return trace.take(keep)
+
+def plot_track_map(lap : Union[ff1.core.Lap, LapTrace], ax : mpl.axes.Axes, decimate : int = 1):
     "Plots a track map, coloured by corner type"
     ax.set_aspect('equal', adjustable='box')
     ax.axis('off')
 
-    for i0 in range(len(lap.telemetry)):
-        i1 = (i0 + 1) % len(lap.telemetry)
+    trace = decimated_trace(lap, decimate)
+    ax.add_collection(colored_segments(trace.x, trace.y, trace.corner_codes(), closed = True, linewidth = 2))
+    ax.autoscale_view()
 
-        row0 = lap.telemetry.iloc[i0]
-        row1 = lap.telemetry.iloc[i1]
-
-        corner_type = row0["CornerType"]
-        color = CORNER_COLORS[corner_type]
-
-        ax.plot([row0["X"], row1["X"]], [row0["Y"], row1["Y"]], color=color, linestyle='-', linewidth = 2)
-
-def plot_speedtrace(lap : ff1.core.Lap, ax : mpl.axes.Axes, time : bool = False):
+def plot_speedtrace(lap : Union[ff1.core.Lap, LapTrace], ax : mpl.axes.Axes, time : bool = False, decimate : int = 1):
     "Plots the speed trace of the given lap"
     ax.set(xlabel = "Time (s)" if time else "Distance (m)", ylabel = "Speed (km/h)")
 
@@ -70,33 +96,18 @@ def plot_speedtrace(lap : ff1.core.Lap, ax : mpl.axes.Axes, time : bool = False)
     ax.axhline(y = 150, color = 'grey', linestyle = '-') 
     ax.axhline(y = 200, color = 'grey', linestyle = '-') 
 
-    for i0 in range(len(lap.telemetry) - 1):
-        i1 = i0 + 1
-
-        row0 = lap.telemetry.iloc[i0]
-        row1 = lap.telemetry.iloc[i1]
-
-        corner_type = row0["CornerType"]
-        color = CORNER_COLORS[corner_type]
-
-        ax.plot(
-            [row0["Time"] / np.timedelta64(1, 's'), row1["Time"] / np.timedelta64(1, 's')] if time else [row0["Distance"], row1["Distance"]], 
-            [row0["Speed"], row1["Speed"]], 
-            color=color, 
-            linestyle='-', 
-            linewidth = 1
-        )
-        ax.plot(
-            [row0["Time"] / np.timedelta64(1, 's'), row1["Time"] / np.timedelta64(1, 's')] if time else [row0["Distance"], row1["Distance"]], 
-            [row0["Throttle"] / 2, row1["Throttle"] / 2], 
-            color=color, 
-            linestyle='-', 
-            linewidth = 1
-        )
-
-def plot_time_per_type(lap : ff1.core.Lap, ax : mpl.axes.Axes):
-    "Plots the time spent on each corner type, as an horizontal bar plot"
-    corner_performance = corner_type_performance(lap)
+    trace = decimated_trace(lap, decimate)
+    x = trace.time if time else trace.distance
+    codes = trace.corner_codes()
+
+    ax.add_collection(colored_segments(x, trace.speed,        codes, linewidth = 1))
+    ax.add_collection(colored_segments(x, trace.throttle / 2, codes, linewidth = 1))
+    ax.autoscale_view()
+
+def plot_time_per_type(lap : Union[ff1.core.Lap, LapTrace], ax : mpl.axes.Axes, corner_performance : Optional[Dict[str, Dict[str, float]]] = None):
+    "Plots the time spent on each corner type, as an horizontal bar plot (corner_performance: the corner_type_performance of the lap, if already known)"
+    if corner_performance is None:
+        corner_performance = corner_type_performance(lap)
     times = [
         corner_performance["LOW"]        ["Time"],
         corner_performance["MEDIUM-LOW"] ["Time"],
@@ -110,21 +121,24 @@ def plot_time_per_type(lap : ff1.core.Lap, ax : mpl.axes.Axes):
     ax.set_yticklabels(CORNER_TYPES)
     ax.set(xlabel = "Time (s)")
 
-def plot_performance_per_car(session : ff1.core.Session, ax : mpl.axes.Axes):
+def plot_performance_per_car(session : Union[ff1.core.Session, SessionAnalysis], ax : mpl.axes.Axes, labelling : str = "distance"):
     "Plots a breakdown of the performance of every team by corner types, as a parallel coordinates plot"
-    fastest_laps = get_team_fastest_laps(session)
+    draw_performance_per_car(session_analysis(session, labelling).team_performance, ax)
+
+def draw_performance_per_car(team_performance : Dict[str, Dict[str, Dict[str, float]]], ax : mpl.axes.Axes) -> Dict[str, mpl.lines.Line2D]:
+    "Draws the plot_performance_per_car view from the corner_type_performance of the fastest lap of every team (by team). Returns the line of every team"
+    lines = update_performance_per_car(team_performance, ax, {})
+
+    ax.set_xticks([0, 1, 2, 3, 4])
+    ax.set_xticklabels(CORNER_TYPES,rotation = 25, ha='right')
+    for i in range(5):
+        ax.axvline(x = i, color = 'grey', linestyle = '-')
+    return lines
+
+def update_performance_per_car(team_performance : Dict[str, Dict[str, Dict[str, float]]], ax : mpl.axes.Axes, lines : Dict[str, mpl.lines.Line2D]) -> Dict[str, mpl.lines.Line2D]:
+    "Moves the lines of a drawn plot_performance_per_car view (see draw_performance_per_car) to new performances, adding the lines of new teams"
     team_corner_performance = {}
-    for i, lap in fastest_laps.iterlaps():
-        driver = lap["Driver"]
-        print(f"Processing {driver}...")
-        team = lap["Team"]
-        try:
-            label_lap(session, lap)
-        except ValueError:
-            # No clue why this happens. Maybe a ff1 bug? Bad data? Both? Who knows
-            continue
-        corner_performance = corner_type_performance(lap)
-        
+    for team, corner_performance in team_performance.items():
         team_corner_performance[team] = {}
         for corner_type in corner_performance:
             team_corner_performance[team][corner_type] = corner_performance[corner_type]["Speed"]
@@ -135,6 +149,16 @@ def plot_performance_per_car(session : ff1.core.Session, ax : mpl.axes.Axes):
         averages[ct] = sum(speeds)/len(speeds)
     
     for team in team_corner_performance:
+        speeds = []
+
+        for ct in CORNER_TYPES:
+            speeds.append(team_corner_performance[team][ct] - averages[ct])
+
+        # Every team is plotted against the average, so all the lines move when one of them does
+        if team in lines:
+            lines[team].set_ydata(speeds)
+            continue
+
         if team == 'Haas F1 Team':
             team_color = "black"
         else:
@@ -142,66 +166,128 @@ def plot_performance_per_car(session : ff1.core.Session, ax : mpl.axes.Axes):
                 team_color = ff1.plotting.team_color(team)
             except KeyError:
                 team_color = "black"
-        speeds = []
-
-        for ct in CORNER_TYPES:
-            speeds.append(team_corner_performance[team][ct] - averages[ct])
-
-        ax.plot([0, 1, 2, 3, 4], speeds, color = team_color)
-    
-    ax.set_xticks([0, 1, 2, 3, 4])
-    ax.set_xticklabels(CORNER_TYPES,rotation = 25, ha='right')
-    for i in range(5):
-        ax.axvline(x = i, color = 'grey', linestyle = '-')
+        lines[team], = ax.plot([0, 1, 2, 3, 4], speeds, color = team_color)
 
-def show_track_stats(session : ff1.core.Session):
-    "Shows the qualifying stats for a given session as a 2x3 grid of plots"
-    fig, axes = plt.subplots(2, 3, figsize=(12, 12))
+    ax.relim()
+    ax.autoscale_view()
+    return lines
 
-    plot_team_quali_performance(session, axes[0][0])
+def plot_delta_traces(tensor : LapTensor, ax : mpl.axes.Axes):
+    "Plots the time delta to the fastest lap of the fastest lap of every team, along the lap"
+    deltas = time_deltas(tensor)
+    for i, team in enumerate(tensor.laps["Team"]):
+        try:
+            team_color = ff1.plotting.team_color(team)
+        except KeyError:
+            team_color = "black"
+        ax.plot(tensor.grid, deltas[i], color = team_color, linewidth = 1, label = tensor.laps["Driver"][i])
+
+    ax.axhline(y = 0, color = 'grey', linestyle = '--')
+    ax.set(xlabel = "Distance (m)", ylabel = f"Delta to {tensor.laps['Driver'][0]} (s)")
+    ax.legend(fontsize = "x-small", ncol = 2)
+
+def plot_corner_time_deltas(session : Union[ff1.core.Session, SessionAnalysis], ax : mpl.axes.Axes, apex_ax : Optional[mpl.axes.Axes] = None):
+    "Plots the time lost by every team to the fastest team in each corner of CORNER_LABELS, as a heatmap (and their apex speeds on apex_ax)"
+    analysis = session_analysis(session)
+    fastest_laps = analysis.team_traces
+    performance = analysis.corner_breakdown
+    times = performance[:, :, CORNER_CHANNELS.index("Time")]
+    deltas = times - np.nanmin(times, axis=0)
+    corners = np.arange(1, times.shape[1] + 1)
+    drivers = [lap["Driver"] for lap in fastest_laps]
+
+    image = ax.imshow(deltas, cmap="Reds", aspect="auto")
+    ax.figure.colorbar(image, ax=ax, label="Time lost (s)")
+    ax.set_xticks(range(len(corners)))
+    ax.set_xticklabels(corners)
+    for tick, corner_type in zip(ax.get_xticklabels(), get_label_index(analysis.name).types[:-1]):
+        tick.set_color(CORNER_COLORS[corner_type])
+    ax.set_yticks(range(len(drivers)))
+    ax.set_yticklabels(drivers)
+    ax.set(xlabel = "Corner", title = "Time lost to the fastest team in each corner")
+
+    if apex_ax is not None:
+        for lap, apex_speeds in zip(fastest_laps, performance[:, :, CORNER_CHANNELS.index("ApexSpeed")]):
+            try:
+                team_color = ff1.plotting.team_color(lap["Team"])
+            except KeyError:
+                team_color = "black"
+            apex_ax.plot(corners, apex_speeds, color = team_color, marker = 'o', label = lap["Driver"])
+        apex_ax.set_xticks(corners)
+        apex_ax.set(xlabel = "Corner", ylabel = "Apex speed (km/h)")
+        apex_ax.legend(fontsize = "x-small", ncol = 2)
+
+def show_corner_breakdown(session : Union[ff1.core.Session, SessionAnalysis]):
+    "Shows the per-corner breakdown of the fastest lap of every team (time lost and apex speed in each corner)"
+    fig, axes = plt.subplots(2, 1, figsize=(12, 10))
+    with stage("plot_corner_time_deltas", Session=session_analysis(session).name):
+        plot_corner_time_deltas(session, axes[0], axes[1])
+    plt.show()
 
-    lap = session.laps.pick_fastest()
-    label_lap(session, lap)
+def track_stats_figure(session : Union[ff1.core.Session, SessionAnalysis], decimate : int = 1, labelling : str = "distance") -> mpl.figure.Figure:
+    """Draws the qualifying stats for a given session as a 2x3 grid of plots (decimate > 1 thins out the telemetry traces, labelling is a key of LABELLERS)
 
-    plot_speedtrace         (lap, axes[0][1])
-    plot_track_map          (lap, axes[1][1])
-    plot_time_per_type      (lap, axes[1][0])
-    plot_performance_per_car(session, axes[0][2])
+    Every panel draws from a single SessionAnalysis, so the fastest laps are picked, labelled and broken down once.
+    """
+    fig, axes = plt.subplots(2, 3, figsize=(12, 12))
 
+    analysis = session_analysis(session, labelling)
+    name = analysis.name
+    with stage("plot_team_quali_performance", Session=name):
+        plot_team_quali_performance(analysis, axes[0][0])
+
+    lap = analysis.pole_lap
+
+    with stage("plot_speedtrace", Session=name):
+        plot_speedtrace         (lap, axes[0][1], decimate = decimate)
+    with stage("plot_track_map", Session=name):
+        plot_track_map          (lap, axes[1][1], decimate = decimate)
+    with stage("plot_time_per_type", Session=name):
+        plot_time_per_type      (lap, axes[1][0], analysis.performance(lap))
+    with stage("plot_performance_per_car", Session=name):
+        plot_performance_per_car(analysis, axes[0][2])
+    with stage("plot_delta_traces", Session=name):
+        plot_delta_traces       (analysis.lap_tensor, axes[1][2])
+
+    return fig
+
+def show_track_stats(session : Union[ff1.core.Session, SessionAnalysis], decimate : int = 1, labelling : str = "distance", corners : bool = False):
+    "Shows the qualifying stats for a given session as a 2x3 grid of plots (see track_stats_figure), corners adds the per-corner breakdown"
+    analysis = session_analysis(session, labelling)
+    track_stats_figure(analysis, decimate)
     plt.show()
+    if corners:
+        show_corner_breakdown(analysis)
 
-def show_season_performance(year : int):
+def show_season_performance(year : int, archive_dir : Optional[str] = None, labelling : str = "distance", corners : bool = False):
     "Shows the qualifying stats for every qualifying session of a given F1 season"
-    for i in range(1, 30):
-        try:
-            quali_session = ff1.get_session(year, i, 'Q')
-            print(f"Loading {quali_session}")
-            quali_session.load()
-        except ValueError:
-            break
-        except ff1.core.DataNotLoadedError:
-            break
-
-        tyres_used = set(quali_session.laps["Compound"])
-
-        if ('INTERMEDIATE' in tyres_used or 'WET' in tyres_used) and str(quali_session) not in {'2023 Season Round 10: British Grand Prix - Qualifying',}:
-            print("Wet weather tyres were used. Skipping this event")
-            continue
-
-        show_track_stats(quali_session)
+    for quali_session in iter_quali_sessions(year, {'2023 Season Round 10: British Grand Prix - Qualifying',}, archive_dir):
+        show_track_stats(quali_session, labelling = labelling, corners = corners)
 
 if __name__ == "__main__":
+    archive_dir = None
+    labelling = "distance"
+    corners = False
+    for option in argv[3:]:
+        if option == "archive":
+            archive_dir = ARCHIVE_DIR
+        elif option == "speed":
+            labelling = "speed"
+        elif option == "corners":
+            corners = True
+    argv = argv[:3] if all(option in ("archive", "speed", "corners") for option in argv[3:]) else argv
+
     if len(argv) == 3 and argv[2] == "all":
-        show_season_performance(int(argv[1]))
+        show_season_performance(int(argv[1]), archive_dir, labelling, corners)
+        report()
     elif len(argv) == 3:
         year = int(argv[1])
         round_number = int(argv[2])
 
-        quali_session = ff1.get_session(year, round_number, 'Q')
-        print(f"Loading {quali_session}")
-        quali_session.load()
-        show_track_stats(quali_session)
+        quali_session = load_quali_session(year, round_number, archive_dir)
+        show_track_stats(quali_session, labelling = labelling, corners = corners)
+        report()
     else:
         print("Usage:")
-        print(f"  {argv[0]} year 'all'")
-        print(f"  {argv[0]} year round_number")
\ No newline at end of file
+        print(f"  {argv[0]} year 'all' ['archive'] ['speed'] ['corners']")
+        print(f"  {argv[0]} year round_number ['archive'] ['speed'] ['corners']")